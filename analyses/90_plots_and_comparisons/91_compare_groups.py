@@ -22,9 +22,6 @@ import pandas as pd
 from nxfvars import nxfvars
 import numpy as np
 from scanpy_helpers import compare_groups
-import pickle
-import os
-import re
 
 sc.settings.set_figure_params(figsize=(5, 5))
 
@@ -41,8 +38,6 @@ stratification_csv = nxfvars.get(
     "stratification_csv",
     "../../data/30_downstream_analyses/stratify_patients/artifacts/patient_stratification.csv",
 )
-# run one of the comparisons defined in the list below
-comparison = nxfvars.get("comparison", "patient_infiltration_status")
 cpus = nxfvars.get("cpus", 32)
 
 # %%
@@ -120,7 +115,8 @@ comparisons = {
     #     "cell_type_column": "cell_type_major",
     #     "pseudobulk_group_by": ["dataset", "patient"],
     #     "column_to_test": "origin",
-    #     "lm_covariate_str": "+ patient",  # paired analysis by patient
+    #     "lm_covariate_str": "",
+    #     "absorb": ["patient"],  # paired analysis by patient
     #     "contrasts": "Treatment('normal')",
     #     "tools": ["dorothea", "progeny", "cytosig"],
     # },
@@ -194,28 +190,26 @@ comparisons = {
 
 # %% [markdown]
 # # Run differential signature analysis
+#
+# All cells are scored only once. All comparisons are run from the same score store.
 
 # %%
-comparison_config = comparisons[comparison]
-
-# %%
-datasets = compare_groups.prepare_dataset(comparison, n_jobs=cpus, **comparison_config)
-
-# %%
-results = compare_groups.compare_signatures(
-    comparison, datasets, n_jobs=cpus, **comparison_config
+cells_to_score = adata.obs_names.isin(
+    np.concatenate([c["dataset"].obs_names for c in comparisons.values()])
+)
+score_store = compare_groups.score_cells(
+    adata[cells_to_score, :],
+    tools=np.unique(np.concatenate([c["tools"] for c in comparisons.values()])),
+    n_jobs=cpus,
 )
 
 # %%
-for tool, results in results.items():
-    results.to_csv(f"{artifact_dir}/{comparison}_{tool}.tsv", sep="\t")
+score_store.write_h5ad(f"{artifact_dir}/signature_scores.h5ad")
 
 # %%
-for tool, adatas in datasets.items():
-    outdir = f"{artifact_dir}/{comparison}_{tool}"
-    os.makedirs(outdir, exist_ok=True)
-    for ct, ad in adatas.items():
-        ct = re.sub("[^a-z0-9_-]", "_", ct.lower())
-        ad.write_h5ad(f"{outdir}/{ct}.h5ad")
+results = compare_groups.run_comparisons(score_store, comparisons, n_jobs=cpus)
 
 # %%
+for comparison, results_by_tool in results.items():
+    for tool, res in results_by_tool.items():
+        res.to_csv(f"{artifact_dir}/{comparison}_{tool}.tsv", sep="\t")
@@ -27,7 +27,7 @@ from nxfvars import nxfvars
 # %%
 path_prefix = nxfvars.get(
     "path_prefix",
-    "../../data/30_downstream_analyses/plots_and_comparisons/91_compare_groups/{comparison}/artifacts",
+    "../../data/30_downstream_analyses/plots_and_comparisons/91_compare_groups/artifacts",
 )
 deseq2_path_prefix = nxfvars.get(
     "deseq2_path_prefix",
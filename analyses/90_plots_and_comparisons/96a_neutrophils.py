@@ -948,16 +948,7 @@ sc.pp.normalize_total(pb_n, target_sum=1e6)
 sc.pp.log1p(pb_n, base=2)
 
 # %%
-for ct in tqdm(pb_n.obs["cell_type"].unique()):
-    sh.signatures.fold_change(
-        pb_n, obs_col="cell_type", positive_class=ct, key_added=f"{ct}_fc"
-    )
-    sh.signatures.specific_fold_change(
-        pb_n, obs_col="cell_type", positive_class=ct, key_added=f"{ct}_sfc"
-    )
-    sh.signatures.roc_auc(
-        pb_n, obs_col="cell_type", positive_class=ct, key_added=f"{ct}_auroc"
-    )
+sh.signatures.marker_metrics(pb_n, "cell_type")
 
 # %%
 markers = {
@@ -1247,9 +1238,8 @@ fig.savefig(f"{artifact_dir}/sig_genes_by_cluster.pdf", bbox_inches="tight")
 # ### Within Neutrophil cluster
 
 # %%
-for sig, genes in neutro_sigs.items():
-    sc.tl.score_genes(pb_n, genes, score_name=sig)
-    sc.tl.score_genes(adata_n, genes, score_name=sig)
+sh.signatures.score_gene_sets(pb_n, neutro_sigs)
+sh.signatures.score_gene_sets(adata_n, neutro_sigs)
 
 # %%
 sig_keys = list(neutro_sigs.keys())
@@ -1278,9 +1268,8 @@ fig.savefig(f"{artifact_dir}/umap_signature_scores.pdf", dpi=1200, bbox_inches="
 # ## Within all cell-types
 
 # %%
-for sig, genes in tqdm(neutro_sigs.items()):
-    sc.tl.score_genes(pb_primary, genes, score_name=sig)
-    sc.tl.score_genes(adata, genes, score_name=sig)
+sh.signatures.score_gene_sets(pb_primary, neutro_sigs)
+sh.signatures.score_gene_sets(adata, neutro_sigs)
 
 # %%
 fig = sc.pl.matrixplot(
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import argparse
+from scanpy_helpers.pseudobulk import (
+    make_pseudobulk_samplesheets,
+    write_pseudobulk_samplesheets,
+)
+
+
+def main(
+    adata_in,
+    *,
+    prefix,
+    split_by,
+    replicate_col,
+    condition_col,
+    min_cells_per_sample,
+    keep_unpaired_samples,
+    out_dir=".",
+):
+    """
+    Generate pseudobulk count matrices and samplesheets for all cell-types in a single pass
+
+    Reads the anndata object in backed mode, i.e. only a chunk of the count matrix
+    is loaded into memory at a time. Writes `{prefix}_{cell_type}_counts.csv`
+    and `{prefix}_{cell_type}_samplesheet.csv` for each cell-type.
+    """
+    samplesheets = make_pseudobulk_samplesheets(
+        adata_in,
+        split_by=split_by,
+        replicate_col=replicate_col,
+        condition_col=condition_col,
+        min_cells_per_sample=min_cells_per_sample,
+        keep_unpaired_samples=keep_unpaired_samples,
+    )
+    write_pseudobulk_samplesheets(samplesheets, out_dir=out_dir, prefix=prefix)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Generate pseudobulk samples for DE analysis for all cell-types in a single pass"
+    )
+    parser.add_argument(
+        "adata_in",
+        type=str,
+        help="Anndata with raw counts in X",
+    )
+    parser.add_argument(
+        "--prefix",
+        dest="prefix",
+        type=str,
+        help="Prefix for the output files",
+        required=True,
+    )
+    parser.add_argument(
+        "--split_by",
+        dest="split_by",
+        type=str,
+        help="Key in adata.obs that contains the cell-type annotation",
+        required=True,
+    )
+    parser.add_argument(
+        "--replicate_col",
+        dest="replicate_col",
+        type=str,
+        help="Key in adata.obs that contains the biological replicate (e.g. patient)",
+        required=True,
+    )
+    parser.add_argument(
+        "--condition_col",
+        dest="condition_col",
+        type=str,
+        help="Key in adata.obs that contains the condition to compare",
+        required=True,
+    )
+    parser.add_argument(
+        "--min_cells_per_sample",
+        dest="min_cells_per_sample",
+        type=int,
+        help="Only keep samples with more than this number of cells",
+        default=10,
+    )
+    parser.add_argument(
+        "--keep_unpaired_samples",
+        dest="keep_unpaired_samples",
+        action="store_true",
+        help="Keep samples that don't have a paired case/control sample",
+    )
+    parser.add_argument(
+        "--out_dir",
+        dest="out_dir",
+        type=str,
+        help="Output directory",
+        default=".",
+    )
+    args = parser.parse_args()
+    main(
+        args.adata_in,
+        prefix=args.prefix,
+        split_by=args.split_by,
+        replicate_col=args.replicate_col,
+        condition_col=args.condition_col,
+        min_cells_per_sample=args.min_cells_per_sample,
+        keep_unpaired_samples=args.keep_unpaired_samples,
+        out_dir=args.out_dir,
+    )
@@ -4,6 +4,7 @@ import numpy as np
 import scanpy as sc
 import importlib.resources as pkg_resources
 from . import assets
+from .signatures import score_gene_sets
 from tqdm import tqdm
 from scanpy import logging
 import matplotlib.pyplot as plt
@@ -90,11 +91,23 @@ class AnnotationHelper:
         prefix="ct_",
         **kwargs,
     ):
+        """Score each cell-type's markers and store them in `adata.obs[prefix + cell_type]`.
+
+        Kwargs are passed to :func:`scanpy_helpers.signatures.score_gene_sets`, which scores all
+        cell-types at once. If other parameters of `sc.tl.score_genes` are specified
+        (e.g. `gene_pool`, `layer`, `copy`), each cell-type is scored with `sc.tl.score_genes` instead.
+        """
         tmp_markers = self.get_markers(filter_cell_type)
-        for ct, group in tqdm(tmp_markers.groupby("cell_type")):
-            var_names = adata.var_names if adata.raw is None else adata.raw.var_names
-            genes = list(set(var_names) & set(group["gene_identifier"].values))
-            sc.tl.score_genes(adata, genes, score_name=prefix + ct, **kwargs)
+        var_names = adata.var_names if adata.raw is None else adata.raw.var_names
+        gene_sets = {
+            prefix + ct: list(set(var_names) & set(group["gene_identifier"].values))
+            for ct, group in tmp_markers.groupby("cell_type")
+        }
+        if set(kwargs) <= {"ctrl_size", "n_bins", "random_state", "use_raw"}:
+            score_gene_sets(adata, gene_sets, **kwargs)
+        else:
+            for score_name, genes in tqdm(gene_sets.items()):
+                sc.tl.score_genes(adata, genes, score_name=score_name, **kwargs)
 
     def plot_dotplot_scores(
         self,
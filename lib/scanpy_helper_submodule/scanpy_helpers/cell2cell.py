@@ -2,7 +2,8 @@
 
 Focuses on differential cellphonedb analysis between conditions.
 """
-from typing import List, Literal
+
+from typing import List, Literal, Mapping, Sequence, Union
 import pandas as pd
 from .pseudobulk import pseudobulk
 import numpy as np
@@ -38,25 +39,27 @@ class CpdbAnalysis:
         self.cpdb = cpdb
         self.cell_type_column = cell_type_column
         self._find_expressed_genes(adata, pseudobulk_group_by)
+        self._build_interaction_index()
 
     def _find_expressed_genes(self, adata, pseudobulk_group_by):
         """Compute the mean expression and fraction of expressed cells per cell-type.
         This is performed on the pseudobulk level, i..e. the mean of means per patient is calculated.
+
+        Results are stored as wide cell-type x gene data frames in `fraction_expressed` and `expr_mean`.
         """
-        pb_fracs = pseudobulk(
+        pb = pseudobulk(
             adata,
             groupby=pseudobulk_group_by + [self.cell_type_column],
-            aggr_fun=lambda x, axis: np.sum(x > 0, axis) / x.shape[axis],  # type: ignore
+            stats=["sum", "fraction_expressed"],
         )
         fractions_expressed = pseudobulk(
-            pb_fracs, groupby=self.cell_type_column, aggr_fun=np.mean
+            pb,
+            groupby=self.cell_type_column,
+            aggr_fun=np.mean,
+            layer="fraction_expressed",
         )
         fractions_expressed.obs.set_index(self.cell_type_column, inplace=True)
 
-        pb = pseudobulk(
-            adata,
-            groupby=pseudobulk_group_by + [self.cell_type_column],
-        )
         sc.pp.normalize_total(pb, target_sum=1e6)
         sc.pp.log1p(pb)
         pb_mean_cell_type = pseudobulk(
@@ -64,18 +67,75 @@ class CpdbAnalysis:
         )
         pb_mean_cell_type.obs.set_index(self.cell_type_column, inplace=True)
 
-        self.expressed_genes = (
-            fractions_expressed.to_df()
-            .melt(ignore_index=False, value_name="fraction_expressed")
+        self.fraction_expressed = fractions_expressed.to_df()
+        self.expr_mean = pb_mean_cell_type.to_df().loc[
+            self.fraction_expressed.index, self.fraction_expressed.columns
+        ]
+
+    def _build_interaction_index(self):
+        """Index the cellphonedb interactions by ligand and receptor.
+
+        For both gene symbol columns, store a mapping gene -> row positions in `cpdb` and
+        the position of each interaction partner in the columns of the expression matrices
+        (-1 if the gene is not measured).
+        """
+        genes = self.fraction_expressed.columns
+        self._interactions_by_gene = {}
+        self._gene_pos = {}
+        for col in ["source_genesymbol", "target_genesymbol"]:
+            self._interactions_by_gene[col] = (
+                self.cpdb.reset_index(drop=True).groupby(col, sort=False).indices
+            )
+            self._gene_pos[col] = genes.get_indexer(self.cpdb[col])
+
+    @property
+    def expressed_genes(self) -> pd.DataFrame:
+        """Fraction of expressing cells and mean expression in long format (one row per cell-type and gene)"""
+        return (
+            self.fraction_expressed.melt(
+                ignore_index=False, value_name="fraction_expressed"
+            )
             .reset_index()
             .merge(
-                pb_mean_cell_type.to_df()
-                .melt(ignore_index=False, value_name="expr_mean")
-                .reset_index(),
+                self.expr_mean.melt(
+                    ignore_index=False, value_name="expr_mean"
+                ).reset_index(),
                 on=[self.cell_type_column, "variable"],
             )
         )
 
+    def _expressed_interactions(
+        self, genes, *, cpdb_de_col, cpdb_expr_col, min_frac_expressed
+    ) -> pd.DataFrame:
+        """All interactions of `genes` (in `cpdb_de_col`) combined with each cell-type that expresses
+        the interaction partner (in `cpdb_expr_col`) in at least `min_frac_expressed` cells.
+        """
+        index = self._interactions_by_gene[cpdb_de_col]
+        rows = [index[g] for g in genes if g in index]
+        rows = np.concatenate(rows) if rows else np.array([], dtype=np.intp)
+        gene_pos = self._gene_pos[cpdb_expr_col][rows]
+        rows, gene_pos = rows[gene_pos >= 0], gene_pos[gene_pos >= 0]
+
+        fraction_expressed = self.fraction_expressed.values[:, gene_pos]
+        ct_idx, j = np.nonzero(fraction_expressed >= min_frac_expressed)
+        # order by gene, cell-type and interaction, as a merge on the long table would
+        order = np.lexsort((rows[j], ct_idx, gene_pos[j]))
+        ct_idx, j = ct_idx[order], j[order]
+
+        return pd.concat(
+            [
+                pd.DataFrame(
+                    {
+                        self.cell_type_column: self.fraction_expressed.index[ct_idx],
+                        "fraction_expressed": fraction_expressed[ct_idx, j],
+                        "expr_mean": self.expr_mean.values[ct_idx, gene_pos[j]],
+                    }
+                ),
+                self.cpdb.iloc[rows[j]].reset_index(drop=True),
+            ],
+            axis=1,
+        )
+
     def significant_interactions(
         self,
         de_res: pd.DataFrame,
@@ -131,26 +191,60 @@ class CpdbAnalysis:
             lambda x: (x[pvalue_col] < max_pvalue) & (np.abs(x[fc_col]) >= min_abs_fc),
             gene_symbol_col,
         ].unique()  # type: ignore
-        significant_interactions = self.cpdb.loc[
-            lambda x: x[cpdb_de_col].isin(significant_genes)
-        ]
 
         res_df = (
-            self.expressed_genes.loc[
-                lambda x: x["fraction_expressed"] >= min_frac_expressed
-            ]  # type: ignore
-            .merge(
-                significant_interactions,
-                left_on="variable",
-                right_on=cpdb_expr_col,
+            self._expressed_interactions(
+                significant_genes,
+                cpdb_de_col=cpdb_de_col,
+                cpdb_expr_col=cpdb_expr_col,
+                min_frac_expressed=min_frac_expressed,
             )
-            .drop(columns=["variable"])
             .merge(de_res, left_on=cpdb_de_col, right_on=gene_symbol_col)
             .drop(columns=[gene_symbol_col])
         )
 
         return res_df
 
+    def significant_interactions_batch(
+        self,
+        de_results: Union[Mapping[str, pd.DataFrame], Sequence[pd.DataFrame]],
+        *,
+        key_added: str = "comparison",
+        **kwargs,
+    ) -> pd.DataFrame:
+        """
+        Run :meth:`significant_interactions` on multiple lists of differentially expressed genes.
+
+        Parameters
+        ----------
+        de_results
+            Mapping from a name to a data frame with differentially expressed genes, or a list of such
+            data frames (which are then named by their position).
+        key_added
+            Name of the column that identifies the DE table each interaction was derived from. It is added
+            as the first column of the result.
+        **kwargs
+            Passed to :meth:`significant_interactions`. The FDR is adjusted for each table separately.
+
+        Returns
+        -------
+        The concatenated results of all tables.
+        """
+        if not isinstance(de_results, Mapping):
+            de_results = dict(enumerate(de_results))
+        if not len(de_results):
+            raise ValueError("No DE results provided!")
+
+        res = {
+            key: self.significant_interactions(de_res, **kwargs)
+            for key, de_res in de_results.items()
+        }
+        return (
+            pd.concat(res, names=[key_added])
+            .reset_index(level=0)
+            .reset_index(drop=True)
+        )
+
     def plot_result(
         self,
         cpdb_res,
@@ -4,7 +4,7 @@ This module contains high-level abstractions to linear models
 and functions to compare scores with different methods
 """
 
-from typing import List, Mapping, Optional, Sequence
+from typing import Dict, List, Mapping, Optional, Sequence, Union
 from . import lm
 from . import pl
 from . import compute_scores
@@ -12,7 +12,18 @@ import numpy as np
 import pandas as pd
 from tqdm.contrib.concurrent import process_map
 import itertools
-from ..util import split_anndata, fdr_correction, log2_fc
+import hashlib
+from ..util import fdr_correction, log2_fc, shared_arrays, attach_shared_arrays
+from ..pseudobulk import (
+    _resolve_view,
+    _group_codes,
+    _first_occurrence,
+    _iter_row_chunks,
+    _get_matrix,
+    _GroupAccumulator,
+    _make_pseudobulk_adata,
+)
+import scipy.sparse
 from anndata import AnnData
 
 TOOLS = {
@@ -22,15 +33,57 @@ TOOLS = {
 }
 
 
-def _run_tool(adata, tools):
-    """Run a certain tool on an anndata object.
+def _run_tool_shared(
+    rows, obs, X_specs, var_names, tools, network_dir=None, scale=True
+):
+    """Run the tools on a subset of rows of a CSR matrix in shared memory.
 
-    Helper function executed in parallel on a chunked anndata object.
+    Helper function executed in parallel. Only the rows of the current cell-type are copied
+    from shared memory.
     """
-    res = {}
-    for tool in tools:
-        res[tool] = TOOLS[tool](adata)
-    return res
+    with attach_shared_arrays(X_specs) as arrays:
+        indptr = arrays["indptr"]
+        starts, stops = indptr[rows], indptr[rows + 1]
+        lengths = stops - starts
+        # positions of the non-zero elements of all selected rows in `data` and `indices`
+        idx = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(
+            np.sum(lengths)
+        )
+        X = scipy.sparse.csr_matrix(
+            (
+                arrays["data"][idx],
+                arrays["indices"][idx],
+                np.concatenate([[0], np.cumsum(lengths)]),
+            ),
+            shape=(len(rows), len(var_names)),
+        )
+        del indptr
+    adata = AnnData(X=X, obs=obs, var=pd.DataFrame(index=var_names))
+    return compute_scores.run_tools(
+        adata, tools, network_dir=network_dir, use_raw=False, scale=scale
+    )
+
+
+def _raw_csr_rows(parent: AnnData, rows: np.ndarray):
+    """Get the rows of `parent.raw.X` that are processed as a CSR matrix to place in shared memory.
+
+    If all rows of a CSR matrix are needed, its buffers are used as they are. Otherwise only
+    the needed rows are copied. Returns the CSR matrix and the position of each of `rows` in it.
+    """
+    if parent.isbacked:
+        raise ValueError(
+            "Backed AnnData objects are not supported. Load the data into memory "
+            "or use `compute_scores.score_h5ad`."
+        )
+    X = parent.raw.X
+    if (
+        scipy.sparse.issparse(X)
+        and X.format == "csr"
+        and np.array_equal(rows, np.arange(X.shape[0]))
+    ):
+        return X, rows
+    needed, positions = np.unique(rows, return_inverse=True)
+    return scipy.sparse.csr_matrix(X[needed]), positions
 
 
 def prepare_dataset(
@@ -41,6 +94,7 @@ def prepare_dataset(
     tools: Sequence[str] = ("progeny", "cytosig"),
     column_to_test: str,
     n_jobs: int = 1,
+    network_dir: Optional[str] = None,
     **kwargs,
 ) -> Mapping[str, Mapping[str, AnnData]]:
     """Split anndata by cell-type and run the different signature enrichment methods
@@ -59,6 +113,10 @@ def prepare_dataset(
         Column containing the dependent variable
     n_jobs
         Number of worker threads to use. Parallelizes by cell-type.
+    network_dir
+        Directory with networks compiled by :func:`compute_scores.compile_networks`.
+        Compiled networks are memory-mapped and shared between workers. If None, each worker
+        loads the networks through the corresponding packages.
     **kwargs
         Not used, but allows to pass parameters via a config dictionary that contains additional parameters
 
@@ -71,30 +129,43 @@ def prepare_dataset(
     tools = [t for t in tools if t in TOOLS]
 
     print(f"Preparing dataset for {id_}:")
-    dataset = dataset[
+    # Don't split the (potentially large) expression matrix by cell-type. Workers only receive
+    # the row indices of each cell-type and read them from a CSR matrix in shared memory.
+    parent, rows, _ = _resolve_view(dataset)
+    rows = np.arange(parent.n_obs) if rows is None else rows
+    mask = (
         (dataset.obs[cell_type_column] != "other")
         & ~pd.isnull(dataset.obs[column_to_test])
-        & (dataset.obs[column_to_test] != "nan"),
-        :,
-    ].copy()
+        & (dataset.obs[column_to_test] != "nan")
+    ).values
+    obs = dataset.obs.loc[mask].copy()
+    rows = rows[mask]
 
-    dataset.obs[column_to_test] = pd.Categorical(
-        dataset.obs[column_to_test].astype(str)
-    )
+    obs[column_to_test] = pd.Categorical(obs[column_to_test].astype(str))
 
     print(f"\tSplitting anndata by {cell_type_column}:")
-    adata_by_cell_type = split_anndata(dataset, cell_type_column)
-    res_by_cell_type = process_map(
-        _run_tool,
-        adata_by_cell_type.values(),
-        itertools.repeat(tools),
-        max_workers=n_jobs,
-    )
+    codes, cell_types = pd.factorize(obs[cell_type_column])
+    # only the rows of the cells to test are placed in shared memory
+    X, rows = _raw_csr_rows(parent, rows)
+    with shared_arrays(
+        {"data": X.data, "indices": X.indices, "indptr": X.indptr}
+    ) as X_specs:
+        res_by_cell_type = process_map(
+            _run_tool_shared,
+            [rows[codes == i] for i in range(len(cell_types))],
+            [obs.loc[codes == i] for i in range(len(cell_types))],
+            itertools.repeat(X_specs),
+            itertools.repeat(parent.raw.var_names),
+            itertools.repeat(tools),
+            itertools.repeat(network_dir),
+            max_workers=n_jobs,
+        )
+    adata_by_cell_type = dict(zip(cell_types, res_by_cell_type))
 
     all_adatas = {}
     for tool in tools:
         all_adatas[tool] = {}
-        for ct, tmp_res in zip(adata_by_cell_type, res_by_cell_type):
+        for ct, tmp_res in adata_by_cell_type.items():
             all_adatas[tool][ct] = tmp_res[tool]
 
     return all_adatas
@@ -108,6 +179,7 @@ def compare_signatures(
     column_to_test: str,
     lm_covariate_str: str,
     contrasts: str,
+    absorb: Sequence[str] = (),
     n_jobs: int = 1,
     **kwargs,
 ) -> Mapping[str, pd.DataFrame]:
@@ -128,6 +200,12 @@ def compare_signatures(
     contrasts
         a patsy contrast included in to linear model formula. May be `Sum`, `Treatment`, or `Treatment('<base level>')`.
         See https://www.statsmodels.org/devel/contrasts.html for more details.
+    absorb
+        Categorical nuisance factors that are absorbed instead of being included in the formula,
+        e.g. `["patient"]` for a paired analysis. Must be included in `pseudobulk_group_by`.
+        See :func:`scanpy_helpers.compare_groups.lm.test_lm`.
+    n_jobs
+        Number of worker processes. All combinations of tool and cell-type are processed in parallel.
     **kwargs
         Not used, but allows to pass parameters via a config dictionary that contains additional parameters
 
@@ -136,17 +214,260 @@ def compare_signatures(
     A dictionary [tool : results data frame]
     """
     print(f"Performing comparison for {id_}:")
+    # flatten all (tool, cell-type) combinations into a single list of tasks
+    # such that they can be processed in parallel.
+    task_keys = [(tool, ct) for tool in all_adatas for ct in all_adatas[tool]]
+    res_list = lm._run_lm_tasks(
+        [(ct, all_adatas[tool][ct]) for tool, ct in task_keys],
+        n_jobs=n_jobs,
+        groupby=pseudobulk_group_by,
+        column_to_test=column_to_test,
+        lm_covariate_str=lm_covariate_str,
+        contrasts=contrasts,
+        min_categories=2,
+        absorb=absorb,
+    )
+
     all_results = {}
     for tool in all_adatas:
-        print(f"\tRunning tests for {tool}:")
-        tmp_res = lm.lm_test_all(
-            all_adatas[tool],
-            groupby=pseudobulk_group_by,
-            column_to_test=column_to_test,
-            lm_covariate_str=lm_covariate_str,
-            contrasts=contrasts,
+        all_results[tool] = lm._combine_lm_results(
+            [res for (t, _), res in zip(task_keys, res_list) if t == tool]
+        )
+
+    return all_results
+
+
+def score_cells(
+    dataset: AnnData,
+    *,
+    tools: Sequence[str] = ("progeny", "dorothea", "cytosig"),
+    n_jobs: int = 1,
+    network_dir: Optional[str] = None,
+) -> AnnData:
+    """Score all cells once with all tools into a score store.
+
+    The scores are not scaled, such that the score of a cell does not depend on the other
+    cells in the dataset. The store can therefore be reused by all comparisons on (subsets of)
+    `dataset` with :func:`run_comparisons`, which applies the scaling per cell-type and comparison.
+
+    Parameters
+    ----------
+    dataset
+        anndata object with the lognorm gene expression in `.raw`. Must not be backed. For views,
+        only the rows in the view are copied.
+    tools
+        tools to run. Supported are `dorothea`, `progeny`, `cytosig`
+    n_jobs
+        Number of worker processes. Parallelizes by blocks of cells.
+    network_dir
+        Directory with compiled networks, see :func:`prepare_dataset`.
+
+    Returns
+    -------
+    AnnData object with the same obs as `dataset` and the scores of all tools in `X`.
+    `.var` contains the `tool` and `source` of each score.
+    """
+    tools = [t for t in tools if t in TOOLS]
+    parent, rows, _ = _resolve_view(dataset)
+    rows = np.arange(parent.n_obs) if rows is None else rows
+    blocks = [b for b in np.array_split(np.arange(rows.size), n_jobs) if b.size]
+
+    print("Scoring cells:")
+    X, rows = _raw_csr_rows(parent, rows)
+    with shared_arrays(
+        {"data": X.data, "indices": X.indices, "indptr": X.indptr}
+    ) as X_specs:
+        res_by_block = process_map(
+            _run_tool_shared,
+            [rows[b] for b in blocks],
+            [pd.DataFrame(index=dataset.obs_names[b]) for b in blocks],
+            itertools.repeat(X_specs),
+            itertools.repeat(parent.raw.var_names),
+            itertools.repeat(tools),
+            itertools.repeat(network_dir),
+            itertools.repeat(False),
+            max_workers=n_jobs,
+        )
+
+    sources = {tool: res_by_block[0][tool].var_names for tool in tools}
+    var = pd.DataFrame(
+        {
+            "tool": np.repeat(tools, [len(sources[t]) for t in tools]),
+            "source": np.concatenate([sources[t] for t in tools]),
+        }
+    )
+    var.index = var["tool"] + ":" + var["source"]
+    return AnnData(
+        X=np.vstack(
+            [np.hstack([res[tool].X for tool in tools]) for res in res_by_block]
+        ),
+        obs=dataset.obs.copy(),
+        var=var,
+    )
+
+
+def _pseudobulk_scores(
+    score_store: AnnData,
+    obs: pd.DataFrame,
+    *,
+    cell_type_column: str,
+    groupby: List[str],
+    chunk_size: int = 50000,
+    min_obs: int = 10,
+):
+    """
+    Pseudobulk (mean) the unscaled scores of the cells in `obs` by cell-type and `groupby`.
+
+    In the same pass, compute mean and standard deviation (`ddof=1`) of the scores of each
+    cell-type (including cells that are missing a value in `groupby`).
+
+    Returns
+    -------
+    pseudobulk
+        AnnData object with all groups
+    cell_types
+        Index of cell-types
+    ct_mean, ct_std
+        cell-types x scores arrays
+    """
+    rows = score_store.obs_names.get_indexer(obs.index)
+    if np.any(rows < 0):
+        raise ValueError("Not all cells of the comparison are in the score store.")
+    groupby = list(dict.fromkeys([cell_type_column] + groupby))
+    ct_codes, cell_types = pd.factorize(obs[cell_type_column])
+    cell_types = pd.Index(cell_types)
+    codes, n_groups = _group_codes(obs, groupby)
+
+    ct_acc = _GroupAccumulator(len(cell_types), ["var"])
+    group_acc = _GroupAccumulator(n_groups, ["mean"])
+    parent, parent_rows, _ = _resolve_view(score_store)
+    if parent_rows is not None:
+        rows = parent_rows[rows]
+    for positions, X_chunk in _iter_row_chunks(_get_matrix(parent), chunk_size, rows):
+        X_chunk = np.asarray(X_chunk, dtype=np.float64)
+        ct_acc.update(X_chunk, ct_codes[positions])
+        group_acc.update(X_chunk, codes[positions])
+
+    n_ct = ct_acc.n_obs[:, np.newaxis]
+    ct_mean = ct_acc.moments["sum"] / n_ct
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ct_std = np.sqrt(
+            np.clip(ct_acc.moments["sumsq"] - n_ct * ct_mean**2, 0, None) / (n_ct - 1)
+        )
+    pb = _make_pseudobulk_adata(
+        obs.iloc[_first_occurrence(codes, n_groups)],
+        groupby,
+        group_acc.n_obs,
+        group_acc.finalize()["mean"],
+        {},
+        score_store.var,
+        min_obs,
+    )
+    return pb, cell_types, ct_mean, ct_std
+
+
+def run_comparisons(
+    score_store: AnnData,
+    comparisons: Mapping[str, Mapping],
+    *,
+    n_jobs: int = 1,
+) -> Dict[str, Dict[str, pd.DataFrame]]:
+    """
+    Run multiple comparisons from a single score store.
+
+    Gives the same results as running :func:`prepare_dataset` and :func:`compare_signatures`
+    for each comparison, but cells are only scored once (:func:`score_cells`), and the
+    concatenated scores of all tools are pseudobulked only once per grouping. Scaling the scores
+    of a cell-type commutes with taking the mean per group, therefore it is applied to the
+    pseudobulk instead of the cells.
+
+    Parameters
+    ----------
+    score_store
+        Unscaled scores as generated by :func:`score_cells`. May be opened in backed mode.
+    comparisons
+        Dictionary comparison id -> config. The config contains the parameters of
+        :func:`prepare_dataset` and :func:`compare_signatures`. Instead of an AnnData
+        object, `dataset` may be a data frame with the `obs` of the cells to compare.
+        The cells are matched to the store by their `obs_names`.
+    n_jobs
+        Number of worker processes. The cell-types of a comparison are processed in parallel.
+
+    Returns
+    -------
+    Dictionary [comparison : (Dictionary [tool : results data frame])]
+    """
+    pseudobulks = {}
+    all_results = {}
+    for id_, config in comparisons.items():
+        dataset = config["dataset"]
+        obs = dataset.obs if isinstance(dataset, AnnData) else dataset
+        cell_type_column = config["cell_type_column"]
+        column_to_test = config["column_to_test"]
+        groupby = list(config["pseudobulk_group_by"]) + [column_to_test]
+        tools = [t for t in config.get("tools", ("progeny", "cytosig")) if t in TOOLS]
+
+        print(f"Performing comparison for {id_}:")
+        obs = obs.loc[
+            (obs[cell_type_column] != "other")
+            & ~pd.isnull(obs[column_to_test])
+            & (obs[column_to_test] != "nan")
+        ].copy()
+        obs[column_to_test] = pd.Categorical(obs[column_to_test].astype(str))
+
+        key = (
+            hashlib.sha1(
+                pd.util.hash_pandas_object(
+                    obs.loc[:, groupby + [cell_type_column]]
+                ).values.tobytes()
+            ).hexdigest(),
+            cell_type_column,
+            tuple(groupby),
+        )
+        if key not in pseudobulks:
+            pseudobulks[key] = _pseudobulk_scores(
+                score_store, obs, cell_type_column=cell_type_column, groupby=groupby
+            )
+        pb, cell_types, ct_mean, ct_std = pseudobulks[key]
+
+        var_mask = score_store.var["tool"].isin(tools).values
+        ct_idx = cell_types.get_indexer(pb.obs[cell_type_column])
+        # scores that are constant within a cell-type are set to zero
+        X = (pb.X - ct_mean[ct_idx]) / compute_scores._scale_std(ct_mean, ct_std)[
+            ct_idx
+        ]
+        bdatas = {}
+        for i, ct in enumerate(cell_types):
+            mask = ct_idx == i
+            obs_ct = pb.obs.loc[mask, groupby + ["n_obs"]].reset_index(drop=True)
+            obs_ct.index = obs_ct.index.astype(str)
+            bdatas[ct] = AnnData(
+                X=X[np.ix_(mask, var_mask)],
+                obs=obs_ct,
+                var=score_store.var.loc[var_mask],
+            )
+
+        res_list = lm._run_lm_tasks(
+            list(bdatas.items()),
             n_jobs=n_jobs,
+            groupby=None,
+            column_to_test=column_to_test,
+            lm_covariate_str=config["lm_covariate_str"],
+            contrasts=config["contrasts"],
+            min_categories=2,
+            absorb=config.get("absorb", ()),
         )
-        all_results[tool] = tmp_res
+        res_list = [res for res in res_list if res is not None]
+        all_results[id_] = {}
+        for tool in tools:
+            tool_vars = score_store.var.loc[score_store.var["tool"] == tool, "source"]
+            all_results[id_][tool] = lm._combine_lm_results(
+                [
+                    res.loc[res["variable"].isin(tool_vars.index)].assign(
+                        variable=lambda x: tool_vars.loc[x["variable"]].values
+                    )
+                    for res in res_list
+                ]
+            )
 
     return all_results
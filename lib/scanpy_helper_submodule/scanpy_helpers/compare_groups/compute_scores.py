@@ -1,11 +1,29 @@
 """Run dorothea, progeny and cytosig with parameters suitable for between-sample comparisons.
 
 In particular, permutation tests are not necessary, as we perform statistics on the sample-level.
+
+All networks are scored with a built-in implementation of the algorithm used by
+progeny-py and dorothea-py (a weighted sum of the centered gene expression).
+Multiple networks are scored in a single sparse matrix product.
+
+Loading the networks through their packages takes several seconds. They can be compiled
+once into a binary format with :func:`compile_networks`. Compiled networks are memory-mapped,
+such that all worker processes share the same copy.
+
+To score all cells of a large dataset (e.g. for plotting), use :func:`score_h5ad`, which
+streams the expression matrix from a h5ad file and writes the scores into `.obsm` on disk.
 """
 
 from functools import lru_cache
-from ..util import suppress_stdout
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple, Union
+from collections import OrderedDict
+from pathlib import Path
+import hashlib
+import json
 import pandas as pd
+import numpy as np
+import scipy.sparse
+from anndata import AnnData
 from .. import assets
 import importlib.resources as pkg_resources
 
@@ -42,62 +60,591 @@ def _cytosig_model():
     )
 
 
-@suppress_stdout
-def run_progeny(adata):
-    import progeny
+_MODELS = {
+    "progeny": _progeny_model,
+    "dorothea": _dorothea_model,
+    "cytosig": _cytosig_model,
+}
 
-    tmp_adata = adata.copy()
 
-    progeny.run(
-        tmp_adata,  # Data to use
-        _progeny_model(),  # PROGENy network
-        center=True,  # Center gene expression by mean per cell
-        num_perm=0,  # Simulate m random activities
-        norm=True,  # Normalize by number of edges to correct for large regulons
-        scale=True,  # Scale values per feature so that values can be compared across cells
-        use_raw=True,  # Use raw adata, where we have the lognorm gene expression
-        min_size=5,  # Pathways with less than 5 targets will be ignored
+class Network:
+    """
+    Weights of sources (pathways, TFs, cytokines) on their target genes.
+
+    Parameters
+    ----------
+    weights
+        sparse weight matrix (genes x sources)
+    genes
+        gene symbols
+    sources
+        names of the sources
+    key
+        unique identifier of the network, used to cache the alignment to the genes of a dataset
+    """
+
+    def __init__(
+        self,
+        weights: scipy.sparse.csr_matrix,
+        genes: pd.Index,
+        sources: pd.Index,
+        *,
+        key: str,
+    ):
+        self.weights = weights
+        self.genes = pd.Index(genes)
+        self.sources = pd.Index(sources)
+        self.key = key
+
+    @classmethod
+    def from_dataframe(cls, network: pd.DataFrame) -> "Network":
+        """Create a network from a data frame with genes in rows and sources in columns"""
+        network = network.fillna(0)
+        weights = scipy.sparse.csr_matrix(network.values.astype(np.float64))
+        key = hashlib.sha1(
+            pd.util.hash_pandas_object(network, index=True).values.tobytes()
+            + "\0".join(map(str, network.columns)).encode()
+        ).hexdigest()
+        return cls(weights, network.index, network.columns, key=key)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame(
+            self.weights.toarray(), index=self.genes, columns=self.sources
+        )
+
+    def save(self, path: Union[str, Path]) -> None:
+        """Save the network as CSR arrays in `.npy` format that can be memory-mapped"""
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        weights = self.weights.tocsr()
+        weights.eliminate_zeros()
+        weights.sort_indices()
+        for name in ["data", "indices", "indptr"]:
+            np.save(path / f"{name}.npy", getattr(weights, name))
+        with open(path / "index.json", "w") as f:
+            json.dump(
+                {
+                    "genes": self.genes.astype(str).tolist(),
+                    "sources": self.sources.astype(str).tolist(),
+                    "key": self.key,
+                },
+                f,
+            )
+
+    @classmethod
+    def load(cls, path: Union[str, Path], *, mmap: bool = True) -> "Network":
+        """Load a network saved with :meth:`save`. The weights are memory-mapped by default."""
+        path = Path(path)
+        arrays = [
+            np.load(path / f"{name}.npy", mmap_mode="r" if mmap else None)
+            for name in ["data", "indices", "indptr"]
+        ]
+        with open(path / "index.json") as f:
+            index = json.load(f)
+        weights = scipy.sparse.csr_matrix(
+            tuple(arrays),
+            shape=(len(index["genes"]), len(index["sources"])),
+            copy=False,
+        )
+        return cls(weights, index["genes"], index["sources"], key=index["key"])
+
+
+def compile_networks(
+    out_dir: Union[str, Path], tools: Sequence[str] = ("progeny", "dorothea", "cytosig")
+) -> None:
+    """
+    Compile the networks of the given tools into a binary format.
+
+    Creates one directory per tool in `out_dir`. Pass `out_dir` as `network_dir` to
+    :func:`run_tools` (or :func:`scanpy_helpers.compare_groups.prepare_dataset`) to use the
+    compiled networks.
+    """
+    for tool in tools:
+        Network.from_dataframe(_MODELS[tool]()).save(Path(out_dir) / tool)
+
+
+@lru_cache
+def _load_compiled_network(path: str) -> Network:
+    return Network.load(path)
+
+
+def load_network(tool: str, network_dir: Optional[Union[str, Path]] = None) -> Network:
+    """
+    Load the network of a tool.
+
+    Parameters
+    ----------
+    tool
+        One of `dorothea`, `progeny`, `cytosig`
+    network_dir
+        Directory with networks compiled by :func:`compile_networks`. If None, load the network
+        through the corresponding package.
+    """
+    if network_dir is None:
+        return _network_from_model(tool)
+    return _load_compiled_network(str(Path(network_dir).resolve() / tool))
+
+
+@lru_cache
+def _network_from_model(tool: str) -> Network:
+    return Network.from_dataframe(_MODELS[tool]())
+
+
+_ALIGNMENT_CACHE: (
+    "OrderedDict[str, Tuple[scipy.sparse.csc_matrix, pd.Index, np.ndarray]]"
+) = OrderedDict()
+_ALIGNMENT_CACHE_SIZE = 32
+
+
+def _network_weights(
+    network: Network, var_names: pd.Index, *, min_size: int, norm: bool
+) -> Tuple[scipy.sparse.csc_matrix, pd.Index, np.ndarray]:
+    """
+    Turn a network into a sparse weight matrix aligned to `var_names`.
+
+    The result is cached for each combination of network, `var_names` and parameters.
+
+    Parameters
+    ----------
+    network
+        network of sources (pathways, TFs, cytokines) and target genes
+    var_names
+        genes of the expression matrix
+    min_size
+        sources with less than `min_size` targets in `var_names` are removed
+    norm
+        If True, normalize the weights of each source by the sum of absolute weights.
+
+    Returns
+    -------
+    weights
+        sparse weight matrix (n_vars x n_sources)
+    sources
+        names of the sources that were kept
+    shared
+        boolean mask of genes in `var_names` that are part of the network
+    """
+    key = hashlib.sha1(
+        "\0".join(
+            [network.key, str(min_size), str(norm)] + var_names.astype(str).tolist()
+        ).encode()
+    ).hexdigest()
+    try:
+        res = _ALIGNMENT_CACHE.pop(key)
+    except KeyError:
+        res = _align_network(network, var_names, min_size=min_size, norm=norm)
+    _ALIGNMENT_CACHE[key] = res
+    while len(_ALIGNMENT_CACHE) > _ALIGNMENT_CACHE_SIZE:
+        _ALIGNMENT_CACHE.popitem(last=False)
+    return res
+
+
+def _align_network(
+    network: Network, var_names: pd.Index, *, min_size: int, norm: bool
+) -> Tuple[scipy.sparse.csc_matrix, pd.Index, np.ndarray]:
+    """Uncached version of :func:`_network_weights`"""
+    gene_idx = var_names.get_indexer(network.genes)
+    is_shared = gene_idx >= 0
+    gene_idx = gene_idx[is_shared]
+    weights = scipy.sparse.csc_matrix(network.weights[is_shared, :])
+    weights.eliminate_zeros()
+    keep_sources = np.diff(weights.indptr) >= min_size
+    weights = weights[:, keep_sources]
+    if norm:
+        norm_factor = np.asarray(abs(weights).sum(axis=0)).ravel()
+        norm_factor[norm_factor == 0] = 1
+        weights = weights @ scipy.sparse.diags(1 / norm_factor)
+
+    shared = np.zeros(len(var_names), dtype=bool)
+    shared[gene_idx] = True
+    weights = weights.tocoo()
+    weights = scipy.sparse.csc_matrix(
+        (weights.data, (gene_idx[weights.row], weights.col)),
+        shape=(len(var_names), weights.shape[1]),
     )
-    return progeny.extract(tmp_adata)
+    return weights, network.sources[keep_sources], shared
 
 
-@suppress_stdout
-def run_dorothea(adata):
-    import dorothea
+def _combined_weights(
+    networks: Mapping[str, Union[Network, pd.DataFrame]],
+    var_names: pd.Index,
+    *,
+    min_size: int,
+    norm: bool,
+) -> Tuple[scipy.sparse.csr_matrix, np.ndarray, np.ndarray, List[pd.Index]]:
+    """
+    Combine multiple networks into a single sparse weight matrix aligned to `var_names`.
+
+    Returns
+    -------
+    W
+        weight matrix (n_vars x (n_sources + n_networks)). The last columns compute the mean
+        expression of the genes of each network (for centering) within the same matrix product.
+    network_idx
+        index of the network of each source
+    weight_sums
+        sum of the weights of each source
+    sources
+        list with the names of the sources of each network
+    """
+    weights, sources, shared = [], [], []
+    for network in networks.values():
+        if isinstance(network, pd.DataFrame):
+            network = Network.from_dataframe(network)
+        tmp_weights, tmp_sources, tmp_shared = _network_weights(
+            network, var_names, min_size=min_size, norm=norm
+        )
+        weights.append(tmp_weights)
+        sources.append(tmp_sources)
+        shared.append(tmp_shared)
+    n_sources = np.array([len(s) for s in sources], dtype=np.int64)
+    W = scipy.sparse.hstack(
+        weights
+        + [
+            scipy.sparse.csc_matrix(
+                tmp_shared[:, np.newaxis] / max(tmp_shared.sum(), 1)
+            )
+            for tmp_shared in shared
+        ]
+    ).tocsr()
+    network_idx = np.repeat(np.arange(len(sources)), n_sources)
+    weight_sums = np.asarray(W[:, : network_idx.size].sum(axis=0)).ravel()
+    return W, network_idx, weight_sums, sources
+
+
+def _score_chunk(
+    chunk,
+    W: scipy.sparse.csr_matrix,
+    network_idx: np.ndarray,
+    weight_sums: np.ndarray,
+    *,
+    center: bool,
+) -> np.ndarray:
+    """Unscaled scores of a chunk of cells with weights from :func:`_combined_weights`"""
+    scores = chunk @ W
+    scores = scores.toarray() if scipy.sparse.issparse(scores) else np.asarray(scores)
+    n_sources = network_idx.size
+    if center:
+        # (x - mean(x)) @ w = x @ w - mean(x) * sum(w)
+        means = scores[:, n_sources:]
+        return scores[:, :n_sources] - means[:, network_idx] * weight_sums
+    return scores[:, :n_sources]
 
-    tmp_adata = adata.copy()
-    dorothea.run(
-        tmp_adata,  # Data to use
-        _dorothea_model(),  # Dorothea network
+
+def _scale_std(mean: np.ndarray, std: np.ndarray) -> np.ndarray:
+    """
+    Standard deviation to divide by when scaling scores.
+
+    Scores that are constant (up to rounding errors) or undefined (less than two observations)
+    are scaled to zero instead of becoming inf, NaN or amplified rounding errors.
+    """
+    std = np.array(std, dtype=np.float64)
+    std[~(std > np.sqrt(np.finfo(np.float64).eps) * np.abs(mean))] = np.inf
+    return std
+
+
+def score_networks(
+    adata: AnnData,
+    networks: Mapping[str, Union[Network, pd.DataFrame]],
+    *,
+    center: bool = True,
+    norm: bool = True,
+    scale: bool = True,
+    min_size: int = 5,
+    use_raw: bool = True,
+    chunk_size: int = 50000,
+) -> Dict[str, pd.DataFrame]:
+    """
+    Score multiple networks in a single pass over the expression matrix.
+
+    Uses the same algorithm as `progeny.run` and `dorothea.run` without permutations:
+    the gene expression of each cell is centered and multiplied with the weights of each source.
+    All networks are combined in a single sparse weight matrix, such that the expression
+    matrix (which may be sparse or backed) only needs to be read once, in chunks of cells.
+    The AnnData object is not copied or modified.
+
+    Parameters
+    ----------
+    adata
+        AnnData object with log-normalized gene expression
+    networks
+        Dictionary name -> network (:class:`Network` or data frame with genes in rows and sources in columns)
+    center
+        Center gene expression by the mean per cell (across the genes of each network)
+    norm
+        Normalize the weights by the sum of absolute weights of each source to correct for large regulons
+    scale
+        Scale the scores of each source across cells (z-score). Constant scores are set to zero.
+    min_size
+        Sources with less than `min_size` targets in the data will be ignored
+    use_raw
+        Use `adata.raw` where we have the lognorm gene expression
+    chunk_size
+        Number of cells that are processed at once.
+
+    Returns
+    -------
+    Dictionary name -> data frame (cells x sources) with scores
+    """
+    X = adata.raw.X if use_raw else adata.X
+    var_names = adata.raw.var_names if use_raw else adata.var_names
+    W, network_idx, weight_sums, sources = _combined_weights(
+        networks, var_names, min_size=min_size, norm=norm
+    )
+
+    scores = np.empty((adata.n_obs, network_idx.size), dtype=np.float64)
+    for start in range(0, adata.n_obs, chunk_size):
+        scores[start : start + chunk_size, :] = _score_chunk(
+            X[start : start + chunk_size], W, network_idx, weight_sums, center=center
+        )
+
+    if scale:
+        mean = np.mean(scores, axis=0)
+        std = (
+            np.std(scores, axis=0, ddof=1)
+            if scores.shape[0] > 1
+            else np.full(scores.shape[1], np.nan)
+        )
+        scores = (scores - mean) / _scale_std(mean, std)
+
+    offsets = np.concatenate([[0], np.cumsum([len(x) for x in sources])])
+    return {
+        name: pd.DataFrame(
+            scores[:, offsets[i] : offsets[i + 1]],
+            index=adata.obs_names,
+            columns=sources[i],
+        )
+        for i, name in enumerate(networks)
+    }
+
+
+def run_tools(
+    adata: AnnData,
+    tools: Sequence[str],
+    *,
+    chunk_size: int = 50000,
+    network_dir: Optional[Union[str, Path]] = None,
+    use_raw: bool = True,
+    scale: bool = True,
+) -> Dict[str, AnnData]:
+    """Run multiple tools in a single pass over the data.
+
+    Parameters
+    ----------
+    adata
+        AnnData object with lognorm gene expression in `adata.raw` (or `adata.X` if `use_raw` is False)
+    tools
+        tools to run. Supported are `dorothea`, `progeny`, `cytosig`
+    chunk_size
+        Number of cells that are processed at once.
+    network_dir
+        Directory with networks compiled by :func:`compile_networks`. If None, the networks
+        are loaded through the corresponding packages.
+    use_raw
+        Use `adata.raw`, where we have the lognorm gene expression
+    scale
+        Scale the scores of each source across the cells in `adata`. Without scaling, the
+        score of a cell doesn't depend on the other cells in `adata`.
+
+    Returns
+    -------
+    Dictionary tool -> AnnData object with scores in `X` and the same `obs` as `adata`.
+    """
+    scores = score_networks(
+        adata,
+        {tool: load_network(tool, network_dir) for tool in tools},
         center=True,  # Center gene expression by mean per cell
-        num_perm=0,  # Simulate m random activities
         norm=True,  # Normalize by number of edges to correct for large regulons
-        scale=True,  # Scale values per feature so that values can be compared across cells
-        use_raw=True,  # Use raw adata, where we have the lognorm gene expression
-        min_size=5,  # TF with less than 5 targets will be ignored
+        scale=scale,  # Scale values per feature so that values can be compared across cells
+        min_size=5,  # Pathways/TFs with less than 5 targets will be ignored
+        use_raw=use_raw,
+        chunk_size=chunk_size,
     )
-    return dorothea.extract(tmp_adata)
+    return {
+        tool: AnnData(
+            X=df.values,
+            obs=adata.obs.copy(),
+            var=pd.DataFrame(index=df.columns),
+        )
+        for tool, df in scores.items()
+    }
+
+
+def _read_elem(elem):
+    try:
+        from anndata.io import read_elem
+    except ImportError:
+        from anndata.experimental import read_elem
+    return read_elem(elem)
+
+
+def _write_elem(group, key, value):
+    try:
+        from anndata.io import write_elem
+    except ImportError:
+        from anndata.experimental import write_elem
+    write_elem(group, key, value)
+
+
+def score_h5ad(
+    path: Union[str, Path],
+    tools: Sequence[str] = ("progeny", "cytosig"),
+    *,
+    chunk_size: int = 50000,
+    n_jobs: Optional[int] = None,
+    network_dir: Optional[Union[str, Path]] = None,
+    use_raw: bool = True,
+    scale: bool = True,
+    dtype=np.float32,
+) -> None:
+    """
+    Score all cells of a h5ad file and write the results into `.obsm` of the same file.
+
+    In contrast to :func:`run_tools`, the data is never loaded into memory. The expression matrix
+    is read in chunks of `chunk_size` rows, which are scored in parallel by a thread pool. The
+    scores of each tool are written into `.obsm[tool]`, the names of the sources into
+    `.uns[f"{tool}_sources"]`. At most `n_jobs` chunks are in memory at the same time.
+
+    Parameters
+    ----------
+    path
+        Path to a h5ad file with lognorm gene expression in `.raw` (or `.X` if `use_raw` is False).
+        The file is modified in place.
+    tools
+        tools to run. Supported are `dorothea`, `progeny`, `cytosig`
+    chunk_size
+        Number of cells that are processed at once.
+    n_jobs
+        Number of worker threads. If None, use all available CPUs.
+    network_dir
+        Directory with networks compiled by :func:`compile_networks`.
+    use_raw
+        Use `.raw`, where we have the lognorm gene expression
+    scale
+        Scale the scores of each source across all cells of the file (z-score). This requires a
+        second pass over the scores on disk.
+    dtype
+        Data type of the scores on disk
+    """
+    import h5py
+    from concurrent.futures import ThreadPoolExecutor
+    from collections import deque
+    from multiprocessing import cpu_count
+
+    try:
+        from anndata.io import sparse_dataset
+    except ImportError:
+        from anndata.experimental import sparse_dataset
+
+    if n_jobs is None:
+        n_jobs = cpu_count()
+    prefix = "raw/" if use_raw else ""
+
+    with h5py.File(path, "r+") as f:
+        elem = f[f"{prefix}X"]
+        X = elem if isinstance(elem, h5py.Dataset) else sparse_dataset(elem)
+        var_names = pd.Index(_read_elem(f[f"{prefix}var"]).index)
+        n_obs = X.shape[0]
+        W, network_idx, weight_sums, sources = _combined_weights(
+            {tool: load_network(tool, network_dir) for tool in tools},
+            var_names,
+            min_size=5,
+            norm=True,
+        )
+        offsets = np.concatenate([[0], np.cumsum([len(x) for x in sources])])
+
+        obsm = f.require_group("obsm")
+        out = []
+        for tool, tool_sources, start, stop in zip(
+            tools, sources, offsets[:-1], offsets[1:]
+        ):
+            if tool in obsm:
+                del obsm[tool]
+            out.append(
+                obsm.create_dataset(
+                    tool,
+                    shape=(n_obs, stop - start),
+                    dtype=dtype,
+                    chunks=(min(chunk_size, max(n_obs, 1)), max(stop - start, 1)),
+                )
+            )
+            out[-1].attrs.update(
+                {"encoding-type": "array", "encoding-version": "0.2.0"}
+            )
+            _write_elem(
+                f.require_group("uns"),
+                f"{tool}_sources",
+                np.array(tool_sources.astype(str), dtype=object),
+            )
+
+        # running mean and sum of squared deviations (Chan et al.) for scaling
+        n_total = 0
+        mean = np.zeros(network_idx.size)
+        m2 = np.zeros(network_idx.size)
+
+        def _write(start, scores):
+            nonlocal n_total, mean, m2
+            for ds, col_start, col_stop in zip(out, offsets[:-1], offsets[1:]):
+                ds[start : start + scores.shape[0], :] = scores[:, col_start:col_stop]
+            n_chunk = scores.shape[0]
+            chunk_mean = np.mean(scores, axis=0)
+            delta = chunk_mean - mean
+            n_new = n_total + n_chunk
+            mean = mean + delta * n_chunk / n_new
+            m2 = (
+                m2
+                + np.sum((scores - chunk_mean) ** 2, axis=0)
+                + delta**2 * n_total * n_chunk / n_new
+            )
+            n_total = n_new
+
+        # chunks are read (and written) by the main thread, h5py does not support concurrent access
+        with ThreadPoolExecutor(n_jobs) as pool:
+            pending = deque()
+            for start in range(0, n_obs, chunk_size):
+                pending.append(
+                    (
+                        start,
+                        pool.submit(
+                            _score_chunk,
+                            X[start : start + chunk_size],
+                            W,
+                            network_idx,
+                            weight_sums,
+                            center=True,
+                        ),
+                    )
+                )
+                if len(pending) >= n_jobs:
+                    tmp_start, future = pending.popleft()
+                    _write(tmp_start, future.result())
+            while pending:
+                tmp_start, future = pending.popleft()
+                _write(tmp_start, future.result())
+
+        if scale:
+            # the same guard against constant scores as in `score_networks`
+            with np.errstate(divide="ignore", invalid="ignore"):
+                std = _scale_std(mean, np.sqrt(m2 / (n_total - 1)))
+            for ds, col_start, col_stop in zip(out, offsets[:-1], offsets[1:]):
+                for start in range(0, n_obs, chunk_size):
+                    ds[start : start + chunk_size, :] = (
+                        ds[start : start + chunk_size, :] - mean[col_start:col_stop]
+                    ) / std[col_start:col_stop]
+
+
+def run_progeny(adata):
+    return run_tools(adata, ["progeny"])["progeny"]
+
+
+def run_dorothea(adata):
+    return run_tools(adata, ["dorothea"])["dorothea"]
 
 
-@suppress_stdout
 def run_cytosig(adata):
     """Run cytosig.
 
-    The algorithm in dorothea-py gives the same results as the original implementation (it's a simple matrix multiplication)
-    and is a lot faster.
+    Uses the same algorithm as progeny. This gives the same results as the original implementation
+    (it's a simple matrix multiplication) and is a lot faster.
     """
-    import progeny
-
-    tmp_adata = adata.copy()
-    progeny.run(
-        tmp_adata,  # Data to use
-        _cytosig_model(),  # PROGENy network
-        center=True,  # Center gene expression by mean per cell
-        num_perm=0,  # Simulate m random activities
-        norm=True,  # Normalize by number of edges to correct for large regulons
-        scale=True,  # Scale values per feature so that values can be compared across cells
-        use_raw=True,  # Use raw adata, where we have the lognorm gene expression
-        min_size=5,  # Pathways with less than 5 targets will be ignored
-        obsm_key="cytosig",
-    )
-    return progeny.extract(tmp_adata, obsm_key="cytosig")
+    return run_tools(adata, ["cytosig"])["cytosig"]
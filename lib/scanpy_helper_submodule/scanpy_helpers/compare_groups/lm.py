@@ -1,24 +1,27 @@
-"""High-level wrappers around linear models to find differences between groups. """
+"""High-level wrappers around linear models to find differences between groups."""
 
-
-from typing import Dict, List, Mapping, Optional, Sequence, Tuple
-from unittest.util import strclass
+from typing import Callable, Dict, List, Mapping, Optional, Sequence, Tuple, Union
 import warnings
 import pandas as pd
+import patsy
 from patsy import PatsyError
 from tqdm.auto import tqdm
-import statsmodels.formula.api as smf
 from tqdm.contrib.concurrent import process_map
-import re
+import scipy.sparse
+import scipy.stats
 from anndata import AnnData
 from ..pseudobulk import pseudobulk
 import numpy as np
 import pandas as pd
-from ..util import chunk_adatas, fdr_correction
+from ..util import fdr_correction, shared_arrays, attach_shared_arrays
 import itertools
+import hashlib
+from collections import OrderedDict
 from multiprocessing import cpu_count
 from threadpoolctl import threadpool_limits
-from statsmodels.regression.linear_model import RegressionResultsWrapper
+
+#: `test_lm` runs sequentially for less than twice this number of variables, unless a chunksize is given.
+_MIN_CHUNKSIZE = 200
 
 
 def lm_test_all(
@@ -29,6 +32,7 @@ def lm_test_all(
     contrasts: str = "Sum",
     lm_covariate_str: str = "",
     min_categories: int = 2,
+    n_jobs: Optional[int] = None,
     **kwargs,
 ) -> Optional[pd.DataFrame]:
     """High-level function to compare groups multiple single cell objects.
@@ -52,33 +56,131 @@ def lm_test_all(
         E.g. `+ dataset`.
     min_categories
         Only perform test if there are at least `min_categories` unique entries in `column_to_test`.
+    n_jobs
+        Number of worker processes. The cell-types are processed in parallel. If there is only a
+        single cell-type, the variables are processed in parallel instead (see :func:`test_lm`).
+    **kwargs
+        passed to :func:`test_lm`
 
     Returns
     -------
     Data frame with coefficients and pvalues.
     """
-    res_list = []
-    for ct, tmp_adata in tqdm(adatas.items()):
-        tmp_bdata = pseudobulk(
-            tmp_adata,
-            groupby=groupby + [column_to_test],
-            aggr_fun=np.mean,
+    res_list = _run_lm_tasks(
+        list(adatas.items()),
+        n_jobs=n_jobs,
+        groupby=groupby,
+        column_to_test=column_to_test,
+        contrasts=contrasts,
+        lm_covariate_str=lm_covariate_str,
+        min_categories=min_categories,
+        **kwargs,
+    )
+    return _combine_lm_results(res_list)
+
+
+def _combine_lm_results(res_list: Sequence[Optional[pd.DataFrame]]) -> pd.DataFrame:
+    """Concatenate the results of multiple cell-types and perform FDR correction"""
+    return (
+        pd.concat([res for res in res_list if res is not None])
+        .pipe(fdr_correction)
+        .sort_values("pvalue")
+    )
+
+
+def _run_lm_tasks(
+    tasks: Sequence[Tuple[str, AnnData]],
+    *,
+    n_jobs: Optional[int] = None,
+    groupby: Optional[List[str]],
+    column_to_test: str,
+    **kwargs,
+) -> List[Optional[pd.DataFrame]]:
+    """
+    Run :func:`_lm_test_cell_type` on a list of (cell-type, adata) tuples.
+
+    If `groupby` is not None, each adata is first aggregated into a pseudobulk by `groupby` and
+    `column_to_test`. This happens in the main process, such that only the (small) pseudobulks
+    are sent to the workers. If `groupby` is None, the adatas already are pseudobulks.
+
+    Tasks are distributed over a process pool. The results are returned in the order
+    of `tasks` (`None` for tasks that were skipped).
+    """
+    if n_jobs is None:
+        n_jobs = cpu_count()
+    if groupby is not None:
+        tasks = [
+            (
+                ct,
+                pseudobulk(adata, groupby=groupby + [column_to_test], aggr_fun=np.mean),
+            )
+            for ct, adata in tasks
+        ]
+    kwargs["column_to_test"] = column_to_test
+
+    if n_jobs == 1 or len(tasks) <= 1:
+        # parallelize within `test_lm` (if at all)
+        results = [
+            _lm_test_cell_type(ct, adata, n_jobs=n_jobs, **kwargs)
+            for ct, adata in tqdm(tasks)
+        ]
+    else:
+        # one task per worker at a time; avoid oversubscription by BLAS threads.
+        results = process_map(
+            _lm_test_cell_type_worker,
+            [ct for ct, _ in tasks],
+            [adata for _, adata in tasks],
+            itertools.repeat(kwargs),
+            max_workers=min(n_jobs, len(tasks)),
+            chunksize=1,
         )
-        if tmp_bdata.obs[column_to_test].nunique() >= min_categories:
-            try:
-                tmp_res = test_lm(
-                    tmp_bdata,
-                    f"~ C({column_to_test}, {contrasts}) {lm_covariate_str}",
-                    column_to_test,
-                    contrasts=contrasts,
-                    progress=False,
-                    **kwargs,
-                )
-                res_list.append(tmp_res.assign(cell_type=ct))
-            except PatsyError as e:
-                warnings.warn(f"Iteration on {ct} failed with {e}. Ignoring error. ")
 
-    return pd.concat(res_list).pipe(fdr_correction).sort_values("pvalue")
+    res_list = []
+    for ct, (res, error) in zip((ct for ct, _ in tasks), results):
+        if error is not None:
+            warnings.warn(f"Iteration on {ct} failed with {error}. Ignoring error. ")
+        res_list.append(res)
+    return res_list
+
+
+def _lm_test_cell_type_worker(
+    ct: str, adata: AnnData, kwargs: Mapping
+) -> Tuple[Optional[pd.DataFrame], Optional[str]]:
+    """Helper function for :func:`_run_lm_tasks` executed in a worker process."""
+    with threadpool_limits(1):
+        return _lm_test_cell_type(ct, adata, n_jobs=1, **kwargs)
+
+
+def _lm_test_cell_type(
+    ct: str,
+    bdata: AnnData,
+    *,
+    column_to_test: str,
+    contrasts: str,
+    lm_covariate_str: str,
+    min_categories: int,
+    **kwargs,
+) -> Tuple[Optional[pd.DataFrame], Optional[str]]:
+    """
+    Test the pseudobulk of a single cell-type.
+
+    Returns a tuple (result, error message). The error message is not None if the model
+    could not be built (e.g. because a covariate only has a single level).
+    """
+    if bdata.obs[column_to_test].nunique() < min_categories:
+        return None, None
+    try:
+        res = test_lm(
+            bdata,
+            f"~ C({column_to_test}, {contrasts}) {lm_covariate_str}",
+            column_to_test,
+            contrasts=contrasts,
+            progress=False,
+            **kwargs,
+        )
+        return res.assign(cell_type=ct), None
+    except PatsyError as e:
+        return None, str(e)
 
 
 def test_lm(
@@ -90,7 +192,13 @@ def test_lm(
     robust: bool = False,
     progress: bool = True,
     n_jobs: int = None,
-    chunksize=200,
+    chunksize: Optional[int] = None,
+    memory_budget: int = 2 * 1024**3,
+    absorb: Sequence[str] = (),
+    permutations: int = 0,
+    permutation_strata: Sequence[str] = (),
+    random_state: int = 0,
+    random_intercept: Optional[str] = None,
 ):
     """
     Use a linear model to find differences between groups
@@ -116,7 +224,37 @@ def test_lm(
     n_jobs
         Run test in parallel. Set to 1 to disable parallelism.
     chunksize
-        Splits up anndata in chunks of var and processes chunks in parallel.
+        Number of variables that are processed by a worker at once. The response matrix is placed
+        in shared memory and workers only receive ranges of variables.
+        If None, the chunksize is chosen based on the number of variables, `n_jobs` and `memory_budget`.
+        Fewer than twice `chunksize` (or twice 200 if chosen automatically) variables are processed
+        sequentially.
+    memory_budget
+        Approximate upper bound (in bytes) of the memory used by all workers together for
+        intermediate results. Only used to choose the `chunksize` automatically.
+    absorb
+        Categorical nuisance factors (columns in `pseudobulk.obs`) that are absorbed rather than
+        included as dummy variables in the design matrix (e.g. `["patient"]` for a paired analysis).
+        The response and the design matrix are demeaned within the levels of these factors
+        (Frisch-Waugh-Lovell) and the residual degrees of freedom are adjusted accordingly.
+        Coefficients and pvalues of the tested variable are the same as with `+ patient`
+        in the formula. The reported intercept is the mean response after removing the
+        effects of the covariates.
+    permutations
+        If > 0, compute empirical pvalues from the given number of permutations of the `groupby`
+        column. All variables are refitted for all permutations at once. The empirical pvalues are
+        reported in the `pvalue` column and the pvalues of the linear model in `pvalue_ols`.
+    permutation_strata
+        Columns in `pseudobulk.obs`. If specified, the `groupby` column is only permuted within
+        groups of observations with the same values in these columns (e.g. `["patient"]` for a paired design).
+    random_state
+        Seed for generating the permutations
+    random_intercept
+        Column in `pseudobulk.obs` (e.g. `"patient"`). If specified, fit a linear mixed model with a
+        random intercept for each level of this column, e.g. to account for the same patient being
+        measured in multiple samples or datasets. The variance components are estimated by REML
+        for all variables at once, using a single eigendecomposition of the random effect covariance.
+        Not compatible with `robust`, `absorb` and `permutations`.
 
     Returns
     -------
@@ -126,36 +264,320 @@ def test_lm(
     if n_jobs is None:
         n_jobs = cpu_count()
 
+    design = _get_design(
+        pseudobulk.obs,
+        formula,
+        groupby,
+        contrasts=contrasts,
+        absorb=absorb,
+        random_intercept=random_intercept,
+    )
+    Y = _get_response(pseudobulk, design)
+    fit_kwargs = {"robust": robust}
+    if permutations:
+        fit_kwargs.update(
+            permutations=permutations,
+            strata=(
+                pseudobulk.obs.loc[design.obs_names, list(permutation_strata)]
+                .groupby(list(permutation_strata), observed=True, dropna=False)
+                .ngroup()
+                .values
+                if len(permutation_strata)
+                else None
+            ),
+            random_state=random_state,
+        )
+
     # likely overhead is larger until several times chunksize. Exact optimum not tested.
-    if pseudobulk.shape[1] < chunksize * 2 or n_jobs == 1:
-        return _test_lm(
-            pseudobulk,
-            formula,
-            groupby,
-            contrasts=contrasts,
-            robust=robust,
+    # The threshold must not depend on the automatically chosen chunksize, which shrinks with
+    # the number of variables.
+    min_parallel_vars = 2 * (_MIN_CHUNKSIZE if chunksize is None else chunksize)
+    if Y.shape[1] < min_parallel_vars or n_jobs == 1:
+        return _fit_lm(
+            design,
+            Y,
+            pseudobulk.var_names,
             progress=progress,
+            memory_budget=memory_budget,
+            **fit_kwargs,
         )
     else:
-        return pd.concat(
-            process_map(
-                _test_lm,
-                list(chunk_adatas(pseudobulk, chunksize=chunksize)),
-                itertools.repeat(formula),
-                itertools.repeat(groupby),
-                itertools.repeat(contrasts),
-                itertools.repeat(False),
-                itertools.repeat(robust),
+        if chunksize is None:
+            chunksize = _get_chunksize(
+                *Y.shape, n_jobs=n_jobs, memory_budget=memory_budget
+            )
+        # place the response matrix in shared memory such that it doesn't need to be
+        # pickled to the workers
+        with shared_arrays({"Y": Y}) as specs:
+            col_ranges = [
+                (i, min(i + chunksize, Y.shape[1]))
+                for i in range(0, Y.shape[1], chunksize)
+            ]
+            res = process_map(
+                _fit_lm_shared,
+                col_ranges,
+                [pseudobulk.var_names[start:stop] for start, stop in col_ranges],
+                itertools.repeat(specs),
+                itertools.repeat(design),
+                itertools.repeat(
+                    dict(fit_kwargs, memory_budget=memory_budget // n_jobs)
+                ),
                 max_workers=n_jobs,
+                chunksize=1,
+                disable=not progress,
             )
+        return pd.concat(res)
+
+
+def _get_chunksize(n_obs: int, n_vars: int, *, n_jobs: int, memory_budget: int) -> int:
+    """
+    Choose the number of variables per parallel task.
+
+    Aims at several tasks per worker for load balancing, while keeping the intermediate arrays
+    of all workers (response, fitted values, residuals, weights; each n_obs x chunksize) within
+    `memory_budget`.
+    """
+    chunksize = int(np.ceil(n_vars / (n_jobs * 4)))
+    max_chunksize = memory_budget // (
+        n_jobs * n_obs * np.dtype(np.float64).itemsize * 4
+    )
+    return int(max(1, min(chunksize, max_chunksize)))
+
+
+def _fit_lm_shared(
+    col_range: Tuple[int, int],
+    var_names: pd.Index,
+    specs: Mapping,
+    design: "_LmDesign",
+    fit_kwargs: Mapping,
+) -> pd.DataFrame:
+    """Helper function for :func:`test_lm` that fits a range of variables from a shared memory block."""
+    with attach_shared_arrays(specs) as arrays:
+        Y = arrays["Y"][:, col_range[0] : col_range[1]].copy()
+    # avoid oversubscription by BLAS threads of the workers
+    with threadpool_limits(1):
+        return _fit_lm(design, Y, var_names, **fit_kwargs)
+
+
+def _ols(
+    design: np.ndarray,
+    Y: np.ndarray,
+    *,
+    robust: bool = False,
+    df_absorbed: int = 0,
+    leverage_absorbed: Optional[np.ndarray] = None,
+    pinv: Optional[np.ndarray] = None,
+    rank: Optional[int] = None,
+) -> Tuple[
+    np.ndarray,
+    Callable[[np.ndarray], Tuple[np.ndarray, np.ndarray, np.ndarray]],
+    Union[int, np.ndarray],
+]:
+    """
+    Fit an ordinary least squares model for all columns of `Y` at once.
+
+    Equivalent to fitting `statsmodels.api.OLS(Y[:, j], design)` for each column `j`
+    (which uses the Moore-Penrose pseudoinverse, i.e. also works for rank-deficient designs).
+
+    Parameters
+    ----------
+    design
+        design matrix (n_obs x n_params). May also be a stack of design matrices
+        (n_designs x n_obs x n_params) which are all fitted against the same `Y`.
+        All outputs get an additional leading dimension in that case.
+    Y
+        response matrix (n_obs x n_vars)
+    robust
+        If true, use heteroskedasticity-consistent standard errors (HC3).
+    df_absorbed
+        degrees of freedom used by absorbed fixed effects (see :class:`_FixedEffects`)
+    leverage_absorbed
+        leverage of the absorbed fixed effects, added to the leverage of `design` for HC3.
+    pinv, rank
+        Precomputed pseudoinverse and rank of `design`. Computed if not specified.
+
+    Returns
+    -------
+    params
+        coefficients (n_params x n_vars)
+    test
+        function that takes a matrix of linear combinations `R` (n_tests x n_params) and
+        returns the estimates of `R @ params`, the t-statistics and the corresponding two-sided pvalues.
+        Each row in `R` corresponds to a test with one degree of freedom
+        (the same as `res.f_test(R[i, :])` in statsmodels).
+    df_resid
+        residual degrees of freedom
+    """
+    if pinv is None:
+        pinv = np.linalg.pinv(design)
+    if rank is None:
+        rank = np.linalg.matrix_rank(design)
+    params = pinv @ Y
+    resid = Y - design @ params
+    df_resid = design.shape[-2] - rank - df_absorbed
+
+    if robust:
+        leverage = np.sum(design * np.swapaxes(pinv, -1, -2), axis=-1)
+        if leverage_absorbed is not None:
+            leverage = leverage + leverage_absorbed
+        # HC3: squared residuals inflated by leverage
+        weights = resid**2 / (1 - leverage[..., np.newaxis]) ** 2
+    else:
+        sigma2 = np.sum(resid**2, axis=-2) / np.asarray(df_resid)[..., np.newaxis]
+
+    def test(R: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        R_pinv = R @ pinv
+        if robust:
+            variance = R_pinv**2 @ weights
+        else:
+            variance = (
+                np.sum(R_pinv**2, axis=-1)[..., np.newaxis] * sigma2[..., np.newaxis, :]
+            )
+        estimate = R @ params
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tvalues = estimate / np.sqrt(variance)
+        pvalues = 2 * scipy.stats.t.sf(
+            np.abs(tvalues), np.asarray(df_resid)[..., np.newaxis, np.newaxis]
         )
+        return estimate, tvalues, pvalues
+
+    return params, test, df_resid
+
+
+def _lmm(
+    design: np.ndarray,
+    Y: np.ndarray,
+    eigenvalues: np.ndarray,
+    *,
+    n_grid: int = 100,
+    n_iter: int = 40,
+    log10_lambda_range: Tuple[float, float] = (-5, 5),
+) -> Tuple[
+    np.ndarray, Callable[[np.ndarray], Tuple[np.ndarray, np.ndarray, np.ndarray]], int
+]:
+    """
+    Fit a linear mixed model with a single random effect for all columns of `Y` at once.
+
+    The model is `y = X @ beta + u + e` with `u ~ N(0, sigma_g^2 K)` and `e ~ N(0, sigma_e^2 I)`.
+    `design` and `Y` must be rotated by the eigenvectors of `K` (i.e. `U.T @ X` and `U.T @ Y`),
+    such that the covariance becomes diagonal: `sigma_e^2 * diag(lambda * eigenvalues + 1)`
+    with `lambda = sigma_g^2 / sigma_e^2`. The eigendecomposition is shared across all variables.
 
+    `lambda` is estimated for each variable by maximizing the restricted likelihood (REML),
+    first on a grid of `log10(lambda)` and then by golden-section search around the best grid
+    point, vectorized over all variables (similar to FaST-LMM or GEMMA).
+    Coefficients are tested with a Wald t-test with `n_obs - rank(X)` degrees of freedom.
 
-def _test_all_params(
-    res, *, groupby: str, all_groups: Sequence[str], contrasts: str
-) -> Tuple[Dict, Dict, Dict]:
+    Parameters
+    ----------
+    design
+        rotated design matrix (n_obs x n_params)
+    Y
+        rotated response matrix (n_obs x n_vars)
+    eigenvalues
+        eigenvalues of the covariance matrix of the random effect (n_obs)
+
+    Returns
+    -------
+    params
+        coefficients (n_params x n_vars)
+    test
+        function that takes a matrix of linear combinations `R` (n_tests x n_params) and
+        returns the estimates of `R @ params`, the t-statistics and the corresponding two-sided pvalues.
+    df_resid
+        residual degrees of freedom
     """
-    Calculate pvalues and coefficients from a statsmodels results object.
+    n_obs, n_params = design.shape
+    rank = np.linalg.matrix_rank(design)
+    df_resid = n_obs - rank
+    # outer products of the rows of the design matrix, such that X^T W X can be computed
+    # for all variables with a single matrix product.
+    XX = (design[:, :, np.newaxis] * design[:, np.newaxis, :]).reshape(n_obs, -1)
+    Y_T = Y.T
+    Y2_T = Y_T**2
+
+    def _gls(lambdas: np.ndarray):
+        """GLS fit for the variance ratios `lambdas` (one for each variable or a single shared value)"""
+        W = 1 / (lambdas[:, np.newaxis] * eigenvalues[np.newaxis, :] + 1)
+        # eigendecomposition of X^T W X gives both the pseudoinverse and the (pseudo) determinant
+        eig, eigvec = np.linalg.eigh((W @ XX).reshape(-1, n_params, n_params))
+        nonzero = eig > 1e-10 * np.max(eig, axis=1, keepdims=True)
+        eig_inv = np.divide(1, eig, out=np.zeros_like(eig), where=nonzero)
+        XtWX_inv = (eigvec * eig_inv[:, np.newaxis, :]) @ np.swapaxes(eigvec, 1, 2)
+        logdet = np.sum(np.log(np.where(nonzero, eig, 1)), axis=1)
+        XtWy = (W * Y_T) @ design
+        beta = (XtWX_inv @ XtWy[:, :, np.newaxis])[:, :, 0]
+        rss = np.sum(W * Y2_T, axis=1) - np.sum(beta * XtWy, axis=1)
+        return W, logdet, XtWX_inv, beta, np.maximum(rss, 0)
+
+    def _reml(lambdas: np.ndarray) -> np.ndarray:
+        """Restricted log-likelihood (up to a constant), profiled over beta and sigma_e^2"""
+        W, logdet, _, _, rss = _gls(lambdas)
+        with np.errstate(divide="ignore"):
+            return -0.5 * (
+                df_resid * np.log(rss / df_resid) - np.sum(np.log(W), axis=1) + logdet
+            )
+
+    n_vars = Y.shape[1]
+    grid = np.linspace(*log10_lambda_range, n_grid)
+    # on the grid, all variables share the same lambda -> only a single X^T W X
+    ll_grid = np.vstack(
+        [
+            np.broadcast_to(_reml(np.array([lam])), (n_vars,))
+            for lam in np.concatenate([[0], 10**grid])
+        ]
+    )
+    best = np.argmax(ll_grid, axis=0)
+
+    # refine the estimate around the best grid point with golden-section search.
+    # The first row of `ll_grid` corresponds to lambda = 0, i.e. no random effect.
+    grid_idx = np.maximum(best - 1, 0)
+    a = grid[np.maximum(grid_idx - 1, 0)]
+    b = grid[np.minimum(grid_idx + 1, n_grid - 1)]
+    r = (np.sqrt(5) - 1) / 2
+    c, d = b - r * (b - a), a + r * (b - a)
+    fc, fd = _reml(10**c), _reml(10**d)
+    for _ in range(n_iter):
+        # if f(c) >= f(d), the maximum is in [a, d], otherwise in [c, b]
+        left = fc >= fd
+        a, b = np.where(left, a, c), np.where(left, d, b)
+        x_keep, f_keep = np.where(left, c, d), np.where(left, fc, fd)
+        x_new = np.where(left, b - r * (b - a), a + r * (b - a))
+        f_new = _reml(10**x_new)
+        c, fc = np.where(left, x_new, x_keep), np.where(left, f_new, f_keep)
+        d, fd = np.where(left, x_keep, x_new), np.where(left, f_keep, f_new)
+
+    x_refined = np.where(fc >= fd, c, d)
+    refined_is_better = np.maximum(fc, fd) >= np.max(ll_grid, axis=0)
+    lambdas = np.where(
+        best == 0,
+        0,
+        10 ** np.where(refined_is_better, x_refined, grid[grid_idx]),
+    )
+
+    _, _, XtWX_inv, beta, rss = _gls(lambdas)
+    sigma2 = rss / df_resid
+    params = beta.T
+
+    def test(R: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        estimate = R @ params
+        variance = np.einsum("kp,gpq,kq->kg", R, XtWX_inv, R) * sigma2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tvalues = estimate / np.sqrt(variance)
+        return estimate, tvalues, 2 * scipy.stats.t.sf(np.abs(tvalues), df_resid)
+
+    return params, test, df_resid
+
+
+def _compile_contrasts(
+    param_names: Sequence[str],
+    *,
+    groupby: str,
+    all_groups: Sequence[str],
+    contrasts: str,
+) -> Tuple[List[str], List[str], np.ndarray]:
+    """
+    Build the restriction matrix to test all groups of the linear model.
 
     If we use sum-to-zero coding, perform the test for the omitted level.
     (By default, one level is omitted, because it is redundant. We can compute
@@ -163,8 +585,8 @@ def _test_all_params(
 
     Parameters
     ----------
-    res
-        a statsmodels result object coming from a linear model
+    param_names
+        names of the columns of the design matrix, as generated by patsy
     groupby
         Name of the column to test
     all_groups
@@ -175,12 +597,13 @@ def _test_all_params(
 
     Returns
     -------
-    coefs
-        Dictionary mapping keys from the linear model summary data frame onto linear model coefficients
-    pvals
-        Dictionary mapping keys from the linear model summary data frame onto pvalues (f-test)
-    intercept
-        Dictionary mapping keys from the linear model summary data frame onto linear model intercepts
+    keys
+        Parameter names as they are used in the linear model results data frame
+    groups
+        The group corresponding to each key
+    R
+        restriction matrix (n_keys x n_params). Each row corresponds to a test with one
+        degree of freedom, see :func:`_ols`.
     """
     if contrasts.startswith("Sum"):
         contrasts_mode = "sum-to-zero"
@@ -200,85 +623,513 @@ def _test_all_params(
 
     # Generate keys as they are used in the linear model results data frame
     keys = [f"C({groupby}, {contrasts})[{contrasts[0]}.{g}]" for g in groups_to_test]
+    param_idx = {name: i for i, name in enumerate(param_names)}
 
-    intercept = res.params["Intercept"]
-
+    # each row of R selects a coefficient (or a linear combination thereof) to test
+    tested_keys = keys[:-1] if contrasts_mode == "sum-to-zero" else keys
+    R = np.zeros((len(keys), len(param_names)))
+    for i, k in enumerate(tested_keys):
+        R[i, param_idx[k]] = 1
     if contrasts_mode == "sum-to-zero":
-        coefs = res.params[keys[:-1]].to_dict()
-        pvals = res.pvalues[keys[:-1]].to_dict()
-
         # test the level that was omitted for redundancy
-        coefs[keys[-1]] = -sum(coefs.values())
-        pvals[keys[-1]] = float(
-            res.f_test(" + ".join([f"{k}" for k in keys[:-1]]) + " = 0").pvalue
+        R[-1, :] = -np.sum(R[:-1, :], axis=0)
+
+    return keys, [str(g) for g in groups_to_test], R
+
+
+class _FixedEffects:
+    """
+    Categorical fixed effects that are absorbed by demeaning within groups (Frisch-Waugh-Lovell).
+
+    By the FWL theorem, regressing the demeaned response on the demeaned design matrix
+    yields the same coefficients and residuals as including one dummy variable per level.
+    Multiple factors are absorbed by alternating projections until convergence.
+
+    Parameters
+    ----------
+    codes
+        integer codes of the factors to absorb (n_obs x n_factors)
+
+    Attributes
+    ----------
+    df
+        number of degrees of freedom used by the absorbed factors
+    leverage
+        diagonal of the hat matrix of the absorbed factors.
+    """
+
+    def __init__(self, codes: np.ndarray):
+        n_obs = codes.shape[0]
+        self._indicators = []
+        for j in range(codes.shape[1]):
+            factor_codes = pd.factorize(codes[:, j])[0]
+            indicator = scipy.sparse.csr_matrix(
+                (np.ones(n_obs), (factor_codes, np.arange(n_obs))),
+                shape=(factor_codes.max() + 1, n_obs),
+            )
+            self._indicators.append((indicator, indicator.sum(axis=1).A))
+
+        dummies = scipy.sparse.vstack([ind for ind, _ in self._indicators]).T.toarray()
+        self.leverage = np.sum(dummies * np.linalg.pinv(dummies).T, axis=1)
+        self.df = np.linalg.matrix_rank(dummies)
+
+    def demean(
+        self, A: np.ndarray, *, tol: float = 1e-12, max_iter: int = 10000
+    ) -> np.ndarray:
+        """Remove the fixed effects from all columns of `A` (n_obs x n_cols)"""
+        A = np.array(A, dtype=np.float64)
+        for _ in range(max_iter):
+            A_prev = A.copy()
+            for indicator, counts in self._indicators:
+                A -= indicator.T @ ((indicator @ A) / counts)
+            if len(self._indicators) == 1 or np.max(
+                np.abs(A - A_prev), initial=0
+            ) <= tol * max(1, np.max(np.abs(A), initial=0)):
+                break
+        else:
+            warnings.warn("Absorbing fixed effects did not converge.")
+        return A
+
+
+class _LmDesign:
+    """
+    Compiled design of a linear model.
+
+    Holds everything that only depends on `obs`, the formula and the contrasts: the design matrix
+    as generated by patsy, the restriction matrix to test all groups (see :func:`_compile_contrasts`),
+    and the pseudoinverse of the design matrix. Use :func:`_get_design` to obtain a cached instance.
+
+    Observations with missing values in the covariates (or the absorbed factors) are dropped.
+    """
+
+    def __init__(
+        self,
+        obs: pd.DataFrame,
+        formula: str,
+        groupby: str,
+        *,
+        contrasts: str,
+        absorb: Sequence[str] = (),
+        random_intercept: Optional[str] = None,
+    ):
+        if random_intercept is not None and len(absorb):
+            raise ValueError(
+                "`absorb` and `random_intercept` can't be used at the same time."
+            )
+        obs = obs.copy()
+        # convert to categorical to make sure the levels have an inherent order
+        obs[groupby] = pd.Categorical(obs[groupby])  # type: ignore
+        # only using the categories (rather than just .unique() gets rid of nans)
+        self.all_groups = obs[groupby].cat.categories.tolist()
+
+        # patsy drops observations with missing values in the covariates
+        obs = obs.dropna(
+            subset=list(absorb) + ([random_intercept] if random_intercept else [])
         )
-    else:
-        coefs = res.params[keys].to_dict()
-        pvals = res.pvalues[keys].to_dict()
+        self.design_df = patsy.dmatrix(
+            formula, obs, return_type="dataframe", NA_action="drop"
+        )
+        self.keys, self.groups, self.R = _compile_contrasts(
+            self.design_df.columns,
+            groupby=groupby,
+            all_groups=self.all_groups,
+            contrasts=contrasts,
+        )
+        # columns of the design matrix that encode the variable to test
+        self.test_cols = np.flatnonzero(
+            self.design_df.columns.str.startswith(f"C({groupby}, {contrasts})[")
+        )
+        self.absorb_codes = (
+            np.column_stack(
+                [pd.factorize(obs.loc[self.design_df.index, col])[0] for col in absorb]
+            )
+            if len(absorb)
+            else None
+        )
+        self.random_codes = (
+            pd.factorize(obs.loc[self.design_df.index, random_intercept])[0]
+            if random_intercept is not None
+            else None
+        )
+        self._factorization = None
+        self._rotation = None
 
-    return coefs, pvals, intercept
+    @property
+    def obs_names(self) -> pd.Index:
+        """Observations used in the model"""
+        return self.design_df.index
 
+    def _factorize(
+        self, obs_mask: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray, int, Optional[_FixedEffects]]:
+        """
+        Design matrix (after absorbing fixed effects), its pseudoinverse and its rank
+        for a subset of observations. The result for all observations is cached.
+        """
+        if obs_mask is None and self._factorization is not None:
+            return self._factorization
 
-def _test_lm(
-    pseudobulk: AnnData,
+        design = self.design_df.values
+        fixed_effects = None
+        if obs_mask is not None:
+            design = design[obs_mask, :]
+        if self.absorb_codes is not None:
+            fixed_effects = _FixedEffects(
+                self.absorb_codes
+                if obs_mask is None
+                else self.absorb_codes[obs_mask, :]
+            )
+            design_absorbed = fixed_effects.demean(design)
+            # columns that are spanned by the absorbed factors (e.g. the intercept) are set to exactly zero.
+            spanned = np.linalg.norm(design_absorbed, axis=0) <= 1e-8 * np.maximum(
+                np.linalg.norm(design, axis=0), 1
+            )
+            design_absorbed[:, spanned] = 0
+            design = design_absorbed
+
+        factorization = (
+            design,
+            np.linalg.pinv(design),
+            np.linalg.matrix_rank(design),
+            fixed_effects,
+        )
+        if obs_mask is None:
+            self._factorization = factorization
+        return factorization
+
+    def _rotate(
+        self, obs_mask: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Eigendecomposition of the covariance of the random intercept (`Z @ Z.T` with `Z`
+        the indicator matrix of the random effect levels) and the rotated design matrix for a
+        subset of observations. The result for all observations is cached.
+        """
+        if obs_mask is None and self._rotation is not None:
+            return self._rotation
+
+        design, codes = self.design_df.values, self.random_codes
+        if obs_mask is not None:
+            design, codes = design[obs_mask, :], codes[obs_mask]
+        eigenvalues, eigenvectors = np.linalg.eigh(
+            (codes[:, np.newaxis] == codes[np.newaxis, :]).astype(np.float64)
+        )
+        rotation = (eigenvectors.T @ design, eigenvectors, np.maximum(eigenvalues, 0))
+        if obs_mask is None:
+            self._rotation = rotation
+        return rotation
+
+    def fit(
+        self,
+        Y: np.ndarray,
+        obs_mask: Optional[np.ndarray] = None,
+        *,
+        robust: bool = False,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Fit the linear model for all columns of `Y` and test all groups.
+
+        If the design has a random intercept, a linear mixed model is fitted instead (see :func:`_lmm`).
+
+        Parameters
+        ----------
+        Y
+            response matrix (n_obs x n_vars). If `obs_mask` is specified, only the
+            corresponding observations.
+        obs_mask
+            Boolean mask to fit the model on a subset of observations
+        robust
+            If true, use heteroskedasticity-consistent standard errors (HC3).
+
+        Returns
+        -------
+        coefs
+            linear model coefficients (n_keys x n_vars)
+        pvals
+            pvalues (n_keys x n_vars)
+        intercept
+            linear model intercepts (n_vars)
+        """
+        intercept_idx = self.design_df.columns.get_loc("Intercept")
+        if self.random_codes is not None:
+            if robust:
+                raise ValueError(
+                    "Robust standard errors are not supported with a random intercept."
+                )
+            design, eigenvectors, eigenvalues = self._rotate(obs_mask)
+            params, test, _ = _lmm(design, eigenvectors.T @ Y, eigenvalues)
+            coefs, _, pvals = test(self.R)
+            return coefs, pvals, params[intercept_idx, :]
+
+        design, pinv, rank, fixed_effects = self._factorize(obs_mask)
+        ols_kwargs = {}
+        if fixed_effects is not None:
+            ols_kwargs["df_absorbed"] = fixed_effects.df
+            ols_kwargs["leverage_absorbed"] = fixed_effects.leverage
+            Y_fit = fixed_effects.demean(Y)
+        else:
+            Y_fit = Y
+        params, test, _ = _ols(
+            design, Y_fit, robust=robust, pinv=pinv, rank=rank, **ols_kwargs
+        )
+        coefs, _, pvals = test(self.R)
+
+        if fixed_effects is not None:
+            # the intercept is absorbed. Recover it from the means of the original data
+            X = self.design_df.values
+            if obs_mask is not None:
+                X = X[obs_mask, :]
+            X_mean = np.mean(X, axis=0)
+            X_mean[intercept_idx] = 0
+            intercept = np.mean(Y, axis=0) - X_mean @ params
+        else:
+            intercept = params[intercept_idx, :]
+        return coefs, pvals, intercept
+
+    def permutation_test(
+        self,
+        Y: np.ndarray,
+        obs_mask: Optional[np.ndarray] = None,
+        *,
+        permutation_keys: np.ndarray,
+        strata: Optional[np.ndarray] = None,
+        robust: bool = False,
+        memory_budget: int = 2 * 1024**3,
+    ) -> np.ndarray:
+        """
+        Empirical pvalues by permuting the variable to test.
+
+        The rows of the design matrix that encode the variable to test are permuted (optionally
+        only within strata) and all variables are refitted for all permutations at once, using a
+        stack of design matrices. The test statistic is the absolute t-statistic of each group.
+
+        Parameters
+        ----------
+        Y
+            response matrix (n_obs x n_vars). If `obs_mask` is specified, only the
+            corresponding observations.
+        obs_mask
+            Boolean mask to fit the model on a subset of observations
+        permutation_keys
+            random numbers (n_permutations x n_obs) that define the permutations by sorting
+            (only the observations in `obs_mask`).
+        strata
+            integer codes of the strata in which observations are permuted (n_obs)
+            (only the observations in `obs_mask`).
+        robust
+            If true, use heteroskedasticity-consistent standard errors (HC3).
+        memory_budget
+            Approximate upper bound (in bytes) for intermediate results. The permutations are
+            processed in chunks that fit in this budget.
+
+        Returns
+        -------
+        Empirical pvalues (n_keys x n_vars), computed as (1 + #{|t_perm| >= |t_obs|}) / (1 + n_permutations).
+        """
+        if self.random_codes is not None:
+            raise ValueError(
+                "Permutation tests are not supported with a random intercept."
+            )
+        design, pinv, rank, fixed_effects = self._factorize(obs_mask)
+        ols_kwargs = {}
+        if fixed_effects is not None:
+            ols_kwargs["df_absorbed"] = fixed_effects.df
+            ols_kwargs["leverage_absorbed"] = fixed_effects.leverage
+            Y = fixed_effects.demean(Y)
+        _, test, _ = _ols(design, Y, robust=robust, pinv=pinv, rank=rank, **ols_kwargs)
+        _, t_obs, _ = test(self.R)
+        t_obs = np.abs(t_obs) * (1 - 1e-12)
+
+        # permute within strata: sort by stratum, then by the random keys.
+        n_permutations, n_obs = permutation_keys.shape
+        strata = np.zeros(n_obs, dtype=int) if strata is None else strata
+        perm_idx = np.empty(permutation_keys.shape, dtype=int)
+        perm_idx[:, np.argsort(strata, kind="stable")] = np.lexsort(
+            (permutation_keys, np.broadcast_to(strata, permutation_keys.shape)),
+            axis=-1,
+        )
+
+        X_test = self.design_df.values[:, self.test_cols]
+        if obs_mask is not None:
+            X_test = X_test[obs_mask, :]
+        n_params = design.shape[1]
+        bytes_per_permutation = (
+            (4 * n_obs + n_params + 2 * self.R.shape[0]) * Y.shape[1] * Y.itemsize
+        )
+        chunksize = max(1, memory_budget // max(bytes_per_permutation, 1))
+
+        n_extreme = np.zeros(t_obs.shape, dtype=int)
+        for start in range(0, n_permutations, chunksize):
+            idx = perm_idx[start : start + chunksize]
+            designs = np.repeat(design[np.newaxis, :, :], idx.shape[0], axis=0)
+            X_perm = X_test[idx, :]
+            if fixed_effects is not None:
+                # demean all permuted columns in one go (n_obs x (chunk * n_test_cols))
+                X_perm = (
+                    fixed_effects.demean(X_perm.transpose(1, 0, 2).reshape(n_obs, -1))
+                    .reshape(n_obs, idx.shape[0], -1)
+                    .transpose(1, 0, 2)
+                )
+            designs[:, :, self.test_cols] = X_perm
+            _, test, _ = _ols(designs, Y, robust=robust, **ols_kwargs)
+            _, t_perm, _ = test(self.R)
+            n_extreme += np.sum(np.abs(t_perm) >= t_obs, axis=0)
+
+        # no test statistic (e.g. constant variable) -> no pvalue
+        return np.where(np.isnan(t_obs), np.nan, (1 + n_extreme) / (1 + n_permutations))
+
+
+_DESIGN_CACHE: "OrderedDict[str, _LmDesign]" = OrderedDict()
+_DESIGN_CACHE_SIZE = 256
+
+
+def _get_design(
+    obs: pd.DataFrame,
     formula: str,
     groupby: str,
+    *,
     contrasts: str,
-    progress: bool = False,
+    absorb: Sequence[str] = (),
+    random_intercept: Optional[str] = None,
+) -> _LmDesign:
+    """
+    Compile the design of a linear model, or retrieve it from the cache.
+
+    The cache key is a hash of the content of `obs` (including the index and the categories),
+    the formula and the contrasts. The cache is therefore shared between all pseudobulks with
+    the same `obs` (e.g. the same cell-type scored with different tools) and invalidated
+    whenever `obs` changes.
+    """
+    try:
+        h = hashlib.sha1(pd.util.hash_pandas_object(obs, index=True).values.tobytes())
+    except TypeError:
+        # unhashable values in obs. Don't use the cache.
+        return _LmDesign(
+            obs,
+            formula,
+            groupby,
+            contrasts=contrasts,
+            absorb=absorb,
+            random_intercept=random_intercept,
+        )
+    categories = {
+        col: obs[col].cat.categories.tolist()
+        for col in obs.columns
+        if isinstance(obs[col].dtype, pd.CategoricalDtype)
+    }
+    h.update(
+        repr(
+            (
+                obs.columns.tolist(),
+                obs.dtypes.astype(str).tolist(),
+                categories,
+                formula,
+                groupby,
+                contrasts,
+                list(absorb),
+                random_intercept,
+            )
+        ).encode()
+    )
+    key = h.hexdigest()
+
+    try:
+        design = _DESIGN_CACHE.pop(key)
+    except KeyError:
+        design = _LmDesign(
+            obs,
+            formula,
+            groupby,
+            contrasts=contrasts,
+            absorb=absorb,
+            random_intercept=random_intercept,
+        )
+    _DESIGN_CACHE[key] = design
+    while len(_DESIGN_CACHE) > _DESIGN_CACHE_SIZE:
+        _DESIGN_CACHE.popitem(last=False)
+    return design
+
+
+def _get_response(pseudobulk: AnnData, design: _LmDesign) -> np.ndarray:
+    """Extract the dense response matrix for the observations used in `design`"""
+    obs_idx = pseudobulk.obs_names.get_indexer(design.obs_names)
+    Y = pseudobulk.X
+    Y = Y.toarray() if scipy.sparse.issparse(Y) else np.asarray(Y)
+    return Y[obs_idx, :].astype(np.float64)
+
+
+def _fit_lm(
+    design: _LmDesign,
+    Y: np.ndarray,
+    var_names: pd.Index,
+    *,
     robust: bool = False,
+    progress: bool = False,
+    permutations: int = 0,
+    strata: Optional[np.ndarray] = None,
+    random_state: int = 0,
+    memory_budget: int = 2 * 1024**3,
 ) -> pd.DataFrame:
-    """Internal helper function for :func:`test_lm` that gets called in parallel."""
-    var_names = pseudobulk.var_names
-
-    # Q() contains the dependent variable which will get inserted in each iteration with a `.format()` call.
-    formula = "Q('{col}') " + formula
+    """
+    Fit the linear model for all variables at once (see :func:`_ols`) and generate the result data frame.
 
-    # add `adata.X` to the dataframe (used by the linear model)
-    df = pseudobulk.obs.join(
-        pd.DataFrame(pseudobulk.X, index=pseudobulk.obs_names, columns=var_names)  # type: ignore
-    )
+    Variables with missing values are fitted separately on the non-missing observations.
+    If `permutations` > 0, add empirical pvalues (see :meth:`_LmDesign.permutation_test`).
+    """
+    if permutations:
+        # The same random numbers are used for every chunk of variables, such that the results
+        # don't depend on the chunking. Subsets of observations use a subset of the keys.
+        permutation_keys = np.random.default_rng(random_state).random(
+            (permutations, Y.shape[0])
+        )
 
-    # convert to categorical to make sure the levels have an inherent order
-    pseudobulk.obs[groupby] = pd.Categorical(pseudobulk.obs[groupby])  # type: ignore
-    # only using the categories (rather than just .unique() gets rid of nans)
-    all_groups = pseudobulk.obs[groupby].cat.categories.tolist()
+    # variables with missing values need a separate design matrix
+    has_nan = np.any(np.isnan(Y), axis=0)
+    var_groups = [(np.flatnonzero(~has_nan), None)]
+    var_groups += [(np.array([j]), ~np.isnan(Y[:, j])) for j in np.flatnonzero(has_nan)]
+    var_groups = tqdm(var_groups) if progress else var_groups
 
     results: List[pd.DataFrame] = []
-    var_iter = tqdm(var_names) if progress else var_names
-    for col in var_iter:
-        try:
-            with threadpool_limits(1):
-                mod = smf.ols(formula=formula.format(col=col), data=df)
-                res = mod.fit()
-                if robust:
-                    res = RegressionResultsWrapper(
-                        res.get_robustcov_results(cov_type="HC3")
-                    )
-                coefs, pvals, intercept = _test_all_params(
-                    res, groupby=groupby, all_groups=all_groups, contrasts=contrasts
-                )
-                res_df = (
-                    pd.DataFrame.from_dict(coefs, orient="index", columns=["coef"])
-                    .assign(intercept=intercept)
-                    .join(
-                        pd.DataFrame.from_dict(
-                            pvals, orient="index", columns=["pvalue"]
-                        )
-                    )
-                    .assign(
-                        variable=col,
-                        # extract plain group variable from model summary data frame:
-                        group=lambda x: [
-                            re.search(f"\[{contrasts[0]}\.(.*)\]", k).groups()[0]
-                            for k in x.index
-                        ],
-                    )
-                )
-            results.append(res_df)
-        except ValueError:
-            pass
+    n_keys = len(design.keys)
+    for var_idx, obs_mask in var_groups:
+        if not var_idx.size or (obs_mask is not None and not np.any(obs_mask)):
+            continue
+        tmp_Y = Y[:, var_idx] if obs_mask is None else Y[np.ix_(obs_mask, var_idx)]
+        coefs, pvals, intercept = design.fit(tmp_Y, obs_mask, robust=robust)
+        tmp_res = pd.DataFrame(
+            {
+                "coef": coefs.T.ravel(),
+                "intercept": np.repeat(intercept, n_keys),
+                "pvalue": pvals.T.ravel(),
+                "variable": np.repeat(var_names[var_idx], n_keys),
+                "group": np.tile(design.groups, var_idx.size),
+            },
+            index=np.tile(design.keys, var_idx.size),
+        )
+        if permutations:
+            pvals_perm = design.permutation_test(
+                tmp_Y,
+                obs_mask,
+                permutation_keys=(
+                    permutation_keys
+                    if obs_mask is None
+                    else permutation_keys[:, obs_mask]
+                ),
+                strata=(
+                    strata if strata is None or obs_mask is None else strata[obs_mask]
+                ),
+                robust=robust,
+                memory_budget=memory_budget,
+            )
+            tmp_res = tmp_res.rename(columns={"pvalue": "pvalue_ols"}).assign(
+                pvalue=pvals_perm.T.ravel()
+            )
+        results.append(tmp_res)
 
     try:
-        return pd.concat(results)
+        # restore the original order of variables
+        return pd.concat(results).sort_values(
+            "variable", key=lambda x: var_names.get_indexer(x), kind="stable"
+        )
     except ValueError:
         return pd.DataFrame()
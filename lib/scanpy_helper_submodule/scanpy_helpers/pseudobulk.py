@@ -1,18 +1,428 @@
-from typing import Sequence, Union
+from typing import Any, Callable, Dict, List, Mapping, Optional, Sequence, Tuple, Union
+from pathlib import Path
+import hashlib
+import os
+import re
+import anndata
 from anndata import AnnData, ImplicitModificationWarning
 import numpy as np
 import pandas as pd
-from operator import and_
-from functools import reduce
+import scipy.sparse
 import warnings
 
+#: Aggregation functions that are computed with a single sparse matrix product
+#: rather than by slicing the matrix once per group.
+_BUILTIN_AGGR_FUNS = {
+    "sum": "sum",
+    "mean": "mean",
+    "count_nonzero": "count_nonzero",
+    "fraction_expressed": "fraction_expressed",
+    "var": "var",
+    np.sum: "sum",
+    np.mean: "mean",
+    np.count_nonzero: "count_nonzero",
+    np.var: "var",
+}
+
+
+def _group_codes(obs: pd.DataFrame, groupby: Sequence[str]) -> Tuple[np.ndarray, int]:
+    """
+    Encode the combinations of values in `groupby` into integer group codes.
+
+    Groups are numbered in the order of their first occurrence in `obs` (which is
+    the same order as `obs.drop_duplicates()`). Observations with a missing value
+    in any of the columns are assigned the code `-1`.
+
+    Returns
+    -------
+    codes
+        integer array of length `obs.shape[0]`
+    n_groups
+        number of distinct groups
+    """
+    codes = np.zeros(obs.shape[0], dtype=np.int64)
+    missing = np.zeros(obs.shape[0], dtype=bool)
+    n_groups = 1
+    for col in groupby:
+        col_codes, col_uniques = pd.factorize(obs[col], sort=False)
+        missing |= col_codes < 0
+        # re-factorize after each column to keep the combined key compact
+        codes, uniques = pd.factorize(codes * len(col_uniques) + col_codes, sort=False)
+        n_groups = len(uniques)
+    if missing.any():
+        valid_codes, uniques = pd.factorize(codes[~missing], sort=False)
+        codes = np.full(obs.shape[0], -1, dtype=np.int64)
+        codes[~missing] = valid_codes
+        n_groups = len(uniques)
+    return codes, n_groups
+
+
+def _sum_dtype(dtype) -> np.dtype:
+    """dtype of sums of values of `dtype`, consistent with `np.sum`
+    (integers are summed with 64 bit, floats keep their precision).
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == "f":
+        return dtype
+    elif dtype.kind == "u":
+        return np.dtype(np.uint64)
+    elif dtype.kind == "i":
+        return np.dtype(np.int64)
+    return np.dtype(np.float64)
+
+
+def _indicator_matrix(
+    codes: np.ndarray, n_groups: int, dtype
+) -> scipy.sparse.csr_matrix:
+    """Sparse `n_groups x n_obs` matrix with a one where an observation belongs to a group."""
+    valid = np.flatnonzero(codes >= 0)
+    return scipy.sparse.csr_matrix(
+        (np.ones(valid.size, dtype=dtype), (codes[valid], valid)),
+        shape=(n_groups, codes.size),
+    )
+
+
+def _nonzero_indicator(X, *, positive: bool = False):
+    """Binary matrix with the same shape as X that is 1 where X is nonzero (or positive,
+    if `positive` is True). Preserves sparsity.
+    """
+    op = np.greater if positive else np.not_equal
+    if scipy.sparse.issparse(X):
+        X = X.copy()
+        X.data = op(X.data, 0).astype(np.int64)
+        return X
+    return op(np.asarray(X), 0).astype(np.int64)
+
+
+def _to_dense(X) -> np.ndarray:
+    if scipy.sparse.issparse(X):
+        return X.toarray()
+    return np.asarray(X)
+
+
+#: Part of the :class:`PseudobulkCache` keys. Increase when the results of a statistic change.
+_CACHE_VERSION = 2
+
+#: Statistics supported by :class:`_GroupAccumulator` and the moments required to compute them.
+_STAT_MOMENTS = {
+    "sum": ("sum",),
+    "mean": ("sum",),
+    "count_nonzero": ("nnz",),
+    # only positive values count as expressed, also in layers with negative values
+    "fraction_expressed": ("npos",),
+    "var": ("sum", "sumsq"),
+}
+
+
+class _GroupAccumulator:
+    """
+    Accumulate per-group statistics over (chunks of) rows of a matrix.
+
+    Each call to :meth:`update` performs one sparse indicator-matrix product per required
+    moment (sum, sum of squares, number of nonzero or positive entries). The work is O(nnz) and
+    `X` is never densified. Statistics are derived from the moments in :meth:`finalize`.
+
+    Parameters
+    ----------
+    n_groups
+        Number of groups
+    stats
+        Statistics to compute. See `_STAT_MOMENTS` for the supported values.
+    """
+
+    def __init__(self, n_groups: int, stats: Sequence[str]):
+        for stat in stats:
+            if stat not in _STAT_MOMENTS:
+                raise ValueError(f"Unsupported aggregation function: {stat}")
+        self.n_groups = n_groups
+        self.stats = list(stats)
+        self.required_moments = {m for stat in self.stats for m in _STAT_MOMENTS[stat]}
+        self.n_obs = np.zeros(n_groups, dtype=np.int64)
+        self._acc = {}
+
+    def _add(self, moment, value):
+        if moment in self._acc:
+            self._acc[moment] += value
+        else:
+            self._acc[moment] = value
+
+    def update(self, X, codes: np.ndarray):
+        """Add the rows of `X` to the groups specified by the `codes` of the same length."""
+        self.n_obs += np.bincount(codes[codes >= 0], minlength=self.n_groups)
+        if "sum" in self.required_moments:
+            dtype = _sum_dtype(X.dtype)
+            self._add(
+                "sum",
+                _to_dense(
+                    _indicator_matrix(codes, self.n_groups, dtype)
+                    @ X.astype(dtype, copy=False)
+                ),
+            )
+        if "sumsq" in self.required_moments:
+            X_sq = X.power(2) if scipy.sparse.issparse(X) else np.square(X)
+            self._add(
+                "sumsq",
+                _to_dense(
+                    _indicator_matrix(codes, self.n_groups, np.float64)
+                    @ X_sq.astype(np.float64)
+                ),
+            )
+        if "nnz" in self.required_moments:
+            self._add(
+                "nnz",
+                _to_dense(
+                    _indicator_matrix(codes, self.n_groups, np.int64)
+                    @ _nonzero_indicator(X)
+                ),
+            )
+        if "npos" in self.required_moments:
+            self._add(
+                "npos",
+                _to_dense(
+                    _indicator_matrix(codes, self.n_groups, np.int64)
+                    @ _nonzero_indicator(X, positive=True)
+                ),
+            )
+
+    @property
+    def moments(self) -> Dict[str, np.ndarray]:
+        """The accumulated moments (`sum`, `sumsq`, `nnz`, `npos`)"""
+        return self._acc
+
+    def finalize(self) -> Dict[str, np.ndarray]:
+        """Compute the requested statistics from the accumulated moments."""
+        return _compute_stats(self._acc, self.n_obs, self.stats)
+
+
+def _compute_stats(
+    moments: Mapping[str, np.ndarray], n_obs: np.ndarray, stats: Sequence[str]
+) -> Dict[str, np.ndarray]:
+    """Compute statistics from per-group moments and the number of observations per group."""
+    n_obs = n_obs[:, np.newaxis]
+    # like `np.mean` and `np.var`, keep the precision of floating point input
+    float_dtype = (
+        moments["sum"].dtype
+        if "sum" in moments and moments["sum"].dtype.kind == "f"
+        else np.float64
+    )
+    res = {}
+    for stat in stats:
+        if stat == "sum":
+            res[stat] = moments["sum"]
+        elif stat == "mean":
+            res[stat] = (moments["sum"] / n_obs).astype(float_dtype, copy=False)
+        elif stat == "count_nonzero":
+            res[stat] = moments["nnz"]
+        elif stat == "fraction_expressed":
+            res[stat] = moments["npos"] / n_obs
+        elif stat == "var":
+            # population variance (`ddof=0`), consistent with `np.var`
+            mean = moments["sum"] / n_obs
+            res[stat] = np.clip(moments["sumsq"] / n_obs - mean**2, 0, None).astype(
+                float_dtype, copy=False
+            )
+    return res
+
+
+def _aggregate_callback(
+    X,
+    codes: np.ndarray,
+    n_groups: int,
+    aggr_fun: Callable,
+    rows: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Aggregate rows of X by group with an arbitrary callback function (slower fallback).
+
+    If `rows` is specified, `codes` refer to these rows of `X`.
+    """
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(n_groups + 1))
+    if rows is not None:
+        order = rows[order]
+    expr_agg = []
+    for i in range(n_groups):
+        expr_row = aggr_fun(X[order[bounds[i] : bounds[i + 1]], :], axis=0)
+        # convert matrix to array if required (happens when aggregating spares matrix)
+        expr_agg.append(_to_dense(expr_row).ravel())
+    return np.vstack(expr_agg) if expr_agg else np.zeros((0, X.shape[1]))
+
+
+def _backed_matrix(adata: AnnData, layer: Optional[str] = None):
+    """Get a handle to `X` or a layer of a backed AnnData object without loading it into memory."""
+    if layer is None:
+        return adata.X
+    import h5py
+
+    elem = adata.file[f"layers/{layer}"]
+    if isinstance(elem, h5py.Dataset):
+        return elem
+    try:
+        from anndata.io import sparse_dataset
+    except ImportError:
+        from anndata.experimental import sparse_dataset
+    return sparse_dataset(elem)
+
+
+def _resolve_view(adata: AnnData) -> Tuple[AnnData, Optional[np.ndarray], Any]:
+    """
+    Resolve an AnnData view into its parent object, an integer array of the parent's rows
+    that are in the view and the index of the parent's vars in the view.
+
+    For actual AnnData objects, returns `(adata, None, slice(None))`.
+    """
+    if not adata.is_view:
+        return adata, None, slice(None)
+    parent = adata._adata_ref
+    rows = np.arange(parent.n_obs)[adata._oidx]
+    return parent, rows, adata._vidx
+
+
+def _iter_row_chunks(X, chunk_size: int, rows: Optional[np.ndarray] = None):
+    """
+    Yield `(positions, chunk)` tuples of row chunks of an (on-disk) matrix.
+
+    If `rows` is specified, only these rows of `X` are read (in ascending order) and
+    `positions` refers to the position in `rows`. Otherwise, `positions` refers to rows of `X`.
+    """
+    if rows is None:
+        for start in range(0, X.shape[0], chunk_size):
+            stop = min(start + chunk_size, X.shape[0])
+            yield slice(start, stop), X[start:stop]
+    else:
+        # reading sorted rows is much faster, in particular from disk
+        order = np.argsort(rows, kind="stable")
+        for start in range(0, order.size, chunk_size):
+            positions = order[start : start + chunk_size]
+            chunk_rows, inverse = np.unique(rows[positions], return_inverse=True)
+            chunk = X[chunk_rows]
+            if chunk_rows.size < positions.size:
+                # duplicated rows in the index
+                chunk = chunk[inverse]
+            yield positions, chunk
+
+
+def _get_matrix(adata: AnnData, layer: Optional[str] = None):
+    """Get `X` or a layer from an actual (i.e. not a view) AnnData object, which may be backed."""
+    if adata.isbacked:
+        return _backed_matrix(adata, layer)
+    return adata.X if layer is None else adata.layers[layer]
+
+
+def _accumulate_moments(
+    adata: AnnData,
+    codes: np.ndarray,
+    n_groups: int,
+    stats: Sequence[str],
+    layer: Optional[str] = None,
+    chunk_size: int = 50000,
+) -> Dict[str, np.ndarray]:
+    """
+    Compute the per-group moments required for `stats` in a single pass over the matrix.
+
+    Views are not copied. Instead, we aggregate the corresponding rows directly from the parent.
+    Backed matrices and views are processed in chunks of `chunk_size` rows.
+    """
+    parent, rows, var_idx = _resolve_view(adata)
+    X = _get_matrix(parent, layer)
+    acc = _GroupAccumulator(n_groups, stats)
+    if parent.isbacked or rows is not None:
+        for positions, X_chunk in _iter_row_chunks(X, chunk_size, rows):
+            acc.update(X_chunk, codes[positions])
+    else:
+        acc.update(X, codes)
+    return {k: v[:, var_idx] for k, v in acc.moments.items()}
+
+
+def _first_occurrence(codes: np.ndarray, n_groups: int) -> np.ndarray:
+    """Index of the first observation of each group, in the order of the group codes"""
+    first_idx = np.full(n_groups, codes.size, dtype=np.int64)
+    valid = codes >= 0
+    np.minimum.at(first_idx, codes[valid], np.flatnonzero(valid))
+    return first_idx
+
+
+def _make_pseudobulk_adata(
+    obs: pd.DataFrame,
+    groupby: Sequence[str],
+    n_obs: np.ndarray,
+    expr_agg: np.ndarray,
+    layers: Mapping[str, np.ndarray],
+    var: pd.DataFrame,
+    min_obs: int,
+) -> AnnData:
+    """
+    Assemble the pseudobulk AnnData object.
+
+    `obs` contains one row per group (e.g. its first observation), `expr_agg`, `layers`
+    and `n_obs` one row per group in the same order. Groups with less than `min_obs`
+    observations are excluded.
+    """
+    keep = n_obs >= min_obs
+    obs_records = []
+    for comb, n in zip(
+        obs.loc[keep, groupby].itertuples(index=False),
+        n_obs[keep],
+    ):
+        obs_row = comb._asdict()
+        obs_row["n_obs"] = n
+        obs_records.append(obs_row)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", ImplicitModificationWarning)
+        return AnnData(
+            X=expr_agg[keep, :],
+            var=var,
+            obs=pd.DataFrame.from_records(
+                obs_records, columns=list(groupby) + ["n_obs"]
+            ),
+            layers={k: v[keep, :] for k, v in layers.items()},
+        )
+
+
+def _array_checksum(h, arr, n_chunks: int = 16, chunk_len: int = 4096) -> None:
+    """Update hash `h` with `n_chunks` evenly spaced chunks of a 1D (on-disk) array"""
+    length = arr.shape[0]
+    starts = np.unique(
+        np.linspace(0, max(length - chunk_len, 0), n_chunks).astype(np.int64)
+    )
+    for start in starts:
+        h.update(np.ascontiguousarray(arr[start : start + chunk_len]).tobytes())
+
+
+def _matrix_fingerprint(X) -> str:
+    """
+    Cheap fingerprint of an in-memory or backed matrix.
+
+    Consists of shape, dtype, number of nonzero entries and a checksum of evenly spaced chunks
+    of the underlying data arrays. Does not read the entire matrix.
+    """
+    h = hashlib.sha1()
+    h.update(repr((X.shape, str(X.dtype))).encode())
+    if scipy.sparse.issparse(X):
+        arrays = [X.data, X.indices, X.indptr]
+    elif hasattr(X, "group"):
+        # backed sparse dataset
+        arrays = [X.group["data"], X.group["indices"], X.group["indptr"]]
+    else:
+        # dense matrix: use evenly spaced rows
+        rows = np.unique(np.linspace(0, max(X.shape[0] - 1, 0), 64).astype(np.int64))
+        arrays = [np.asarray(X[rows]).ravel()] if X.shape[0] else []
+    for arr in arrays:
+        h.update(str(arr.shape[0]).encode())
+        _array_checksum(h, arr)
+    return h.hexdigest()
+
 
 def pseudobulk(
     adata,
     *,
     groupby: Union[str, Sequence[str]],
-    aggr_fun=np.sum,
+    aggr_fun: Union[str, Callable] = np.sum,
     min_obs=10,
+    stats: Optional[Sequence[str]] = None,
+    layer: Optional[str] = None,
+    chunk_size: int = 50000,
+    cache: Optional["PseudobulkCache"] = None,
 ) -> AnnData:
     """
     Calculate Pseudobulk of groups
@@ -20,14 +430,32 @@ def pseudobulk(
     Parameters
     ----------
     adata
-        annotated data matrix
+        annotated data matrix. May also be an AnnData object opened in backed mode, or a path to a `h5ad`
+        file. In that case, the matrix is streamed from disk in chunks of `chunk_size` rows, and only
+        builtin aggregation functions are supported.
     groupby
         One or multiple columns to group by
     aggr_fun
-        Callback function to calculate pseudobulk. Must be a numpy ufunc supporting
-        the `axis` attribute.
+        Function to calculate pseudobulk. Either one of `sum`, `mean`, `count_nonzero`,
+        `fraction_expressed` (fraction of values > 0), `var` (or the numpy equivalents `np.sum`,
+        `np.mean`, `np.count_nonzero`),
+        which are computed in a single pass over the (sparse) matrix, or a callback function.
+        A callback must be a numpy ufunc supporting the `axis` attribute and is called once per group.
     min_obs
         Exclude groups with less than `min_obs` observations
+    stats
+        Compute multiple statistics in a single pass over the matrix. Must be a list of
+        builtin aggregation functions (see `aggr_fun`). Each statistic is stored in
+        `.layers[stat]` of the result, `.X` contains the first statistic.
+        If `stats` is specified, `aggr_fun` is ignored.
+    layer
+        Aggregate values from `adata.layers[layer]` instead of `adata.X`.
+    chunk_size
+        Number of rows that are read at once when operating on a backed AnnData object or on a view.
+        Bounds the peak memory usage.
+    cache
+        A :class:`PseudobulkCache`. If specified, results are retrieved from or stored in the
+        on-disk cache. Only used with builtin aggregation functions.
 
     Returns
     -------
@@ -36,41 +464,543 @@ def pseudobulk(
     if isinstance(groupby, str):
         groupby = [groupby]
 
-    combinations = adata.obs.loc[:, groupby].drop_duplicates()
+    if isinstance(adata, (str, Path)):
+        adata = anndata.read_h5ad(adata, backed="r")
+        try:
+            return pseudobulk(
+                adata,
+                groupby=groupby,
+                aggr_fun=aggr_fun,
+                min_obs=min_obs,
+                stats=stats,
+                layer=layer,
+                chunk_size=chunk_size,
+                cache=cache,
+            )
+        finally:
+            adata.file.close()
 
-    if adata.is_view:
-        # for whatever reason, the pseudobulk function is terribly slow when operating on a view.
-        adata = adata.copy()
+    cache_key = None
+    if cache is not None and (
+        stats is not None or _BUILTIN_AGGR_FUNS.get(aggr_fun, None) is not None  # type: ignore
+    ):
+        cache_key = cache.key(
+            adata,
+            groupby=groupby,
+            stats=stats if stats is not None else [_BUILTIN_AGGR_FUNS[aggr_fun]],  # type: ignore
+            layer=layer,
+            min_obs=min_obs,
+            with_layers=stats is not None,
+        )
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
 
-    # precompute masks
-    masks = {}
-    for col in groupby:
-        masks[col] = {}
-        for val in combinations[col].unique():
-            masks[col][val] = adata.obs[col] == val
+    codes, n_groups = _group_codes(adata.obs, groupby)
+    n_obs = np.bincount(codes[codes >= 0], minlength=n_groups)
 
-    expr_agg = []
-    obs = []
+    layers = {}
+    if stats is not None:
+        layers = _compute_stats(
+            _accumulate_moments(adata, codes, n_groups, stats, layer, chunk_size),
+            n_obs,
+            stats,
+        )
+        expr_agg = layers[stats[0]]
+    elif _BUILTIN_AGGR_FUNS.get(aggr_fun, None) is not None:  # type: ignore
+        aggr_fun_name = _BUILTIN_AGGR_FUNS[aggr_fun]  # type: ignore
+        expr_agg = _compute_stats(
+            _accumulate_moments(
+                adata, codes, n_groups, [aggr_fun_name], layer, chunk_size
+            ),
+            n_obs,
+            [aggr_fun_name],
+        )[aggr_fun_name]
+    elif callable(aggr_fun):
+        parent, rows, var_idx = _resolve_view(adata)
+        if parent.isbacked:
+            raise ValueError(
+                "Callback aggregation functions are not supported on backed AnnData objects. "
+                "Use a builtin aggregation function instead."
+            )
+        expr_agg = _aggregate_callback(
+            _get_matrix(parent, layer), codes, n_groups, aggr_fun, rows
+        )[:, var_idx]
+    else:
+        raise ValueError(f"Unsupported aggregation function: {aggr_fun}")
 
-    for comb in combinations.itertuples(index=False):
-        mask = reduce(and_, (masks[col][val] for col, val in zip(groupby, comb)))
-        if np.sum(mask) < min_obs:
-            continue
-        expr_row = aggr_fun(adata.X[mask, :], axis=0)
-        obs_row = comb._asdict()
-        obs_row["n_obs"] = np.sum(mask)
-        # convert matrix to array if required (happens when aggregating spares matrix)
+    res = _make_pseudobulk_adata(
+        adata.obs.iloc[_first_occurrence(codes, n_groups)],
+        groupby,
+        n_obs,
+        expr_agg,
+        layers,
+        adata.var,
+        min_obs,
+    )
+    if cache_key is not None:
+        cache.put(cache_key, res)  # type: ignore
+    return res
+
+
+def make_pseudobulk_samplesheets(
+    adata,
+    *,
+    split_by: str,
+    replicate_col: str,
+    condition_col: str,
+    min_cells_per_sample: int = 10,
+    keep_unpaired_samples: bool = True,
+    layer: Optional[str] = None,
+    chunk_size: int = 50000,
+) -> Dict[str, Tuple[pd.DataFrame, pd.DataFrame]]:
+    """
+    Generate count matrices and samplesheets for pseudobulk differential expression analysis
+    (e.g. with DESeq2) for all groups in `split_by` (e.g. cell-types) in a single pass.
+
+    Counts are summed for each combination of `split_by`, `replicate_col` and `condition_col`.
+    The samplesheet of each group contains all columns from `adata.obs` that are unique
+    within each sample.
+
+    Parameters
+    ----------
+    adata
+        annotated data matrix with raw counts. May be a view, backed or a path to a `h5ad` file,
+        see :func:`pseudobulk`.
+    split_by
+        column in `adata.obs` to split the analysis by (e.g. cell-type)
+    replicate_col
+        column in `adata.obs` that contains the biological replicate (e.g. patient)
+    condition_col
+        column in `adata.obs` that contains the condition to compare
+    min_cells_per_sample
+        Only keep samples with more than `min_cells_per_sample` cells
+    keep_unpaired_samples
+        If False, only keep replicates that have a sample in exactly two conditions
+    layer
+        Aggregate counts from `adata.layers[layer]` instead of `adata.X`.
+    chunk_size
+        See :func:`pseudobulk`.
+
+    Returns
+    -------
+    Dictionary mapping each value of `split_by` to a tuple `(counts, samplesheet)`.
+    `counts` is a genes x samples data frame, `samplesheet` has one row per sample.
+    """
+    if isinstance(adata, (str, Path)):
+        adata = anndata.read_h5ad(adata, backed="r")
         try:
-            expr_row = expr_row.A1
-        except AttributeError:
-            pass
-        obs.append(obs_row)
-        expr_agg.append(expr_row)
+            return make_pseudobulk_samplesheets(
+                adata,
+                split_by=split_by,
+                replicate_col=replicate_col,
+                condition_col=condition_col,
+                min_cells_per_sample=min_cells_per_sample,
+                keep_unpaired_samples=keep_unpaired_samples,
+                layer=layer,
+                chunk_size=chunk_size,
+            )
+        finally:
+            adata.file.close()
 
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore", ImplicitModificationWarning)
-        return AnnData(
-            X=np.vstack(expr_agg),
-            var=adata.var,
-            obs=pd.DataFrame.from_records(obs),
+    groupby = [split_by, replicate_col, condition_col]
+    obs = adata.obs
+    codes, n_groups = _group_codes(obs, groupby)
+    n_obs = np.bincount(codes[codes >= 0], minlength=n_groups)
+    counts = _accumulate_moments(adata, codes, n_groups, ["sum"], layer, chunk_size)[
+        "sum"
+    ]
+    samples = obs.iloc[_first_occurrence(codes, n_groups)].reset_index(drop=True)
+
+    # columns that have a unique value within each sample
+    other_cols = [c for c in obs.columns if c not in groupby]
+    n_unique = (
+        obs.loc[codes >= 0, other_cols]
+        .groupby(codes[codes >= 0])
+        .nunique()
+        .reindex(range(n_groups))
+        == 1
+    )
+
+    res = {}
+    for group in samples[split_by].unique():
+        group_idx = np.flatnonzero(samples[split_by] == group)
+        keep_cols = [
+            c
+            for c in obs.columns
+            if c in groupby or (c in other_cols and n_unique[c].values[group_idx].all())
+        ]
+        samplesheet = samples.loc[group_idx, keep_cols]
+        samplesheet.index = [
+            f"{replicate}_{condition}"
+            for replicate, condition in zip(
+                samplesheet[replicate_col], samplesheet[condition_col]
+            )
+        ]
+        # drop a pre-existing sample column should it exist
+        samplesheet = samplesheet.drop(["sample"], axis="columns", errors="ignore")
+        samplesheet.index.name = "sample"
+        samplesheet["n_cells"] = n_obs[group_idx]
+        bulk_df = pd.DataFrame(
+            counts[group_idx, :].T,
+            index=adata.var_names,
+            columns=samplesheet.index,
+        )
+        bulk_df.index.name = "gene_id"
+
+        samplesheet = samplesheet.loc[samplesheet["n_cells"] > min_cells_per_sample, :]
+        # remove all entries that don't have a paired case/control sample
+        if not keep_unpaired_samples:
+            keep_replicates = samplesheet.groupby([replicate_col]).size() == 2
+            keep_replicates = keep_replicates.index[keep_replicates].values
+            samplesheet = samplesheet.loc[
+                samplesheet[replicate_col].isin(keep_replicates), :
+            ]
+        samplesheet = samplesheet.sort_index()
+        res[group] = (bulk_df.loc[:, samplesheet.index], samplesheet)
+
+    return res
+
+
+def write_pseudobulk_samplesheets(
+    samplesheets: Mapping[str, Tuple[pd.DataFrame, pd.DataFrame]],
+    *,
+    out_dir: Union[str, Path] = ".",
+    prefix: str,
+) -> None:
+    """
+    Write the output of :func:`make_pseudobulk_samplesheets` to
+    `{out_dir}/{prefix}_{group}_counts.csv` and `{out_dir}/{prefix}_{group}_samplesheet.csv`.
+
+    Group names are sanitized (lower case, all special characters replaced by `_`).
+    """
+    out_dir = Path(out_dir)
+    for group, (bulk_df, samplesheet) in samplesheets.items():
+        group_sanitized = re.sub("[^a-z0-9_-]", "_", str(group).lower())
+        bulk_df.to_csv(out_dir / f"{prefix}_{group_sanitized}_counts.csv")
+        samplesheet.to_csv(out_dir / f"{prefix}_{group_sanitized}_samplesheet.csv")
+
+
+class PseudobulkCube:
+    """
+    Pseudobulk at the finest grouping level from which coarser groupings can be derived.
+
+    The expensive pass over the single-cell matrix is performed only once when the cube is
+    created. :meth:`pseudobulk` aggregates the (few) rows of the cube, which is equivalent to
+    calling :func:`pseudobulk` with a coarser grouping on the single-cell data, but a lot faster.
+
+    Coarser groupings can be any subset of the `groupby` columns, any of the `annotation_cols`,
+    or labels derived from them with :meth:`map_labels` (e.g. `cell_type -> cell_type_major`).
+
+    Parameters
+    ----------
+    adata
+        annotated data matrix (may be a view or backed, see :func:`pseudobulk`).
+    groupby
+        Columns that define the finest grouping level
+    stats
+        Statistics that will be available for roll-ups. Only builtin aggregation functions
+        are supported, see :func:`pseudobulk`.
+    annotation_cols
+        Additional columns in `adata.obs` that will be available for roll-ups. Must have a
+        unique value within each group of the finest grouping level (e.g. `cell_type_coarse`
+        if `cell_type` is in `groupby`).
+    layer
+        Aggregate values from `adata.layers[layer]` instead of `adata.X`.
+    chunk_size
+        See :func:`pseudobulk`.
+
+    Examples
+    --------
+    >>> cube = PseudobulkCube(adata, groupby=["dataset", "patient", "cell_type"])
+    >>> pb = cube.pseudobulk(groupby=["patient", "cell_type"])
+    >>> cube.map_labels("cell_type", {"T cell CD4": "T cell", "T cell CD8": "T cell"}, key_added="cell_type_coarse")
+    >>> pb_coarse = cube.pseudobulk(groupby=["patient", "cell_type_coarse"])
+    """
+
+    def __init__(
+        self,
+        adata: AnnData,
+        *,
+        groupby: Union[str, Sequence[str]],
+        stats: Sequence[str] = ("sum", "mean"),
+        annotation_cols: Sequence[str] = (),
+        layer: Optional[str] = None,
+        chunk_size: int = 50000,
+    ):
+        if isinstance(groupby, str):
+            groupby = [groupby]
+        self.groupby = list(groupby)
+        self.stats = list(stats)
+
+        codes, n_groups = _group_codes(adata.obs, self.groupby)
+        for col in annotation_cols:
+            _, n_groups_annot = _group_codes(adata.obs, self.groupby + [col])
+            if n_groups_annot != n_groups:
+                raise ValueError(
+                    f"Annotation column {col} is not unique within the groups of {self.groupby}"
+                )
+
+        self.n_obs = np.bincount(codes[codes >= 0], minlength=n_groups)
+        self.obs = (
+            adata.obs.iloc[_first_occurrence(codes, n_groups)]
+            .loc[:, self.groupby + list(annotation_cols)]
+            .reset_index(drop=True)
+        )
+        self.obs.index = self.obs.index.astype(str)
+        self.var = adata.var.copy()
+        self.moments = _accumulate_moments(
+            adata, codes, n_groups, self.stats, layer, chunk_size
+        )
+
+    def map_labels(
+        self,
+        source_col: str,
+        mapping: Union[Mapping, pd.Series, Callable],
+        *,
+        key_added: str,
+    ) -> None:
+        """
+        Derive a new grouping column from an existing one through a label hierarchy.
+
+        Parameters
+        ----------
+        source_col
+            Existing column in the cube (one of `groupby` or `annotation_cols`)
+        mapping
+            Maps labels of `source_col` to the new labels, e.g. `cell_type -> cell_type_major`.
+            Anything accepted by :meth:`pandas.Series.map`. Groups with unmapped labels
+            are excluded from roll-ups by the new column.
+        key_added
+            Name of the new column
+        """
+        self.obs[key_added] = self.obs[source_col].map(mapping)
+
+    def pseudobulk(
+        self,
+        *,
+        groupby: Union[str, Sequence[str]],
+        aggr_fun: str = "sum",
+        stats: Optional[Sequence[str]] = None,
+        min_obs: int = 10,
+    ) -> AnnData:
+        """
+        Derive the pseudobulk of a coarser grouping from the cube.
+
+        The result is the same as calling :func:`pseudobulk` on the original data with
+        the same parameters. Statistics are weighted by the number of observations per group.
+
+        Parameters
+        ----------
+        groupby
+            One or multiple columns in the cube to group by
+        aggr_fun
+            One of the `stats` the cube has been created with.
+        stats
+            Compute multiple statistics, see :func:`pseudobulk`. If specified, `aggr_fun` is ignored.
+        min_obs
+            Exclude groups with less than `min_obs` observations
+
+        Returns
+        -------
+        New anndata object with same vars as the cube.
+        """
+        if isinstance(groupby, str):
+            groupby = [groupby]
+        if stats is None:
+            aggr_fun_name = _BUILTIN_AGGR_FUNS.get(aggr_fun, None)  # type: ignore
+            if aggr_fun_name is None:
+                raise ValueError(f"Unsupported aggregation function: {aggr_fun}")
+            stats_to_compute = [aggr_fun_name]
+        else:
+            stats_to_compute = list(stats)
+        for stat in stats_to_compute:
+            if stat not in _STAT_MOMENTS:
+                raise ValueError(f"Unsupported aggregation function: {stat}")
+            if not set(_STAT_MOMENTS[stat]) <= set(self.moments):
+                raise ValueError(
+                    f"{stat} cannot be derived from a cube that was created with stats={self.stats}."
+                )
+
+        codes, n_groups = _group_codes(self.obs, groupby)
+        n_obs = np.bincount(
+            codes[codes >= 0], weights=self.n_obs[codes >= 0], minlength=n_groups
+        ).astype(np.int64)
+        moments = {}
+        for moment, values in self.moments.items():
+            dtype = _sum_dtype(values.dtype)
+            moments[moment] = _indicator_matrix(codes, n_groups, dtype) @ values
+
+        layers = _compute_stats(moments, n_obs, stats_to_compute)
+        if stats is None:
+            expr_agg = layers.pop(stats_to_compute[0])
+        else:
+            expr_agg = layers[stats_to_compute[0]]
+
+        return _make_pseudobulk_adata(
+            self.obs.iloc[_first_occurrence(codes, n_groups)],
+            groupby,
+            n_obs,
+            expr_agg,
+            layers,
+            self.var,
+            min_obs,
+        )
+
+
+class PseudobulkCache:
+    """
+    Persistent on-disk cache for :func:`pseudobulk` results.
+
+    Entries are keyed by a cheap fingerprint of the matrix (see `_matrix_fingerprint`),
+    the values of the `groupby` columns, the var names, the aggregation function(s),
+    the layer and `min_obs`. Each entry is stored as `.npz` file (`X` and layers) and a
+    pickle with `obs` and `var`. When the total size exceeds `max_size`, the least recently
+    used entries are evicted.
+
+    Parameters
+    ----------
+    cache_dir
+        Directory to store the cache in. Will be created if it doesn't exist.
+    max_size
+        Maximum total size of the cache in bytes.
+
+    Examples
+    --------
+    >>> cache = PseudobulkCache("~/.cache/pseudobulk")
+    >>> pb = pseudobulk(adata, groupby=["patient", "cell_type"], cache=cache)
+    >>> cache.stats()
+    {'hits': 0, 'misses': 1, 'n_entries': 1, 'size': 123456}
+    """
+
+    def __init__(self, cache_dir: Union[str, Path], *, max_size: int = 10 * 1024**3):
+        self.cache_dir = Path(cache_dir).expanduser()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(
+        adata: AnnData,
+        *,
+        groupby: Sequence[str],
+        stats: Sequence[str],
+        layer: Optional[str],
+        min_obs: int,
+        with_layers: bool,
+    ) -> str:
+        """Compute the cache key for a pseudobulk call"""
+        parent, rows, var_idx = _resolve_view(adata)
+        h = hashlib.sha1()
+        h.update(_matrix_fingerprint(_get_matrix(parent, layer)).encode())
+        if rows is not None:
+            h.update(rows.tobytes())
+        h.update(
+            pd.util.hash_pandas_object(
+                adata.obs.loc[:, list(groupby)], index=False
+            ).values.tobytes()
         )
+        h.update(
+            pd.util.hash_pandas_object(
+                adata.var_names.to_series(), index=False
+            ).values.tobytes()
+        )
+        h.update(
+            repr(
+                (
+                    _CACHE_VERSION,
+                    list(groupby),
+                    list(stats),
+                    layer,
+                    min_obs,
+                    with_layers,
+                )
+            ).encode()
+        )
+        return h.hexdigest()
+
+    def _paths(self, key: str) -> Tuple[Path, Path]:
+        return self.cache_dir / f"{key}.npz", self.cache_dir / f"{key}.pkl"
+
+    def get(self, key: str) -> Optional[AnnData]:
+        """Retrieve an entry from the cache. Returns None if it doesn't exist."""
+        npz_path, pkl_path = self._paths(key)
+        if not (npz_path.exists() and pkl_path.exists()):
+            self.misses += 1
+            return None
+        self.hits += 1
+        # update access time for LRU eviction
+        for path in (npz_path, pkl_path):
+            os.utime(path)
+        with np.load(npz_path) as npz:
+            arrays = {k: npz[k] for k in npz.files}
+        dfs = pd.read_pickle(pkl_path)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", ImplicitModificationWarning)
+            return AnnData(
+                X=arrays.pop("X"),
+                obs=dfs["obs"],
+                var=dfs["var"],
+                layers={k[len("layer_") :]: v for k, v in arrays.items()},
+            )
+
+    def put(self, key: str, adata: AnnData) -> None:
+        """Store a pseudobulk AnnData object in the cache and evict old entries if necessary."""
+        npz_path, pkl_path = self._paths(key)
+        # write to temporary files first, such that concurrent readers never see incomplete entries
+        tmp_npz = npz_path.with_suffix(f".{os.getpid()}.tmp.npz")
+        tmp_pkl = pkl_path.with_suffix(f".{os.getpid()}.tmp")
+        np.savez(
+            tmp_npz,
+            X=np.asarray(adata.X),
+            **{f"layer_{k}": np.asarray(v) for k, v in adata.layers.items()},
+        )
+        pd.to_pickle({"obs": adata.obs, "var": adata.var}, tmp_pkl)
+        os.replace(tmp_npz, npz_path)
+        os.replace(tmp_pkl, pkl_path)
+        self._evict()
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        """List of (last access time, size, key) for all entries"""
+        entries = []
+        for npz_path in self.cache_dir.glob("*.npz"):
+            key = npz_path.stem
+            if ".tmp" in key:
+                continue
+            paths = [p for p in self._paths(key) if p.exists()]
+            entries.append(
+                (
+                    max(p.stat().st_mtime for p in paths),
+                    sum(p.stat().st_size for p in paths),
+                    key,
+                )
+            )
+        return entries
+
+    def _evict(self) -> None:
+        """Remove least recently used entries until the cache is smaller than `max_size`"""
+        entries = sorted(self._entries())
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total_size <= self.max_size:
+                break
+            for path in self._paths(key):
+                path.unlink(missing_ok=True)
+            total_size -= size
+
+    def clear(self) -> None:
+        """Remove all entries from the cache"""
+        for _, _, key in self._entries():
+            for path in self._paths(key):
+                path.unlink(missing_ok=True)
+
+    def stats(self) -> Dict[str, int]:
+        """Hit/miss statistics and current size of the cache"""
+        entries = self._entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "n_entries": len(entries),
+            "size": sum(size for _, size, _ in entries),
+        }
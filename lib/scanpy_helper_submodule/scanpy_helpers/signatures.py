@@ -9,14 +9,15 @@ The original cutoffs used in the MCP counter paper are
  * AUC ROC >= ``min_auc`` (default=0.97)
 """
 
-from typing import Callable, Dict, List, Mapping, Optional, Sequence
+from typing import Callable, Dict, List, Mapping, Optional, Sequence, Union
 import numpy as np
-from sklearn.metrics import roc_auc_score
+from numba import njit, prange
 import sklearn.model_selection
 from anndata import AnnData
 import itertools
 import scipy.stats
-from .pseudobulk import pseudobulk
+import scipy.sparse
+from .pseudobulk import pseudobulk, _get_matrix
 import scanpy as sc
 import altair as alt
 import pandas as pd
@@ -118,6 +119,100 @@ def specific_fold_change(
         return spec_fc
 
 
+@njit
+def _midranks(values, n_obs):
+    """
+    Ranks (starting from 1) of `values` among `n_obs` observations. The remaining
+    `n_obs - len(values)` observations are zero and form a single block of ties.
+    Tied values are assigned their average rank.
+
+    Returns the ranks of `values` and the rank of the zeros.
+    """
+    n_values = values.size
+    n_zero = n_obs - n_values
+    order = np.argsort(values, kind="mergesort")
+    ranks = np.empty(n_values)
+    n_below_zero = 0
+    i = 0
+    while i < n_values:
+        value = values[order[i]]
+        # find the block of ties
+        j = i
+        while j + 1 < n_values and values[order[j + 1]] == value:
+            j += 1
+        if value < 0:
+            n_below_zero += j - i + 1
+        # positive values are ranked after the block of zeros
+        offset = n_zero if value > 0 else 0
+        for k in range(i, j + 1):
+            ranks[order[k]] = offset + (i + j + 2) / 2
+        i = j + 1
+    return ranks, n_below_zero + (n_zero + 1) / 2
+
+
+@njit(parallel=True)
+def _midranks_csc(data, indptr, n_obs):
+    """Rank the non-zero values of each column of a CSC matrix without explicit zeros"""
+    ranks = np.empty(data.size)
+    zero_ranks = np.empty(indptr.size - 1)
+    for j in prange(indptr.size - 1):
+        tmp_ranks, zero_ranks[j] = _midranks(data[indptr[j] : indptr[j + 1]], n_obs)
+        ranks[indptr[j] : indptr[j + 1]] = tmp_ranks
+    return ranks, zero_ranks
+
+
+@njit(parallel=True)
+def _midranks_dense(X):
+    """Rank the values of each column of a dense matrix"""
+    ranks = np.empty_like(X)
+    for j in prange(X.shape[1]):
+        ranks[:, j] = _midranks(X[:, j], X.shape[0])[0]
+    return ranks
+
+
+def _class_indicator(codes: np.ndarray, n_classes: int) -> scipy.sparse.csr_matrix:
+    """Sparse `n_classes x n_obs` matrix with a one where an observation belongs to a class"""
+    valid = np.flatnonzero(codes >= 0)
+    return scipy.sparse.csr_matrix(
+        (np.ones(valid.size), (codes[valid], valid)), shape=(n_classes, codes.size)
+    )
+
+
+def _roc_auc_matrix(X, codes: np.ndarray, n_classes: int) -> np.ndarray:
+    """
+    Compute the one-vs-rest ROC AUC of all classes and all columns of a (sparse) matrix at once.
+
+    The values of each column are ranked only once. The ROC AUC of a class is derived from the
+    sum of ranks of its observations (Mann-Whitney U statistic). For sparse matrices, only the
+    non-zero entries are ranked. Observations with a negative code are only used as negatives.
+
+    Returns
+    -------
+    `n_classes x n_vars` array
+    """
+    n_obs = codes.size
+    n_pos = np.bincount(codes[codes >= 0], minlength=n_classes).astype(np.float64)
+    if np.any(n_pos == 0) or np.any(n_pos == n_obs):
+        raise ValueError(
+            "Only one class present in y_true. ROC AUC score is not defined in that case."
+        )
+    indicator = _class_indicator(codes, n_classes)
+    if scipy.sparse.issparse(X):
+        X = scipy.sparse.csc_matrix(X, dtype=np.float64, copy=True)
+        X.eliminate_zeros()
+        ranks, zero_ranks = _midranks_csc(X.data, X.indptr, n_obs)
+        n_nonzero = np.asarray((indicator @ (X != 0).astype(np.float64)).todense())
+        X.data = ranks
+        rank_sums = (
+            np.asarray((indicator @ X).todense())
+            + (n_pos[:, np.newaxis] - n_nonzero) * zero_ranks
+        )
+    else:
+        rank_sums = indicator @ _midranks_dense(np.asfortranarray(X, dtype=np.float64))
+    n_pos = n_pos[:, np.newaxis]
+    return (rank_sums - n_pos * (n_pos + 1) / 2) / (n_pos * (n_obs - n_pos))
+
+
 def roc_auc(
     adata,
     *,
@@ -129,7 +224,10 @@ def roc_auc(
     """
     Compute the Receiver Operator Characteristics Area under the Curve (ROC AUC) for a single gene `G`.
     This tells how well the gene discriminates between the two classes.
-    This is a wrapper for the scikit-learn `roc_auc_score`_ function.
+
+    The ROC AUC of all genes is computed at once from the ranks of the values (Mann-Whitney U statistic),
+    in parallel over genes. Ties are assigned their average rank. This gives the same result as the
+    scikit-learn `roc_auc_score`_ function. For sparse matrices, only the non-zero values are ranked.
 
     Parameters
     ----------
@@ -151,12 +249,8 @@ def roc_auc(
     .. _roc_auc_score:
         http://scikit-learn.org/stable/modules/generated/sklearn.metrics.roc_auc_score.html#sklearn.metrics.roc_auc_score
     """
-
-    def _roc_auc(arr, mask):
-        return roc_auc_score(mask, arr)
-
-    positive_mask = adata.obs[obs_col] == positive_class
-    roc_auc = np.apply_along_axis(_roc_auc, 0, adata.X, positive_mask)
+    positive_mask = (adata.obs[obs_col] == positive_class).values
+    roc_auc = _roc_auc_matrix(adata.X, positive_mask.astype(np.int64) - 1, 1)[0, :]
 
     if inplace:
         adata.var[key_added] = roc_auc
@@ -164,6 +258,185 @@ def roc_auc(
         return roc_auc
 
 
+def marker_metrics(adata, obs_col, *, inplace=True):
+    """
+    Compute fold change, specific fold change and ROC AUC of all classes versus the rest at once.
+
+    Gives the same results as calling :func:`fold_change`, :func:`specific_fold_change` and
+    :func:`roc_auc` for each class, but the mean per class is computed only once
+    and the values of each gene are ranked only once.
+
+    Parameters
+    ----------
+    adata
+        annotated data matrix. Values in X are expected to be log-transformed and normalized
+    obs_col
+        Column in adata.obs with the annotation to compare. Observations without
+        annotation are only used as negatives.
+    inplace
+        If True, store the results in `adata.var` under `{class}_fc`, `{class}_sfc` and
+        `{class}_auroc`. Otherwise return a data frame with these columns.
+
+    Returns
+    -------
+    Data frame with one row per gene and three columns for each class.
+    """
+    codes, classes = pd.factorize(adata.obs[obs_col])
+    n_classes = len(classes)
+    if n_classes < 2:
+        raise ValueError("At least two classes are required.")
+    X = adata.X
+    indicator = _class_indicator(codes, n_classes)
+    n_obs = np.bincount(codes[codes >= 0], minlength=n_classes)[:, np.newaxis]
+    class_sums = indicator @ X
+    class_sums = (
+        class_sums.toarray()
+        if scipy.sparse.issparse(class_sums)
+        else np.asarray(class_sums)
+    )
+    total_sum = np.asarray(X.sum(axis=0)).reshape(1, -1)
+    class_means = class_sums / n_obs
+
+    fc = class_means - (total_sum - class_sums) / (codes.size - n_obs)
+
+    # min and max over the negative classes: use the second largest (smallest) mean
+    # if the positive class has the largest (smallest) mean.
+    order = np.argsort(class_means, axis=0, kind="stable")
+    col_idx = np.arange(class_means.shape[1])
+    class_idx = np.arange(n_classes)[:, np.newaxis]
+    x_min = np.where(
+        class_idx == order[0],
+        class_means[order[1], col_idx],
+        class_means[order[0], col_idx],
+    )
+    x_max = np.where(
+        class_idx == order[-1],
+        class_means[order[-2], col_idx],
+        class_means[order[-1], col_idx],
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sfc = (class_means - x_min) / (x_max - x_min)
+
+    auroc = _roc_auc_matrix(X, codes, n_classes)
+
+    res = pd.DataFrame(
+        {
+            f"{ct}_{metric}": values[i]
+            for i, ct in enumerate(classes)
+            for metric, values in [("fc", fc), ("sfc", sfc), ("auroc", auroc)]
+        },
+        index=adata.var_names,
+    )
+    if inplace:
+        for col in res.columns:
+            adata.var[col] = res[col]
+    else:
+        return res
+
+
+def score_gene_sets(
+    adata: AnnData,
+    gene_sets: Mapping[str, Sequence[str]],
+    *,
+    ctrl_size: int = 50,
+    n_bins: int = 25,
+    random_state: Optional[int] = 0,
+    use_raw: Optional[bool] = None,
+    chunk_size: int = 50000,
+    inplace: bool = True,
+):
+    """
+    Score multiple gene sets at once.
+
+    Equivalent to calling :func:`scanpy.tl.score_genes` for each gene set with the
+    same parameters: the score is the average expression of the genes in the set minus the average
+    expression of a set of control genes with a similar expression level. Expression bins are
+    computed only once and the control genes of each gene set are sampled with the same random
+    seed as `score_genes`. All gene sets are then scored with a single sparse matrix product,
+    in chunks of `chunk_size` cells.
+
+    The results are numerically equal to `score_genes` only if scanpy samples the control genes
+    the same way (tested with scanpy 1.11: one global seed, `pandas.Series.sample` per expression
+    bin). Other scanpy versions may choose different control genes. Only the parameters of
+    `score_genes` listed below are supported (e.g. no `gene_pool` or `layer`).
+
+    Parameters
+    ----------
+    adata
+        annotated data matrix. The expression values must not contain missing values.
+    gene_sets
+        Dictionary name -> list of genes. Genes that are not in `adata` are ignored.
+    ctrl_size
+        Number of control genes sampled from each expression bin
+    n_bins
+        Number of expression bins
+    random_state
+        Random seed for sampling the control genes. The same seed is used for each gene set.
+    use_raw
+        Use `adata.raw`. Defaults to True if `.raw` is present.
+    chunk_size
+        Number of cells that are processed at once
+    inplace
+        If True, store the scores in `adata.obs[name]`. Otherwise return them.
+
+    Returns
+    -------
+    Data frame with one column per gene set
+    """
+    if use_raw is None:
+        use_raw = adata.raw is not None
+    X = adata.raw.X if use_raw else adata.X
+    var_names = adata.raw.var_names if use_raw else adata.var_names
+
+    # average expression of all genes, the same way as in `score_genes`
+    if scipy.sparse.issparse(X):
+        gene_means = np.asarray(X.sum(axis=0, dtype=np.float64)).ravel() / X.shape[0]
+    else:
+        gene_means = np.nanmean(X, axis=0)
+    obs_avg = pd.Series(gene_means, index=var_names)
+    obs_avg = obs_avg[np.isfinite(obs_avg)]
+    n_items = int(np.round(len(obs_avg) / (n_bins - 1)))
+    obs_cut = obs_avg.rank(method="min") // n_items
+
+    weights = np.zeros((len(var_names), len(gene_sets)))
+    for i, (name, genes) in enumerate(gene_sets.items()):
+        gene_list = pd.Index([genes] if isinstance(genes, str) else genes).intersection(
+            var_names
+        )
+        if len(gene_list) == 0:
+            raise ValueError(f"No valid genes were passed for scoring {name}.")
+        # `score_genes` samples with `pd.Series.sample` from the global random state,
+        # which is reset for each gene set.
+        rs = np.random.RandomState(random_state)
+        control_genes = pd.Index([])
+        for cut in np.unique(obs_cut.loc[gene_list]):
+            r_genes = obs_cut.index[obs_cut.values == cut]
+            if ctrl_size < len(r_genes):
+                r_genes = r_genes[rs.choice(len(r_genes), ctrl_size, replace=False)]
+            control_genes = control_genes.union(r_genes.difference(gene_list))
+        if len(control_genes) == 0:
+            raise ValueError(f"No control genes found for {name}.")
+        weights[var_names.get_indexer(gene_list), i] = 1 / len(gene_list)
+        weights[var_names.get_indexer(control_genes), i] = -1 / len(control_genes)
+
+    weights = scipy.sparse.csc_matrix(weights)
+    scores = np.empty((X.shape[0], len(gene_sets)))
+    for start in range(0, X.shape[0], chunk_size):
+        tmp_scores = X[start : start + chunk_size] @ weights
+        scores[start : start + chunk_size] = (
+            tmp_scores.toarray()
+            if scipy.sparse.issparse(tmp_scores)
+            else np.asarray(tmp_scores)
+        )
+
+    res = pd.DataFrame(scores, index=adata.obs_names, columns=list(gene_sets))
+    if inplace:
+        for col in res.columns:
+            adata.obs[col] = res[col]
+    else:
+        return res
+
+
 class MCPSignatureRegressor:
     def __init__(
         self,
@@ -280,6 +553,113 @@ class MCPSignatureRegressor:
         return scipy.stats.pearsonr(true_fractions, predicted_scores)[0]
 
 
+def predict_signatures(
+    models: Union[Sequence[MCPSignatureRegressor], Mapping[str, MCPSignatureRegressor]],
+    X,
+    *,
+    var_names: Optional[Sequence[str]] = None,
+    obs_names: Optional[Sequence[str]] = None,
+    chunk_size: int = 1000,
+) -> pd.DataFrame:
+    """
+    Compute the signature scores of multiple fitted models at once.
+
+    Gives the same results as calling :meth:`MCPSignatureRegressor.predict` for each model,
+    but the data is neither copied nor loaded into memory at once. Mean and standard deviation
+    of the signature genes are computed in a single streaming pass over chunks of
+    `chunk_size` samples. In a second pass, the scores of all models are computed with a single matrix
+    product per chunk. The memory usage is bounded by the chunk size.
+
+    Parameters
+    ----------
+    models
+        List or dictionary of fitted :class:`MCPSignatureRegressor` models
+    X
+        samples x genes matrix. Either an AnnData object (which may be backed) or an array-like
+        that supports slicing rows, e.g. a numpy array, `np.memmap`, a h5py or zarr array.
+    var_names
+        gene names of the columns of `X`. Required if `X` is not an AnnData object.
+    obs_names
+        names of the samples. Taken from `X` if it is an AnnData object.
+    chunk_size
+        Number of samples that are processed at once.
+
+    Returns
+    -------
+    Data frame samples x models with the signature scores. Columns are the keys of
+    `models` if it is a dictionary.
+    """
+    if isinstance(X, AnnData):
+        var_names, obs_names = X.var_names, X.obs_names
+        X = _get_matrix(X)
+    if var_names is None:
+        raise ValueError("var_names must be specified if X is not an AnnData object.")
+    var_names = pd.Index(var_names)
+    names = list(models.keys()) if isinstance(models, Mapping) else None
+    models = list(models.values()) if isinstance(models, Mapping) else list(models)
+
+    genes = pd.Index(
+        pd.unique(
+            np.concatenate([np.array(m.signature_genes, dtype=object) for m in models])
+        )
+    )
+    cols = var_names.get_indexer(genes)
+    if np.any(cols < 0):
+        raise ValueError(
+            f"Signature genes not in var_names: {genes[cols < 0].tolist()}"
+        )
+    n_obs = X.shape[0]
+
+    def _chunks():
+        for start in range(0, n_obs, chunk_size):
+            chunk = X[start : start + chunk_size]
+            chunk = chunk[:, cols]
+            yield start, (
+                chunk.toarray() if scipy.sparse.issparse(chunk) else np.asarray(chunk)
+            ).astype(np.float64)
+
+    # running mean and sum of squared deviations (Chan et al.)
+    n_total = 0
+    mean = np.zeros(genes.size)
+    m2 = np.zeros(genes.size)
+    for _, chunk in _chunks():
+        n_chunk = chunk.shape[0]
+        chunk_mean = np.mean(chunk, axis=0)
+        delta = chunk_mean - mean
+        n_new = n_total + n_chunk
+        mean = mean + delta * n_chunk / n_new
+        m2 = (
+            m2
+            + np.sum((chunk - chunk_mean) ** 2, axis=0)
+            + delta**2 * n_total * n_chunk / n_new
+        )
+        n_total = n_new
+    # population standard deviation (`ddof=0`), consistent with `scipy.stats.zscore`
+    std = np.sqrt(m2 / n_total)
+    # genes without a z-score (constant within numerical precision, as in `scipy.stats.zscore`)
+    # are ignored, see `MCPSignatureRegressor.predict`
+    has_zscore = np.isfinite(std) & (std > np.abs(np.finfo(np.float64).eps * mean))
+
+    # the score is the mean z-score of the signature genes: z @ W = x @ (W / std) - (mean / std) @ W
+    W = np.zeros((genes.size, len(models)))
+    for i, m in enumerate(models):
+        idx = genes.get_indexer(m.signature_genes)
+        idx = idx[has_zscore[idx]]
+        if idx.size:
+            W[idx, i] = 1 / idx.size
+        else:
+            W[:, i] = np.nan
+    W = W / np.where(has_zscore, std, 1)[:, np.newaxis]
+    offset = np.where(has_zscore, mean, 0) @ W
+
+    scores = np.empty((n_obs, len(models)))
+    for start, chunk in _chunks():
+        chunk[:, ~has_zscore] = 0
+        scores[start : start + chunk.shape[0]] = chunk @ W - offset
+
+    return pd.DataFrame(scores, index=obs_names, columns=names)
+
+
 def train_test_split(adata, *, replicate_col: str):
     """
     Split anndata object by replicates into test and train dataset.
@@ -335,16 +715,9 @@ def _grid_search_cv_execute_fold(
     )
 
     print("Evaluating grid")
-    for params in grid:
-        mcpr = MCPSignatureRegressor(**params)
-        mcpr.fit(pb_train)
-        n_genes = len(mcpr.signature_genes)
-        if not n_genes:
-            score_pearson = np.nan
-        else:
-            y_pred = mcpr.predict(pb_test)
-            score_pearson = mcpr.score_pearson(pb_test.obs["true_frac"].values, y_pred)
-
+    for params, (n_genes, score_pearson) in zip(
+        grid, _evaluate_grid(pb_train, pb_test, grid)
+    ):
         results.append(
             {
                 "fold": i,
@@ -357,6 +730,88 @@ def _grid_search_cv_execute_fold(
     return results
 
 
+#: Parameters of :class:`MCPSignatureRegressor` that are cutoffs on columns of `adata.var`
+_GRID_CUTOFFS = {
+    "min_fc": "fold_change",
+    "min_sfc": "specific_fold_change",
+    "min_auroc": "roc_auc",
+}
+
+
+def _evaluate_grid(pb_train, pb_test, grid):
+    """
+    Fit and evaluate a :class:`MCPSignatureRegressor` for each parameter combination in `grid`.
+
+    Returns a list of tuples `(n_genes, score_pearson)`.
+
+    If the grid only contains cutoffs, all combinations are evaluated at once: the test data
+    is z-scored only once, each combination is represented by a mask of signature genes, and
+    the predictions of all combinations are computed with a single matrix product.
+    Otherwise, a model is fitted for each combination.
+    """
+    if not all(k in _GRID_CUTOFFS for params in grid for k in params):
+        results = []
+        for params in grid:
+            mcpr = MCPSignatureRegressor(**params)
+            mcpr.fit(pb_train)
+            n_genes = len(mcpr.signature_genes)
+            if not n_genes:
+                score_pearson = np.nan
+            else:
+                y_pred = mcpr.predict(pb_test)
+                score_pearson = mcpr.score_pearson(
+                    pb_test.obs["true_frac"].values, y_pred
+                )
+            results.append((n_genes, score_pearson))
+        return results
+
+    defaults = MCPSignatureRegressor()
+    defaults._check_adata(pb_train)
+    cutoffs = {
+        param: np.array(
+            [params.get(param, getattr(defaults, param)) for params in grid]
+        )
+        for param in _GRID_CUTOFFS
+    }
+    metrics = {
+        param: pb_train.var[col].values.astype(np.float64)
+        for param, col in _GRID_CUTOFFS.items()
+    }
+    # only genes that pass the most lenient cutoffs can be signature genes
+    candidates = np.ones(pb_train.n_vars, dtype=bool)
+    for param in _GRID_CUTOFFS:
+        candidates &= metrics[param] >= np.min(cutoffs[param])
+    masks = np.ones((len(grid), np.sum(candidates)), dtype=bool)
+    for param in _GRID_CUTOFFS:
+        masks &= metrics[param][candidates] >= cutoffs[param][:, np.newaxis]
+    n_genes = np.sum(masks, axis=1)
+
+    X = pb_test[:, pb_train.var_names[candidates]].X
+    X = X.toarray() if scipy.sparse.issparse(X) else np.asarray(X)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        Z = scipy.stats.zscore(X, axis=0)
+    # genes without a z-score are ignored, see `MCPSignatureRegressor.predict`
+    has_zscore = ~np.any(np.isnan(Z), axis=0)
+    masks_valid = masks & has_zscore
+    with np.errstate(divide="ignore", invalid="ignore"):
+        y_pred = (masks_valid @ np.where(has_zscore, Z, 0).T) / np.sum(
+            masks_valid, axis=1, keepdims=True
+        )
+
+    # pearson correlation of all predictions with the true fractions
+    y_true = pb_test.obs["true_frac"].values.astype(np.float64)
+    y_true = y_true - np.mean(y_true)
+    y_pred = y_pred - np.mean(y_pred, axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        score_pearson = np.clip(
+            (y_pred @ y_true) / np.sqrt(np.sum(y_pred**2, axis=1) * np.sum(y_true**2)),
+            -1,
+            1,
+        )
+    score_pearson[n_genes == 0] = np.nan
+    return list(zip(n_genes.tolist(), score_pearson.tolist()))
+
+
 def grid_search_cv(
     adata: AnnData,
     *,
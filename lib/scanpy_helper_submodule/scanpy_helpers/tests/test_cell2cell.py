@@ -0,0 +1,135 @@
+from scanpy_helpers.cell2cell import CpdbAnalysis
+from scanpy_helpers.util import fdr_correction
+from anndata import AnnData
+import pytest
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import pandas.testing as pdt
+
+
+@pytest.fixture
+def cpdba():
+    rng = np.random.default_rng(0)
+    genes = [f"g{i}" for i in range(30)]
+    X = rng.poisson(0.5, size=(1200, 30)).astype(np.float32)
+    adata = AnnData(
+        X=sp.csr_matrix(X),
+        obs=pd.DataFrame(
+            {
+                "patient": rng.choice([f"p{i}" for i in range(12)], 1200),
+                "cell_type": rng.choice(["A", "B", "C", "D"], 1200),
+            },
+            index=[f"c{i}" for i in range(1200)],
+        ),
+        var=pd.DataFrame(index=genes),
+    )
+    cpdb = pd.DataFrame(
+        {
+            # includes genes not measured in adata and duplicated interactions
+            "source_genesymbol": rng.choice(genes[:15] + ["x1"], 60),
+            "target_genesymbol": rng.choice(genes[10:] + ["x2"], 60),
+        },
+        index=[f"i{i}" for i in range(60)],
+    )
+    return CpdbAnalysis(
+        cpdb, adata, pseudobulk_group_by=["patient"], cell_type_column="cell_type"
+    )
+
+
+@pytest.fixture
+def de_res():
+    rng = np.random.default_rng(1)
+    return pd.DataFrame(
+        {
+            "gene_id": [f"g{i}" for i in range(30)] + ["x1", "x2"],
+            "pvalue": rng.uniform(0, 0.2, 32),
+            "log2FoldChange": rng.normal(scale=2, size=32),
+        }
+    )
+
+
+def _significant_interactions_merge(
+    cpdba,
+    de_res,
+    *,
+    max_pvalue=0.1,
+    min_abs_fc=1,
+    min_frac_expressed=0.1,
+    de_genes_mode="ligand",
+):
+    """Reference implementation based on merging the long-format table"""
+    cpdb_de_col, cpdb_expr_col = ["source_genesymbol", "target_genesymbol"][
+        :: 1 if de_genes_mode == "ligand" else -1
+    ]
+    de_res = de_res.loc[lambda x: x["gene_id"].isin(cpdba.cpdb[cpdb_de_col])]
+    de_res = fdr_correction(de_res, pvalue_col="pvalue", key_added="fdr")
+    significant_genes = de_res.loc[
+        lambda x: (x["fdr"] < max_pvalue) & (np.abs(x["log2FoldChange"]) >= min_abs_fc),
+        "gene_id",
+    ].unique()
+    return (
+        cpdba.expressed_genes.loc[
+            lambda x: x["fraction_expressed"] >= min_frac_expressed
+        ]
+        .merge(
+            cpdba.cpdb.loc[lambda x: x[cpdb_de_col].isin(significant_genes)],
+            left_on="variable",
+            right_on=cpdb_expr_col,
+        )
+        .drop(columns=["variable"])
+        .merge(de_res, left_on=cpdb_de_col, right_on="gene_id")
+        .drop(columns=["gene_id"])
+    )
+
+
+def test_expressed_genes(cpdba):
+    assert cpdba.fraction_expressed.shape == cpdba.expr_mean.shape == (4, 30)
+    assert cpdba.expressed_genes.shape == (4 * 30, 4)
+    assert np.all(
+        (cpdba.fraction_expressed.values >= 0) & (cpdba.fraction_expressed.values <= 1)
+    )
+
+
+@pytest.mark.parametrize("de_genes_mode", ["ligand", "receptor"])
+@pytest.mark.parametrize("min_frac_expressed", [0, 0.35, 1.1])
+def test_significant_interactions(cpdba, de_res, de_genes_mode, min_frac_expressed):
+    kwargs = dict(
+        max_pvalue=0.5,
+        min_frac_expressed=min_frac_expressed,
+        de_genes_mode=de_genes_mode,
+    )
+    expected = _significant_interactions_merge(cpdba, de_res, **kwargs)
+    res = cpdba.significant_interactions(de_res, **kwargs)
+    if min_frac_expressed < 1:
+        assert res.shape[0] > 0
+    pdt.assert_frame_equal(res, expected, check_index_type=False)
+
+
+def test_significant_interactions_invalid_mode(cpdba, de_res):
+    with pytest.raises(ValueError):
+        cpdba.significant_interactions(de_res, de_genes_mode="foo")
+
+
+def test_significant_interactions_batch(cpdba, de_res):
+    de_res2 = de_res.assign(pvalue=lambda x: x["pvalue"][::-1].values)
+    res = cpdba.significant_interactions_batch(
+        {"cmp1": de_res, "cmp2": de_res2}, max_pvalue=0.5, key_added="group"
+    )
+    expected = pd.concat(
+        [
+            cpdba.significant_interactions(de_res, max_pvalue=0.5).assign(group="cmp1"),
+            cpdba.significant_interactions(de_res2, max_pvalue=0.5).assign(
+                group="cmp2"
+            ),
+        ],
+        ignore_index=True,
+    )
+    pdt.assert_frame_equal(res, expected.loc[:, res.columns])
+    assert res.columns[0] == "group"
+
+    res_list = cpdba.significant_interactions_batch([de_res, de_res2], max_pvalue=0.5)
+    assert res_list["comparison"].unique().tolist() == [0, 1]
+
+    with pytest.raises(ValueError):
+        cpdba.significant_interactions_batch({})
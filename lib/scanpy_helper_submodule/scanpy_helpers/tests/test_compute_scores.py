@@ -0,0 +1,449 @@
+from scanpy_helpers import compare_groups
+from scanpy_helpers.compare_groups import compute_scores, prepare_dataset
+from anndata import AnnData
+import anndata
+import pytest
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import numpy.testing as npt
+import pandas.testing as pdt
+
+
+@pytest.fixture(params=[np.array, sp.csr_matrix])
+def adata_lognorm(request):
+    rng = np.random.default_rng(0)
+    X = rng.poisson(0.5, size=(50, 30)).astype(float)
+    X = np.log1p(X)
+    adata = AnnData(
+        X=request.param(X),
+        obs=pd.DataFrame(index=[f"c{i}" for i in range(50)]),
+        var=pd.DataFrame(index=[f"g{i}" for i in range(30)]),
+    )
+    adata.raw = adata
+    return adata[:, :10].copy()
+
+
+@pytest.fixture
+def networks():
+    rng = np.random.default_rng(1)
+    # genes g25-g34 are partially not in the data
+    genes = [f"g{i}" for i in range(35)]
+    network1 = pd.DataFrame(
+        rng.normal(size=(35, 4)) * (rng.random((35, 4)) < 0.5),
+        index=genes,
+        columns=["p1", "p2", "p3", "p4"],
+    )
+    # too few targets
+    network1["p4"] = 0.0
+    network1.loc["g0", "p4"] = 1
+    network2 = pd.DataFrame(
+        rng.choice([-1, 0, 1], size=(20, 3)),
+        index=genes[10:30],
+        columns=["tf1", "tf2", "tf3"],
+    )
+    return {"net1": network1, "net2": network2}
+
+
+def _score_network_reference(adata, network, *, center, norm, scale, min_size):
+    """Dense reference implementation following progeny-py/dorothea-py"""
+    X = adata.raw.X
+    X = X.toarray() if sp.issparse(X) else X
+    genes = adata.raw.var_names
+    network = network.loc[network.index.isin(genes)]
+    network = network.loc[:, (network != 0).sum(axis=0) >= min_size]
+    X = X[:, genes.get_indexer(network.index)]
+    if center:
+        X = X - np.mean(X, axis=1).reshape(-1, 1)
+    if norm:
+        norm_factor = np.sum(np.abs(network), axis=0)
+        norm_factor[norm_factor == 0] = 1
+        network = network / norm_factor
+    estimate = X.dot(network.values)
+    if scale:
+        estimate = (estimate - np.mean(estimate, axis=0)) / np.std(
+            estimate, axis=0, ddof=1
+        )
+    return pd.DataFrame(estimate, index=adata.obs_names, columns=network.columns)
+
+
+@pytest.mark.parametrize("center", [True, False])
+@pytest.mark.parametrize("norm", [True, False])
+@pytest.mark.parametrize("scale", [True, False])
+@pytest.mark.parametrize("chunk_size", [7, 50000])
+def test_score_networks(adata_lognorm, networks, center, norm, scale, chunk_size):
+    adata_orig = adata_lognorm.copy()
+    res = compute_scores.score_networks(
+        adata_lognorm,
+        networks,
+        center=center,
+        norm=norm,
+        scale=scale,
+        min_size=5,
+        chunk_size=chunk_size,
+    )
+    assert list(res) == ["net1", "net2"]
+    for name, network in networks.items():
+        pdt.assert_frame_equal(
+            res[name],
+            _score_network_reference(
+                adata_lognorm,
+                network,
+                center=center,
+                norm=norm,
+                scale=scale,
+                min_size=5,
+            ),
+        )
+    assert "p4" not in res["net1"].columns
+    # the input is not modified
+    npt.assert_array_equal(
+        (
+            adata_orig.raw.X.toarray()
+            if sp.issparse(adata_orig.raw.X)
+            else adata_orig.raw.X
+        ),
+        (
+            adata_lognorm.raw.X.toarray()
+            if sp.issparse(adata_lognorm.raw.X)
+            else adata_lognorm.raw.X
+        ),
+    )
+
+
+@pytest.fixture
+def adata_constant():
+    """Targets of source `const` are not expressed"""
+    rng = np.random.default_rng(0)
+    X = np.log1p(rng.poisson(0.5, size=(50, 30)).astype(float))
+    X[:, 20:26] = 0
+    adata = AnnData(X=X, var=pd.DataFrame(index=[f"g{i}" for i in range(30)]))
+    adata.raw = adata
+    network = pd.DataFrame(0.0, index=adata.var_names, columns=["const", "var"])
+    network.iloc[20:26, 0] = 1
+    network.iloc[0:6, 1] = 1
+    return adata, {"net": network}
+
+
+@pytest.mark.parametrize("n_obs", [1, 2, 50])
+def test_score_networks_constant(adata_constant, n_obs):
+    """Constant scores and single observations don't result in inf or NaN"""
+    adata, networks = adata_constant
+    res = compute_scores.score_networks(adata[:n_obs], networks, center=False)["net"]
+    npt.assert_array_equal(res["const"], 0)
+    if n_obs == 1:
+        npt.assert_array_equal(res["var"], 0)
+    else:
+        npt.assert_allclose(np.std(res["var"], ddof=1), 1)
+
+
+def test_run_tools(adata_lognorm, networks, monkeypatch):
+    compute_scores._network_from_model.cache_clear()
+    monkeypatch.setitem(compute_scores._MODELS, "progeny", lambda: networks["net1"])
+    monkeypatch.setitem(compute_scores._MODELS, "dorothea", lambda: networks["net2"])
+    res = compute_scores.run_tools(adata_lognorm, ["progeny", "dorothea"])
+    assert list(res) == ["progeny", "dorothea"]
+    for tool, network in zip(res, networks.values()):
+        assert res[tool].obs_names.equals(adata_lognorm.obs_names)
+        pdt.assert_frame_equal(
+            res[tool].to_df(),
+            _score_network_reference(
+                adata_lognorm, network, center=True, norm=True, scale=True, min_size=5
+            ),
+            check_names=False,
+        )
+
+
+def test_compiled_networks(adata_lognorm, networks, monkeypatch, tmp_path):
+    monkeypatch.setitem(compute_scores._MODELS, "progeny", lambda: networks["net1"])
+    monkeypatch.setitem(compute_scores._MODELS, "dorothea", lambda: networks["net2"])
+    compute_scores._network_from_model.cache_clear()
+    compute_scores.compile_networks(tmp_path, ["progeny", "dorothea"])
+
+    network = compute_scores.load_network("progeny", tmp_path)
+    # memory-mapped (read-only) rather than loaded into memory
+    assert not network.weights.data.flags.owndata
+    assert not network.weights.data.flags.writeable
+    pdt.assert_frame_equal(network.to_dataframe(), networks["net1"])
+    # cached
+    assert compute_scores.load_network("progeny", tmp_path) is network
+
+    res = compute_scores.run_tools(adata_lognorm, ["progeny", "dorothea"])
+    res_compiled = compute_scores.run_tools(
+        adata_lognorm, ["progeny", "dorothea"], network_dir=tmp_path
+    )
+    for tool in res:
+        pdt.assert_frame_equal(res[tool].to_df(), res_compiled[tool].to_df())
+    compute_scores._network_from_model.cache_clear()
+
+
+def test_network_alignment_cache(adata_lognorm, networks):
+    network = compute_scores.Network.from_dataframe(networks["net1"])
+    var_names = adata_lognorm.raw.var_names
+    res = compute_scores._network_weights(network, var_names, min_size=5, norm=True)
+    assert (
+        compute_scores._network_weights(
+            network, var_names.copy(), min_size=5, norm=True
+        )
+        is res
+    )
+    assert (
+        compute_scores._network_weights(network, var_names[::-1], min_size=5, norm=True)
+        is not res
+    )
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_prepare_dataset(adata_lognorm, networks, monkeypatch, n_jobs):
+    monkeypatch.setitem(compute_scores._MODELS, "progeny", lambda: networks["net1"])
+    monkeypatch.setitem(compute_scores._MODELS, "dorothea", lambda: networks["net2"])
+    compute_scores._network_from_model.cache_clear()
+    rng = np.random.default_rng(2)
+    adata_lognorm.obs["cell_type"] = rng.choice(
+        ["T", "B", "other"], adata_lognorm.n_obs
+    )
+    adata_lognorm.obs["status"] = rng.choice(["a", "b", np.nan], adata_lognorm.n_obs)
+    # input is a view
+    adata = adata_lognorm[5:, :]
+
+    res = prepare_dataset(
+        "test",
+        dataset=adata,
+        cell_type_column="cell_type",
+        tools=["progeny", "dorothea"],
+        column_to_test="status",
+        n_jobs=n_jobs,
+    )
+
+    assert list(res) == ["progeny", "dorothea"]
+    adata_filtered = adata[
+        (adata.obs["cell_type"] != "other") & (adata.obs["status"] != "nan")
+    ].copy()
+    for ct in ["T", "B"]:
+        expected = compute_scores.run_tools(
+            adata_filtered[adata_filtered.obs["cell_type"] == ct].copy(),
+            ["progeny", "dorothea"],
+        )
+        for tool in res:
+            actual = res[tool][ct]
+            pdt.assert_frame_equal(actual.to_df(), expected[tool].to_df())
+            assert actual.obs["status"].dtype == "category"
+            assert set(actual.obs["status"]) <= {"a", "b"}
+    compute_scores._network_from_model.cache_clear()
+
+
+@pytest.mark.parametrize("fmt", [np.array, sp.csr_matrix, sp.csc_matrix])
+def test_raw_csr_rows(fmt, tmp_path):
+    rng = np.random.default_rng(0)
+    X = rng.poisson(0.5, size=(20, 5)).astype(float)
+    adata = AnnData(X=fmt(X))
+    adata.raw = adata
+    rows = np.array([7, 3, 3, 12])
+    X_rows, positions = compare_groups._raw_csr_rows(adata, rows)
+    assert sp.isspmatrix_csr(X_rows)
+    # only the needed rows are copied
+    assert X_rows.shape == (3, 5)
+    npt.assert_array_equal(X_rows[positions].toarray(), X[rows])
+
+    X_all, positions = compare_groups._raw_csr_rows(adata, np.arange(20))
+    npt.assert_array_equal(X_all[positions].toarray(), X)
+    if fmt is sp.csr_matrix:
+        # no conversion copy
+        assert np.shares_memory(X_all.data, adata.raw.X.data)
+
+    adata.write_h5ad(tmp_path / "adata.h5ad")
+    with pytest.raises(ValueError):
+        compare_groups._raw_csr_rows(
+            anndata.read_h5ad(tmp_path / "adata.h5ad", backed="r"), rows
+        )
+
+
+@pytest.mark.parametrize("backed", [False, True])
+def test_run_comparisons(networks, monkeypatch, tmp_path, backed):
+    monkeypatch.setitem(compute_scores._MODELS, "progeny", lambda: networks["net1"])
+    monkeypatch.setitem(compute_scores._MODELS, "dorothea", lambda: networks["net2"])
+    compute_scores._network_from_model.cache_clear()
+    rng = np.random.default_rng(3)
+    n_obs = 1200
+    patient = rng.choice([f"p{i}" for i in range(12)], n_obs)
+    patient_idx = np.array([int(p[1:]) for p in patient])
+    obs = pd.DataFrame(
+        {
+            "cell_type": rng.choice(["T", "B", "other"], n_obs),
+            "patient": patient,
+            "dataset": np.where(patient_idx % 2, "d1", "d2"),
+            "status": np.array(["a", "b", "a", "b", "a", "b"] * 2, dtype=object)[
+                patient_idx
+            ],
+            "stage": np.array(["early", "late", "late"] * 4, dtype=object)[patient_idx],
+        },
+        index=[f"c{i}" for i in range(n_obs)],
+    )
+    obs.loc[obs["patient"] == "p11", "status"] = np.nan
+    adata = AnnData(
+        X=sp.csr_matrix(np.log1p(rng.poisson(0.5, size=(n_obs, 30)).astype(float))),
+        obs=obs,
+        var=pd.DataFrame(index=[f"g{i}" for i in range(30)]),
+    )
+    adata.raw = adata
+    comparisons = {
+        "status": {
+            "dataset": adata,
+            "cell_type_column": "cell_type",
+            "pseudobulk_group_by": ["dataset", "patient"],
+            "column_to_test": "status",
+            "lm_covariate_str": "+ dataset",
+            "contrasts": "Treatment('a')",
+            "tools": ["progeny", "dorothea"],
+        },
+        "status_sum": {
+            "dataset": adata,
+            "cell_type_column": "cell_type",
+            "pseudobulk_group_by": ["dataset", "patient"],
+            "column_to_test": "status",
+            "lm_covariate_str": "+ dataset",
+            "contrasts": "Sum",
+            "tools": ["dorothea"],
+        },
+        "stage": {
+            "dataset": adata[adata.obs["patient"] != "p0", :],
+            "cell_type_column": "cell_type",
+            "pseudobulk_group_by": ["patient"],
+            "column_to_test": "stage",
+            "lm_covariate_str": "",
+            "contrasts": "Treatment('early')",
+            "tools": ["progeny"],
+        },
+    }
+
+    score_store = compare_groups.score_cells(
+        adata[5:, :], tools=["progeny", "dorothea"], n_jobs=2
+    )
+    assert score_store.obs_names.equals(adata.obs_names[5:])
+    assert list(score_store.var["tool"].unique()) == ["progeny", "dorothea"]
+    if backed:
+        score_store.write_h5ad(tmp_path / "scores.h5ad")
+        score_store = anndata.read_h5ad(tmp_path / "scores.h5ad", backed="r")
+
+    comparisons = {
+        k: dict(
+            v, dataset=v["dataset"][v["dataset"].obs_names.isin(adata.obs_names[5:])]
+        )
+        for k, v in comparisons.items()
+    }
+    res = compare_groups.run_comparisons(score_store, comparisons)
+    assert list(res) == list(comparisons)
+    for id_, config in comparisons.items():
+        expected = compare_groups.compare_signatures(
+            id_, prepare_dataset(id_, **config), **config
+        )
+        assert list(res[id_]) == config["tools"]
+        for tool in res[id_]:
+            pdt.assert_frame_equal(
+                res[id_][tool]
+                .sort_values(["cell_type", "variable", "group"])
+                .reset_index(drop=True),
+                expected[tool]
+                .sort_values(["cell_type", "variable", "group"])
+                .reset_index(drop=True),
+            )
+    compute_scores._network_from_model.cache_clear()
+
+
+def test_run_comparisons_constant():
+    """Scores that are constant within a cell-type don't result in inf or NaN pseudobulks"""
+    rng = np.random.default_rng(4)
+    n_obs = 600
+    patient = rng.choice([f"p{i}" for i in range(12)], n_obs)
+    obs = pd.DataFrame(
+        {
+            "cell_type": rng.choice(["T", "B"], n_obs),
+            "patient": patient,
+            "status": np.where(np.isin(patient, ["p0", "p2", "p4", "p6"]), "a", "b"),
+        },
+        index=[f"c{i}" for i in range(n_obs)],
+    )
+    X = rng.normal(size=(n_obs, 3))
+    X[:, 1] = 0.1
+    var = pd.DataFrame({"tool": "progeny", "source": ["s1", "s2", "s3"]})
+    var.index = var["tool"] + ":" + var["source"]
+    score_store = AnnData(X=X, obs=obs, var=var)
+    comparisons = {
+        "status": {
+            "dataset": score_store,
+            "cell_type_column": "cell_type",
+            "pseudobulk_group_by": ["patient"],
+            "column_to_test": "status",
+            "lm_covariate_str": "",
+            "contrasts": "Treatment('a')",
+            "tools": ["progeny"],
+        }
+    }
+    res = compare_groups.run_comparisons(score_store, comparisons)["status"]["progeny"]
+    assert set(res["cell_type"]) == {"T", "B"}
+    assert np.all(np.isfinite(res.select_dtypes("number").fillna(0)))
+    assert np.all(np.isnan(res.loc[lambda x: x["variable"] == "s2", "pvalue"]))
+    assert np.all(np.isfinite(res.loc[lambda x: x["variable"] != "s2", "pvalue"]))
+
+
+@pytest.mark.parametrize("scale", [True, False])
+@pytest.mark.parametrize("n_jobs", [1, 3])
+def test_score_h5ad(adata_lognorm, networks, monkeypatch, tmp_path, scale, n_jobs):
+    monkeypatch.setitem(compute_scores._MODELS, "progeny", lambda: networks["net1"])
+    monkeypatch.setitem(compute_scores._MODELS, "dorothea", lambda: networks["net2"])
+    compute_scores._network_from_model.cache_clear()
+    path = tmp_path / "adata.h5ad"
+    adata_lognorm.write_h5ad(path)
+
+    compute_scores.score_h5ad(
+        path,
+        ["progeny", "dorothea"],
+        chunk_size=7,
+        n_jobs=n_jobs,
+        scale=scale,
+        dtype=np.float64,
+    )
+    # scoring again overwrites the existing results
+    compute_scores.score_h5ad(
+        path,
+        ["progeny", "dorothea"],
+        chunk_size=7,
+        n_jobs=n_jobs,
+        scale=scale,
+        dtype=np.float64,
+    )
+
+    adata = anndata.read_h5ad(path)
+    expected = compute_scores.score_networks(
+        adata_lognorm,
+        {"progeny": networks["net1"], "dorothea": networks["net2"]},
+        scale=scale,
+    )
+    for tool, df in expected.items():
+        npt.assert_allclose(adata.obsm[tool], df.values)
+        assert list(adata.uns[f"{tool}_sources"]) == list(df.columns)
+    assert adata.raw.shape == adata_lognorm.raw.shape
+    npt.assert_array_equal(
+        sp.csr_matrix(adata.X).toarray(), sp.csr_matrix(adata_lognorm.X).toarray()
+    )
+    compute_scores._network_from_model.cache_clear()
+
+
+@pytest.mark.parametrize("n_obs", [1, 5])
+def test_score_h5ad_constant(networks, monkeypatch, tmp_path, n_obs):
+    """Cells with the same expression (constant scores) are scaled the same way as in memory"""
+    monkeypatch.setitem(compute_scores._MODELS, "progeny", lambda: networks["net1"])
+    compute_scores._network_from_model.cache_clear()
+    rng = np.random.default_rng(0)
+    X = np.repeat(np.log1p(rng.poisson(0.5, size=(1, 30))), n_obs, axis=0)
+    adata = AnnData(X=X, var=pd.DataFrame(index=[f"g{i}" for i in range(30)]))
+    adata.raw = adata
+    path = tmp_path / "adata.h5ad"
+    adata.write_h5ad(path)
+
+    compute_scores.score_h5ad(path, ["progeny"], chunk_size=2, dtype=np.float64)
+    res = anndata.read_h5ad(path).obsm["progeny"]
+    expected = compute_scores.score_networks(adata, {"progeny": networks["net1"]})
+    npt.assert_array_equal(res, 0)
+    npt.assert_array_equal(expected["progeny"].values, 0)
+    compute_scores._network_from_model.cache_clear()
@@ -0,0 +1,457 @@
+from scanpy_helpers.compare_groups import lm, compare_signatures
+from anndata import AnnData
+import statsmodels.formula.api as smf
+from statsmodels.regression.linear_model import RegressionResultsWrapper
+import pytest
+import patsy
+import scipy.stats
+import numpy as np
+import pandas as pd
+import numpy.testing as npt
+import pandas.testing as pdt
+
+
+@pytest.fixture
+def adata_pseudobulk():
+    rng = np.random.default_rng(0)
+    n_obs = 24
+    X = rng.normal(size=(n_obs, 5))
+    X[:, 0] += np.repeat([0, 1, 2], 8)
+    X[3, 4] = np.nan
+    return AnnData(
+        X=X,
+        obs=pd.DataFrame(index=[str(i) for i in range(n_obs)]).assign(
+            group=np.repeat(["A", "B", "C"], 8),
+            dataset=np.tile(["d1", "d2", "d3", "d4"], 6),
+            age=rng.normal(size=n_obs),
+        ),
+        var=pd.DataFrame(index=["x", "y", "z", "w", "v"]),
+    )
+
+
+def _test_lm_statsmodels(pseudobulk, formula, groupby, contrasts, robust):
+    """Reference implementation fitting one statsmodels model per variable"""
+    df = pseudobulk.obs.join(
+        pd.DataFrame(
+            pseudobulk.X, index=pseudobulk.obs_names, columns=pseudobulk.var_names
+        )
+    )
+    all_groups = sorted(pseudobulk.obs[groupby].unique())
+    groups_to_test = (
+        all_groups
+        if contrasts.startswith("Sum")
+        else [g for g in all_groups if g not in contrasts]
+    )
+    keys = [f"C({groupby}, {contrasts})[{contrasts[0]}.{g}]" for g in groups_to_test]
+    results = []
+    for col in pseudobulk.var_names:
+        res = smf.ols(formula=f"Q('{col}') {formula}", data=df).fit()
+        if robust:
+            res = RegressionResultsWrapper(res.get_robustcov_results(cov_type="HC3"))
+        coefs = res.params[keys].tolist() if not contrasts.startswith("Sum") else []
+        pvals = res.pvalues[keys].tolist() if not contrasts.startswith("Sum") else []
+        if contrasts.startswith("Sum"):
+            coefs = res.params[keys[:-1]].tolist()
+            pvals = res.pvalues[keys[:-1]].tolist()
+            coefs.append(-sum(coefs))
+            pvals.append(float(res.f_test(" + ".join(keys[:-1]) + " = 0").pvalue))
+        results.append(
+            pd.DataFrame(
+                {
+                    "coef": coefs,
+                    "intercept": res.params["Intercept"],
+                    "pvalue": pvals,
+                    "variable": col,
+                    "group": groups_to_test,
+                },
+                index=keys,
+            )
+        )
+    return pd.concat(results)
+
+
+@pytest.mark.parametrize("contrasts", ["Sum", "Treatment('A')", "Treatment('C')"])
+@pytest.mark.parametrize("covariates", ["", "+ dataset", "+ age"])
+@pytest.mark.parametrize("robust", [False, True])
+def test_test_lm_statsmodels(adata_pseudobulk, contrasts, covariates, robust):
+    """The batched linear model gives the same results as statsmodels"""
+    formula = f"~ C(group, {contrasts}) {covariates}"
+    res = lm.test_lm(
+        adata_pseudobulk,
+        formula,
+        "group",
+        contrasts=contrasts,
+        robust=robust,
+        n_jobs=1,
+        progress=False,
+    )
+    res_expected = _test_lm_statsmodels(
+        adata_pseudobulk, formula, "group", contrasts, robust
+    )
+    pdt.assert_frame_equal(res, res_expected)
+
+
+def test_test_lm_parallel(adata_pseudobulk):
+    formula = "~ C(group, Sum) + dataset"
+    res = lm.test_lm(adata_pseudobulk, formula, "group", n_jobs=1)
+    res_chunked = lm.test_lm(adata_pseudobulk, formula, "group", n_jobs=2, chunksize=2)
+    pdt.assert_frame_equal(res, res_chunked)
+
+
+def test_test_lm_small_sequential(adata_pseudobulk, monkeypatch):
+    """Small inputs don't start a process pool if the chunksize is chosen automatically"""
+
+    def _process_map(*args, **kwargs):
+        raise AssertionError("process_map called")
+
+    monkeypatch.setattr(lm, "process_map", _process_map)
+    formula = "~ C(group, Sum) + dataset"
+    res = lm.test_lm(adata_pseudobulk, formula, "group", n_jobs=1)
+    res_parallel = lm.test_lm(adata_pseudobulk, formula, "group", n_jobs=4)
+    pdt.assert_frame_equal(res, res_parallel)
+
+
+@pytest.mark.parametrize(
+    "n_obs,n_vars,n_jobs,memory_budget,expected",
+    [
+        (24, 1000, 4, 2 * 1024**3, 63),
+        (24, 3, 4, 2 * 1024**3, 1),
+        (1000, 20000, 2, 1000 * 8 * 4 * 2 * 100, 100),
+    ],
+)
+def test_get_chunksize(n_obs, n_vars, n_jobs, memory_budget, expected):
+    assert (
+        lm._get_chunksize(n_obs, n_vars, n_jobs=n_jobs, memory_budget=memory_budget)
+        == expected
+    )
+
+
+@pytest.fixture
+def adatas_by_cell_type():
+    rng = np.random.default_rng(1)
+    adatas = {}
+    for ct in ["T cell", "B cell", "Macrophage"]:
+        n_obs = 120
+        adatas[ct] = AnnData(
+            X=rng.normal(size=(n_obs, 4)),
+            obs=pd.DataFrame(index=[f"{ct}_{i}" for i in range(n_obs)]).assign(
+                patient=np.repeat([f"p{i}" for i in range(12)], 10),
+                group=np.repeat(["A", "B", "C"], 40),
+            ),
+            var=pd.DataFrame(index=["a", "b", "c", "d"]),
+        )
+    # not enough categories -> skipped
+    adatas["Mast cell"] = adatas["B cell"][adatas["B cell"].obs["group"] == "A"].copy()
+    return adatas
+
+
+def test_lm_test_all_parallel(adatas_by_cell_type):
+    kwargs = {"groupby": ["patient"], "column_to_test": "group"}
+    res = lm.lm_test_all(adatas_by_cell_type, n_jobs=1, **kwargs)
+    res_parallel = lm.lm_test_all(adatas_by_cell_type, n_jobs=2, **kwargs)
+    pdt.assert_frame_equal(res, res_parallel)
+    assert set(res["cell_type"]) == {"T cell", "B cell", "Macrophage"}
+
+
+def test_lm_test_all_sends_pseudobulks(adatas_by_cell_type, monkeypatch):
+    """Only the pseudobulks, not the single-cell data, are sent to the workers"""
+    n_obs_sent = []
+
+    def _process_map(fun, cts, adatas, *args, **kwargs):
+        adatas = list(adatas)
+        n_obs_sent.extend(adata.n_obs for adata in adatas)
+        return list(map(fun, cts, adatas, *args))
+
+    monkeypatch.setattr(lm, "process_map", _process_map)
+    lm.lm_test_all(
+        adatas_by_cell_type, groupby=["patient"], column_to_test="group", n_jobs=2
+    )
+    assert n_obs_sent == [12, 12, 12, 4]
+
+
+def test_compare_signatures(adatas_by_cell_type):
+    all_adatas = {"tool1": adatas_by_cell_type, "tool2": adatas_by_cell_type}
+    res = compare_signatures(
+        "test",
+        all_adatas,
+        pseudobulk_group_by=["patient"],
+        column_to_test="group",
+        lm_covariate_str="",
+        contrasts="Sum",
+        n_jobs=2,
+    )
+    assert list(res) == ["tool1", "tool2"]
+    expected = lm.lm_test_all(
+        adatas_by_cell_type, groupby=["patient"], column_to_test="group", n_jobs=1
+    )
+    for tool in res:
+        pdt.assert_frame_equal(res[tool], expected)
+
+
+@pytest.fixture
+def adata_pseudobulk_paired():
+    rng = np.random.default_rng(2)
+    n_patients = 8
+    n_obs = n_patients * 3
+    patient_effect = rng.normal(scale=3, size=(n_patients, 1))
+    X = rng.normal(size=(n_obs, 5)) + np.repeat(patient_effect, 3, axis=0)
+    X[:, 0] += np.tile([0, 1, 2], n_patients)
+    X[5, 3] = np.nan
+    return AnnData(
+        X=X,
+        obs=pd.DataFrame(index=[str(i) for i in range(n_obs)]).assign(
+            patient=np.repeat([f"p{i}" for i in range(n_patients)], 3),
+            group=np.tile(["A", "B", "C"], n_patients),
+            batch=rng.choice(["b1", "b2", "b3"], size=n_obs),
+            age=rng.normal(size=n_obs),
+        ),
+        var=pd.DataFrame(index=["x", "y", "z", "w", "v"]),
+    )
+
+
+@pytest.mark.parametrize("robust", [False, True])
+@pytest.mark.parametrize("contrasts", ["Sum", "Treatment('A')"])
+@pytest.mark.parametrize(
+    "absorb,covariate_str",
+    [
+        (["patient"], ""),
+        (["patient"], "+ age"),
+        (["patient", "batch"], ""),
+    ],
+)
+def test_test_lm_absorb(
+    adata_pseudobulk_paired, absorb, covariate_str, contrasts, robust
+):
+    formula = f"~ C(group, {contrasts}) {covariate_str}"
+    res_dummies = lm.test_lm(
+        adata_pseudobulk_paired,
+        formula + "".join(f" + {col}" for col in absorb),
+        "group",
+        contrasts=contrasts,
+        robust=robust,
+        n_jobs=1,
+    )
+    res_absorbed = lm.test_lm(
+        adata_pseudobulk_paired,
+        formula,
+        "group",
+        contrasts=contrasts,
+        robust=robust,
+        n_jobs=1,
+        absorb=absorb,
+    )
+    pdt.assert_frame_equal(
+        res_dummies.drop(columns="intercept"), res_absorbed.drop(columns="intercept")
+    )
+
+
+def test_design_cache(adata_pseudobulk):
+    formula = "~ C(group, Sum) + dataset"
+    design = lm._get_design(adata_pseudobulk.obs, formula, "group", contrasts="Sum")
+    # same obs (e.g. different tool, same cell-type) -> cached
+    assert (
+        lm._get_design(adata_pseudobulk.obs.copy(), formula, "group", contrasts="Sum")
+        is design
+    )
+    assert (
+        lm._get_design(
+            adata_pseudobulk.obs,
+            "~ C(group, Treatment('A')) + dataset",
+            "group",
+            contrasts="Treatment('A')",
+        )
+        is not design
+    )
+
+    # changing obs invalidates the cache
+    adata2 = adata_pseudobulk.copy()
+    adata2.obs.loc["0", "dataset"] = "d2"
+    design2 = lm._get_design(adata2.obs, formula, "group", contrasts="Sum")
+    assert design2 is not design
+    assert not np.array_equal(design2.design_df.values, design.design_df.values)
+    pdt.assert_frame_equal(
+        lm.test_lm(adata2, formula, "group", n_jobs=1),
+        _test_lm_statsmodels(adata2, formula, "group", "Sum", False),
+    )
+
+    adata2.obs["group"] = pd.Categorical(
+        adata2.obs["group"], categories=["C", "B", "A"]
+    )
+    assert lm._get_design(adata2.obs, formula, "group", contrasts="Sum").all_groups == [
+        "C",
+        "B",
+        "A",
+    ]
+
+
+def _permutation_test_reference(
+    adata, formula, groupby, permutations, strata, **kwargs
+):
+    """Reference implementation refitting the model for each permutation separately"""
+    keys = np.random.default_rng(0).random((permutations, adata.n_obs))
+    res_obs = lm.test_lm(adata, formula, groupby, n_jobs=1, **kwargs)
+    n_extreme = np.zeros(res_obs.shape[0])
+    for i in range(permutations):
+        # sort by stratum, then by the random keys
+        perm_idx = np.empty(adata.n_obs, dtype=int)
+        perm_idx[np.argsort(strata, kind="stable")] = np.lexsort((keys[i], strata))
+        assert np.all(strata[perm_idx] == strata)
+        adata_perm = adata.copy()
+        adata_perm.obs[groupby] = adata.obs[groupby].values[perm_idx]
+        res_perm = lm.test_lm(adata_perm, formula, groupby, n_jobs=1, **kwargs)
+        n_extreme += res_perm["pvalue"].values <= res_obs["pvalue"].values * (1 + 1e-9)
+    return (1 + n_extreme) / (1 + permutations)
+
+
+@pytest.mark.parametrize("robust", [False, True])
+@pytest.mark.parametrize(
+    "contrasts,covariates,strata_col,absorb",
+    [
+        ("Sum", "+ age", None, ()),
+        ("Treatment('A')", "", "patient", ()),
+        ("Sum", "", "patient", ["patient"]),
+    ],
+)
+def test_test_lm_permutations(
+    adata_pseudobulk_paired, contrasts, covariates, strata_col, absorb, robust
+):
+    adata = adata_pseudobulk_paired[:, ["x", "y", "z", "v"]].copy()
+    formula = f"~ C(group, {contrasts}) {covariates}"
+    kwargs = {"contrasts": contrasts, "robust": robust, "absorb": absorb}
+    strata = (
+        np.zeros(adata.n_obs, dtype=int)
+        if strata_col is None
+        else pd.factorize(adata.obs[strata_col])[0]
+    )
+    res = lm.test_lm(
+        adata,
+        formula,
+        "group",
+        n_jobs=1,
+        permutations=30,
+        permutation_strata=[] if strata_col is None else [strata_col],
+        memory_budget=10000,  # multiple chunks of permutations
+        **kwargs,
+    )
+    res_ols = lm.test_lm(adata, formula, "group", n_jobs=1, **kwargs)
+    npt.assert_array_equal(res["pvalue_ols"].values, res_ols["pvalue"].values)
+    npt.assert_allclose(
+        res["pvalue"].values,
+        _permutation_test_reference(adata, formula, "group", 30, strata, **kwargs),
+    )
+
+
+def test_test_lm_permutations_parallel(adata_pseudobulk):
+    formula = "~ C(group, Sum) + dataset"
+    res = lm.test_lm(adata_pseudobulk, formula, "group", n_jobs=1, permutations=20)
+    res_chunked = lm.test_lm(
+        adata_pseudobulk, formula, "group", n_jobs=2, chunksize=2, permutations=20
+    )
+    pdt.assert_frame_equal(res, res_chunked)
+    assert np.all((res["pvalue"] >= 1 / 21) & (res["pvalue"] <= 1))
+
+
+def test_test_lm_permutations_constant(adata_pseudobulk):
+    """Variables without a test statistic don't get the smallest possible pvalue"""
+    adata_pseudobulk.X[:, 1] = 0
+    res = lm.test_lm(
+        adata_pseudobulk, "~ C(group, Sum)", "group", n_jobs=1, permutations=99
+    )
+    res_y = res.loc[lambda x: x["variable"] == "y"]
+    assert np.all(np.isnan(res_y["pvalue_ols"]))
+    assert np.all(np.isnan(res_y["pvalue"]))
+    assert np.all(res.loc[lambda x: x["variable"] != "y", "pvalue"] >= 1 / 100)
+
+
+@pytest.fixture
+def adata_pseudobulk_repeated():
+    """Pseudobulk where patients occur in multiple samples"""
+    rng = np.random.default_rng(3)
+    n_patients = 15
+    sizes = rng.integers(2, 5, size=n_patients)
+    n_obs = np.sum(sizes)
+    X = rng.normal(size=(n_obs, 5)) + np.repeat(
+        rng.normal(scale=1.5, size=(n_patients, 5)), sizes, axis=0
+    )
+    # no random effect
+    X[:, 4] = rng.normal(size=n_obs)
+    return AnnData(
+        X=X,
+        obs=pd.DataFrame(index=[str(i) for i in range(n_obs)]).assign(
+            patient=np.repeat([f"p{i}" for i in range(n_patients)], sizes),
+            group=rng.choice(["A", "B", "C"], size=n_obs),
+            dataset=rng.choice(["d1", "d2"], size=n_obs),
+        ),
+        var=pd.DataFrame(index=["x", "y", "z", "w", "v"]),
+    )
+
+
+@pytest.mark.filterwarnings("ignore::UserWarning")
+@pytest.mark.filterwarnings(
+    "ignore::statsmodels.tools.sm_exceptions.ConvergenceWarning"
+)
+@pytest.mark.parametrize("contrasts", ["Sum", "Treatment('A')"])
+def test_test_lm_random_intercept(adata_pseudobulk_repeated, contrasts):
+    """The batched mixed model gives the same estimates as statsmodels' MixedLM"""
+    adata = adata_pseudobulk_repeated
+    formula = f"~ C(group, {contrasts}) + dataset"
+    res = lm.test_lm(
+        adata, formula, "group", contrasts=contrasts, random_intercept="patient"
+    ).set_index("variable", append=True)
+
+    df = adata.obs.join(adata.to_df())
+    for var in adata.var_names:
+        mod = smf.mixedlm(f"{var} {formula}", df, groups=df["patient"]).fit(reml=True)
+        # only compare the parameters that are in the model (not the omitted level for sum-coding)
+        keys = [k for k in res.index.get_level_values(0).unique() if k in mod.params]
+        tmp_res = res.xs(var, level="variable").loc[keys]
+        npt.assert_allclose(tmp_res["coef"], mod.params[keys], rtol=1e-4, atol=1e-6)
+        npt.assert_allclose(
+            tmp_res["intercept"], mod.params["Intercept"], rtol=1e-4, atol=1e-6
+        )
+        # statsmodels derives standard errors from the hessian of the likelihood and uses a z-test.
+        # We use (X^T V^-1 X)^-1 as in lme4 (with the variance components estimated by statsmodels)
+        # and a t-test with n_obs - n_params degrees of freedom.
+        design = patsy.dmatrix(formula, df, return_type="dataframe")
+        codes = pd.factorize(df["patient"])[0]
+        V = mod.scale * np.eye(adata.n_obs) + float(mod.cov_re.iloc[0, 0]) * (
+            codes[:, np.newaxis] == codes[np.newaxis, :]
+        )
+        se = np.sqrt(
+            np.diag(np.linalg.inv(design.values.T @ np.linalg.solve(V, design.values)))
+        )
+        se = pd.Series(se, index=design.columns)
+        npt.assert_allclose(
+            tmp_res["pvalue"],
+            2
+            * scipy.stats.t.sf(
+                np.abs(mod.params[keys] / se[keys]), adata.n_obs - design.shape[1]
+            ),
+            rtol=1e-3,
+        )
+
+
+def test_test_lm_random_intercept_no_variance(adata_pseudobulk):
+    """Without repeated measurements, the mixed model is the same as OLS"""
+    formula = "~ C(group, Sum) + dataset"
+    res = lm.test_lm(adata_pseudobulk, formula, "group", n_jobs=1)
+    adata_pseudobulk.obs["sample"] = adata_pseudobulk.obs_names
+    res_lmm = lm.test_lm(
+        adata_pseudobulk, formula, "group", n_jobs=1, random_intercept="sample"
+    )
+    pdt.assert_frame_equal(res, res_lmm, rtol=1e-4)
+
+
+@pytest.mark.parametrize(
+    "kwargs", [{"robust": True}, {"absorb": ["dataset"]}, {"permutations": 10}]
+)
+def test_test_lm_random_intercept_unsupported(adata_pseudobulk_repeated, kwargs):
+    with pytest.raises(ValueError):
+        lm.test_lm(
+            adata_pseudobulk_repeated,
+            "~ C(group, Sum)",
+            "group",
+            n_jobs=1,
+            random_intercept="patient",
+            **kwargs,
+        )
@@ -1,10 +1,18 @@
 from .fixtures import adata_hierarchical1
-from scanpy_helpers.pseudobulk import pseudobulk
+from scanpy_helpers.pseudobulk import (
+    pseudobulk,
+    PseudobulkCube,
+    PseudobulkCache,
+    make_pseudobulk_samplesheets,
+    write_pseudobulk_samplesheets,
+)
 import pytest
 import numpy.testing as npt
 import numpy as np
+import scipy.sparse as sp
 import pandas as pd
 import pandas.testing as pdt
+import anndata
 
 
 @pytest.mark.parametrize(
@@ -98,3 +106,308 @@ def test_pseudobulk1(
     )
     pdt.assert_frame_equal(adata_pb.obs, obs_expected)
     npt.assert_almost_equal(adata_pb.X, x_expected)
+
+
+@pytest.mark.parametrize(
+    "aggr_fun,callback",
+    [
+        ("sum", np.sum),
+        ("mean", np.mean),
+        ("count_nonzero", lambda x, axis: np.sum(x != 0, axis)),
+        (
+            "fraction_expressed",
+            lambda x, axis: np.sum(x > 0, axis) / x.shape[axis],
+        ),
+    ],
+)
+@pytest.mark.parametrize("dtype", [np.float32, np.float64, np.int32, np.int64])
+def test_pseudobulk_aggr_fun_equivalence(
+    adata_hierarchical1, aggr_fun, callback, dtype
+):
+    """Builtin aggregation functions give the same result as the per-group callback"""
+    adata_hierarchical1.X = adata_hierarchical1.X.astype(dtype)
+    adata_pb = pseudobulk(
+        adata_hierarchical1,
+        groupby=["dataset", "patient"],
+        aggr_fun=aggr_fun,
+        min_obs=0,
+    )
+    adata_pb_callback = pseudobulk(
+        adata_hierarchical1,
+        groupby=["dataset", "patient"],
+        aggr_fun=callback,
+        min_obs=0,
+    )
+    pdt.assert_frame_equal(adata_pb.obs, adata_pb_callback.obs)
+    npt.assert_almost_equal(adata_pb.X, adata_pb_callback.X)
+    assert adata_pb.X.dtype == adata_pb_callback.X.dtype
+
+
+@pytest.mark.parametrize("matrix_type", [np.array, sp.csr_matrix, sp.csc_matrix])
+def test_pseudobulk_negative_values(matrix_type):
+    """Only positive values count as expressed, count_nonzero is consistent with np.count_nonzero"""
+    X = np.array([[1.0, -2, 0], [0, -1, 3], [-1, 0, 0], [2, 1, 0]])
+    adata = anndata.AnnData(
+        X=matrix_type(X),
+        obs=pd.DataFrame({"group": ["a", "a", "b", "b"]}, index=list("0123")),
+    )
+    res = pseudobulk(
+        adata,
+        groupby="group",
+        stats=["fraction_expressed", "count_nonzero"],
+        min_obs=0,
+    )
+    npt.assert_array_equal(
+        res.layers["fraction_expressed"], [[0.5, 0, 0.5], [0.5, 0.5, 0]]
+    )
+    npt.assert_array_equal(res.layers["count_nonzero"], [[1, 2, 1], [2, 1, 0]])
+
+
+def test_pseudobulk_missing_values(adata_hierarchical1):
+    """Observations with missing values in a groupby column are excluded"""
+    adata_hierarchical1.obs["patient"] = adata_hierarchical1.obs["patient"].replace(
+        "p3", np.nan
+    )
+    adata_pb = pseudobulk(
+        adata_hierarchical1, groupby=["dataset", "patient"], min_obs=0
+    )
+    assert adata_pb.obs["patient"].tolist() == ["p1", "p2", "p1", "p1", "p2"]
+    npt.assert_almost_equal(adata_pb.X, [[20, 0], [12, 0], [4, 0], [20, 1], [5, 0]])
+
+
+def test_pseudobulk_stats(adata_hierarchical1):
+    """Multiple statistics computed in one pass match individual calls"""
+    stats = ["sum", "mean", "count_nonzero", "fraction_expressed", "var"]
+    adata_pb = pseudobulk(
+        adata_hierarchical1, groupby=["dataset", "patient"], stats=stats, min_obs=0
+    )
+    npt.assert_almost_equal(adata_pb.X, adata_pb.layers["sum"])
+    for stat in stats:
+        adata_pb_single = pseudobulk(
+            adata_hierarchical1,
+            groupby=["dataset", "patient"],
+            aggr_fun=stat,
+            min_obs=0,
+        )
+        npt.assert_almost_equal(adata_pb.layers[stat], adata_pb_single.X)
+
+    npt.assert_almost_equal(
+        adata_pb.layers["var"],
+        [[0, 0], [0, 0], [1, 0], [0, 0], [0, 0], [0, 0]],
+    )
+
+
+def test_pseudobulk_layer(adata_hierarchical1):
+    adata_hierarchical1.layers["double"] = adata_hierarchical1.X * 2
+    adata_pb = pseudobulk(
+        adata_hierarchical1, groupby="dataset", layer="double", min_obs=1
+    )
+    npt.assert_almost_equal(adata_pb.X, [[90, 0], [18, 0], [40, 2]])
+
+
+@pytest.mark.parametrize("layer", [None, "counts"])
+def test_pseudobulk_backed(adata_hierarchical1, tmp_path, layer):
+    """Streaming from disk in chunks gives the same result as the in-memory path"""
+    adata_hierarchical1.layers["counts"] = adata_hierarchical1.X.copy()
+    stats = ["sum", "mean", "fraction_expressed", "var"]
+    adata_pb_mem = pseudobulk(
+        adata_hierarchical1, groupby=["dataset", "patient"], stats=stats, min_obs=0
+    )
+
+    path = tmp_path / "adata.h5ad"
+    adata_hierarchical1.write_h5ad(path)
+    adata_backed = anndata.read_h5ad(path, backed="r")
+    for tmp_adata in [adata_backed, path, str(path)]:
+        adata_pb = pseudobulk(
+            tmp_adata,
+            groupby=["dataset", "patient"],
+            stats=stats,
+            min_obs=0,
+            layer=layer,
+            chunk_size=3,
+        )
+        pdt.assert_frame_equal(adata_pb.obs, adata_pb_mem.obs)
+        for stat in stats:
+            npt.assert_almost_equal(adata_pb.layers[stat], adata_pb_mem.layers[stat])
+
+    with pytest.raises(ValueError):
+        pseudobulk(adata_backed, groupby="dataset", aggr_fun=np.median)
+
+
+@pytest.mark.parametrize("aggr_fun", ["sum", "fraction_expressed", np.max])
+@pytest.mark.parametrize(
+    "subset",
+    [
+        lambda x: x[x.obs["patient"] != "p3", :],
+        lambda x: x[[7, 0, 2, 5, 4], ["B"]],
+        lambda x: x[1:, :][[0, 2, 2, 4], :],
+    ],
+)
+def test_pseudobulk_view(adata_hierarchical1, subset, aggr_fun):
+    """Aggregating from the parent of a view gives the same result as aggregating a copy"""
+    adata_view = subset(adata_hierarchical1)
+    assert adata_view.is_view
+    adata_pb_view = pseudobulk(
+        adata_view, groupby="dataset", aggr_fun=aggr_fun, min_obs=0, chunk_size=2
+    )
+    adata_pb_copy = pseudobulk(
+        adata_view.copy(), groupby="dataset", aggr_fun=aggr_fun, min_obs=0
+    )
+    pdt.assert_frame_equal(adata_pb_view.obs, adata_pb_copy.obs)
+    npt.assert_almost_equal(adata_pb_view.X, adata_pb_copy.X)
+    assert adata_pb_view.var_names.tolist() == adata_view.var_names.tolist()
+
+
+def test_pseudobulk_backed_view(adata_hierarchical1, tmp_path):
+    path = tmp_path / "adata.h5ad"
+    adata_hierarchical1.write_h5ad(path)
+    adata_backed = anndata.read_h5ad(path, backed="r")
+    subset = adata_hierarchical1.obs["patient"] != "p3"
+    adata_pb = pseudobulk(
+        adata_backed[subset.values, :], groupby="dataset", min_obs=0, chunk_size=2
+    )
+    adata_pb_mem = pseudobulk(
+        adata_hierarchical1[subset, :], groupby="dataset", min_obs=0
+    )
+    npt.assert_almost_equal(adata_pb.X, adata_pb_mem.X)
+
+
+@pytest.mark.parametrize("groupby", [["dataset", "patient"], "dataset", "patient"])
+@pytest.mark.parametrize("min_obs", [0, 2])
+def test_pseudobulk_cube(adata_hierarchical1, groupby, min_obs):
+    """Roll-ups from the cube are the same as the pseudobulk of the original data"""
+    stats = ["sum", "mean", "fraction_expressed", "var"]
+    cube = PseudobulkCube(
+        adata_hierarchical1, groupby=["dataset", "patient"], stats=stats
+    )
+    adata_pb_cube = cube.pseudobulk(groupby=groupby, stats=stats, min_obs=min_obs)
+    adata_pb = pseudobulk(
+        adata_hierarchical1, groupby=groupby, stats=stats, min_obs=min_obs
+    )
+    pdt.assert_frame_equal(adata_pb_cube.obs, adata_pb.obs)
+    for stat in stats:
+        npt.assert_almost_equal(adata_pb_cube.layers[stat], adata_pb.layers[stat])
+
+    npt.assert_almost_equal(
+        cube.pseudobulk(groupby=groupby, aggr_fun=np.mean, min_obs=min_obs).X,
+        adata_pb.layers["mean"],
+    )
+
+
+def test_pseudobulk_cube_hierarchy(adata_hierarchical1):
+    adata_hierarchical1.obs["dataset_group"] = adata_hierarchical1.obs["dataset"].map(
+        {"d1": "A", "d2": "A", "d3": "B"}
+    )
+    cube = PseudobulkCube(
+        adata_hierarchical1,
+        groupby=["dataset", "patient"],
+        annotation_cols=["dataset_group"],
+    )
+    cube.map_labels("dataset", {"d1": "A", "d2": "A"}, key_added="dataset_mapped")
+
+    adata_pb = pseudobulk(adata_hierarchical1, groupby="dataset_group", min_obs=0)
+    adata_pb_cube = cube.pseudobulk(groupby="dataset_group", min_obs=0)
+    pdt.assert_frame_equal(adata_pb_cube.obs, adata_pb.obs)
+    npt.assert_almost_equal(adata_pb_cube.X, adata_pb.X)
+
+    # unmapped labels are excluded
+    adata_pb_mapped = cube.pseudobulk(groupby="dataset_mapped", min_obs=0)
+    assert adata_pb_mapped.obs["dataset_mapped"].tolist() == ["A"]
+    npt.assert_almost_equal(adata_pb_mapped.X, [[54, 0]])
+
+    with pytest.raises(ValueError):
+        PseudobulkCube(
+            adata_hierarchical1, groupby="dataset_group", annotation_cols=["dataset"]
+        )
+    with pytest.raises(ValueError):
+        cube.pseudobulk(groupby="dataset", aggr_fun="fraction_expressed")
+
+
+def test_pseudobulk_cache(adata_hierarchical1, tmp_path):
+    cache = PseudobulkCache(tmp_path / "cache")
+    kwargs = {"groupby": ["dataset", "patient"], "min_obs": 0}
+    adata_pb = pseudobulk(adata_hierarchical1, stats=["sum", "mean"], **kwargs)
+
+    for _ in range(2):
+        adata_pb_cached = pseudobulk(
+            adata_hierarchical1, stats=["sum", "mean"], cache=cache, **kwargs
+        )
+        pdt.assert_frame_equal(adata_pb_cached.obs, adata_pb.obs)
+        npt.assert_almost_equal(adata_pb_cached.X, adata_pb.X)
+        npt.assert_almost_equal(adata_pb_cached.layers["mean"], adata_pb.layers["mean"])
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["n_entries"] == 1
+
+    # different parameters, different data or views are cache misses
+    pseudobulk(adata_hierarchical1, aggr_fun="mean", cache=cache, **kwargs)
+    pseudobulk(adata_hierarchical1[:6, :], stats=["sum"], cache=cache, **kwargs)
+    adata_hierarchical1.X = adata_hierarchical1.X * 2
+    adata_pb_modified = pseudobulk(
+        adata_hierarchical1, stats=["sum", "mean"], cache=cache, **kwargs
+    )
+    npt.assert_almost_equal(adata_pb_modified.X, adata_pb.X * 2)
+    assert cache.stats()["misses"] == 4
+    # callbacks are not cached
+    pseudobulk(adata_hierarchical1, aggr_fun=np.max, cache=cache, **kwargs)
+    assert cache.stats()["n_entries"] == 4
+
+    # LRU eviction
+    cache.max_size = 1
+    cache._evict()
+    assert cache.stats()["n_entries"] == 0
+
+
+@pytest.mark.parametrize("keep_unpaired_samples", [True, False])
+def test_make_pseudobulk_samplesheets(tmp_path, keep_unpaired_samples):
+    adata = anndata.AnnData(
+        X=np.array([[1, 2, 3, 4, 5, 6, 7, 8], [0, 0, 0, 0, 0, 0, 0, 1]]).T,
+        obs=pd.DataFrame(index=[f"c{i}" for i in range(8)]).assign(
+            cell_type=list("AAAABBBB"),
+            patient=["p1", "p1", "p2", "p2", "p1", "p1", "p1", "p2"],
+            origin=list("TNTTTNNT"),
+            sex=["m", "m", "f", "f", "m", "m", "m", "f"],
+            batch=["b1", "b1", "b1", "b2", "b1", "b1", "b1", "b2"],
+        ),
+        var=pd.DataFrame(index=["G1", "G2"]),
+    )
+    res = make_pseudobulk_samplesheets(
+        adata,
+        split_by="cell_type",
+        replicate_col="patient",
+        condition_col="origin",
+        min_cells_per_sample=0,
+        keep_unpaired_samples=keep_unpaired_samples,
+    )
+    assert list(res) == ["A", "B"]
+
+    counts_a, samplesheet_a = res["A"]
+    expected_samples_a = ["p1_N", "p1_T"] + (["p2_T"] if keep_unpaired_samples else [])
+    assert samplesheet_a.index.tolist() == expected_samples_a
+    assert samplesheet_a.columns.tolist() == [
+        "cell_type",
+        "patient",
+        "origin",
+        "sex",
+        "n_cells",
+    ]
+    assert counts_a.index.name == "gene_id"
+    assert counts_a.columns.tolist() == expected_samples_a
+    npt.assert_equal(
+        counts_a.values, np.array([[2, 1, 7], [0, 0, 0]])[:, : len(expected_samples_a)]
+    )
+    npt.assert_equal(
+        samplesheet_a["n_cells"].values, [1, 1, 2][: len(expected_samples_a)]
+    )
+
+    counts_b, samplesheet_b = res["B"]
+    assert "batch" in samplesheet_b.columns
+    assert samplesheet_b.index.tolist() == expected_samples_a
+    npt.assert_equal(
+        counts_b.values, np.array([[13, 5, 8], [0, 0, 1]])[:, : len(expected_samples_a)]
+    )
+
+    write_pseudobulk_samplesheets(res, out_dir=tmp_path, prefix="test")
+    counts_b_csv = pd.read_csv(tmp_path / "test_b_counts.csv", index_col=0)
+    npt.assert_equal(counts_b_csv.values, counts_b.values)
+    assert (tmp_path / "test_a_samplesheet.csv").exists()
@@ -0,0 +1,268 @@
+from scanpy_helpers import signatures
+from sklearn.metrics import roc_auc_score
+import scanpy as sc
+import anndata
+import warnings
+from anndata import AnnData
+import pytest
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import numpy.testing as npt
+import pandas.testing as pdt
+
+
+@pytest.fixture(params=[np.array, sp.csr_matrix, sp.csc_matrix])
+def adata_classes(request):
+    rng = np.random.default_rng(0)
+    # few distinct values -> many ties, including negative values and explicit zeros
+    X = rng.choice([-1.0, 0, 0, 0, 0.5, 1, 2, 3.5], size=(60, 25))
+    X[:, 0] = 0
+    X[:, 1] = rng.normal(size=60)
+    X = request.param(X)
+    if sp.issparse(X):
+        # explicitly stored zero
+        X.data[0] = 0
+    return AnnData(
+        X=X,
+        obs=pd.DataFrame(
+            {"cell_type": rng.choice(["A", "B", "C"], 60)},
+            index=[f"c{i}" for i in range(60)],
+        ),
+        var=pd.DataFrame(index=[f"g{i}" for i in range(25)]),
+    )
+
+
+@pytest.mark.parametrize("positive_class", ["A", "B", "C"])
+def test_roc_auc(adata_classes, positive_class):
+    X = adata_classes.X.toarray() if sp.issparse(adata_classes.X) else adata_classes.X
+    mask = adata_classes.obs["cell_type"] == positive_class
+    expected = np.array([roc_auc_score(mask, X[:, j]) for j in range(X.shape[1])])
+    res = signatures.roc_auc(
+        adata_classes, obs_col="cell_type", positive_class=positive_class, inplace=False
+    )
+    npt.assert_allclose(res, expected, rtol=1e-12)
+    signatures.roc_auc(
+        adata_classes, obs_col="cell_type", positive_class=positive_class
+    )
+    npt.assert_allclose(adata_classes.var["roc_auc"], expected, rtol=1e-12)
+
+
+def test_roc_auc_single_class(adata_classes):
+    with pytest.raises(ValueError):
+        signatures.roc_auc(adata_classes, obs_col="cell_type", positive_class="D")
+
+
+def test_marker_metrics(adata_classes):
+    adata_classes.obs.iloc[:3, 0] = np.nan
+    adata_expected = adata_classes.copy()
+    X = adata_expected.X
+    adata_expected.X = X.toarray() if sp.issparse(X) else X
+    for ct in ["A", "B", "C"]:
+        signatures.fold_change(
+            adata_expected, obs_col="cell_type", positive_class=ct, key_added=f"{ct}_fc"
+        )
+        signatures.roc_auc(
+            adata_expected,
+            obs_col="cell_type",
+            positive_class=ct,
+            key_added=f"{ct}_auroc",
+        )
+    # observations without annotation are not a negative class for the specific fold change
+    adata_expected = adata_expected[3:, :].copy()
+    for ct in ["A", "B", "C"]:
+        signatures.specific_fold_change(
+            adata_expected,
+            obs_col="cell_type",
+            positive_class=ct,
+            key_added=f"{ct}_sfc",
+        )
+
+    res = signatures.marker_metrics(adata_classes, "cell_type", inplace=False)
+    assert set(res.columns) == {
+        f"{ct}_{metric}" for ct in "ABC" for metric in ["fc", "sfc", "auroc"]
+    }
+    for col in res.columns:
+        npt.assert_allclose(res[col], adata_expected.var[col], rtol=1e-10, err_msg=col)
+
+    signatures.marker_metrics(adata_classes, "cell_type")
+    pdt.assert_frame_equal(adata_classes.var, res)
+
+
+def test_evaluate_grid():
+    rng = np.random.default_rng(1)
+    n_genes = 200
+    pb_train = AnnData(
+        X=rng.normal(size=(20, n_genes)),
+        obs=pd.DataFrame(
+            {"cell_type": ["A", "B", "C", "D"] * 5},
+            index=[f"s{i}" for i in range(20)],
+        ),
+        var=pd.DataFrame(index=[f"g{i}" for i in range(n_genes)]),
+    )
+    pb_train.X[:5, :50] += 2
+    pb_train = signatures.MCPSignatureRegressor.prepare_anndata(
+        pb_train, label_col="cell_type", positive_class="A"
+    )
+    X_test = rng.normal(size=(12, n_genes))
+    # constant genes do not have a z-score
+    X_test[:, :3] = 1
+    pb_test = AnnData(
+        X=X_test,
+        obs=pd.DataFrame(
+            {"true_frac": rng.random(12)}, index=[f"p{i}" for i in range(12)]
+        ),
+        var=pb_train.var.loc[:, []],
+    )
+    grid = list(
+        signatures._get_grid(
+            {
+                "min_fc": [-1, 0.5, 1, 2, 10],
+                "min_sfc": [0, 0.5, 1, 1.5],
+                "min_auroc": [0.5, 0.8, 0.97],
+            }
+        )
+    )
+    res = signatures._evaluate_grid(pb_train, pb_test, grid)
+    # passing a constraint falls back to fitting one model per parameter combination
+    expected = signatures._evaluate_grid(
+        pb_train, pb_test, [dict(params, constraint=None) for params in grid]
+    )
+    assert [n for n, _ in res] == [n for n, _ in expected]
+    assert any(n == 0 for n, _ in res)
+    npt.assert_allclose(
+        [r for _, r in res], [r for _, r in expected], rtol=1e-10, atol=1e-12
+    )
+
+
+@pytest.mark.parametrize("use_raw", [True, False])
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("matrix_type", [np.array, sp.csr_matrix])
+def test_score_gene_sets(use_raw, dtype, matrix_type):
+    rng = np.random.default_rng(2)
+    n_genes = 400
+    X = np.log1p(rng.poisson(rng.gamma(0.5, 2, size=n_genes), size=(100, n_genes)))
+    adata = AnnData(
+        X=matrix_type(X.astype(dtype)),
+        obs=pd.DataFrame(index=[f"c{i}" for i in range(100)]),
+        var=pd.DataFrame(index=[f"g{i}" for i in range(n_genes)]),
+    )
+    if use_raw:
+        adata.raw = adata
+        adata = adata[:, :50].copy()
+    gene_sets = {
+        "sig1": [f"g{i}" for i in range(10)],
+        "sig2": [f"g{i}" for i in range(300, 340)] + ["not_a_gene"],
+        "sig3": "g7",
+    }
+    adata_expected = adata.copy()
+    for name, genes in gene_sets.items():
+        sc.tl.score_genes(
+            adata_expected, genes, score_name=name, ctrl_size=5, use_raw=use_raw
+        )
+
+    signatures.score_gene_sets(
+        adata, gene_sets, ctrl_size=5, use_raw=use_raw, chunk_size=30
+    )
+    for name in gene_sets:
+        npt.assert_allclose(
+            adata.obs[name], adata_expected.obs[name], rtol=1e-5, atol=1e-6
+        )
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [{"ctrl_size": 5}, {"ctrl_size": 5, "gene_pool": [f"g{i}" for i in range(200)]}],
+)
+def test_score_cell_types(kwargs):
+    from scanpy_helpers.annotation import AnnotationHelper
+
+    rng = np.random.default_rng(2)
+    X = np.log1p(rng.poisson(rng.gamma(0.5, 2, size=300), size=(60, 300)))
+    adata = AnnData(X=X, var=pd.DataFrame(index=[f"g{i}" for i in range(300)]))
+    markers = pd.DataFrame(
+        {
+            "cell_type": ["A"] * 5 + ["B"] * 5,
+            "gene_identifier": [f"g{i}" for i in range(10)],
+        }
+    )
+    ah = AnnotationHelper(markers=markers)
+    adata_expected = adata.copy()
+    for ct, genes in markers.groupby("cell_type")["gene_identifier"]:
+        sc.tl.score_genes(adata_expected, list(genes), score_name=f"ct_{ct}", **kwargs)
+
+    ah.score_cell_types(adata, **kwargs)
+    for ct in ["A", "B"]:
+        npt.assert_allclose(
+            adata.obs[f"ct_{ct}"], adata_expected.obs[f"ct_{ct}"], rtol=1e-5, atol=1e-6
+        )
+
+
+@pytest.mark.parametrize("input_type", ["adata", "backed", "memmap", "h5py"])
+def test_predict_signatures(tmp_path, input_type):
+    import h5py
+
+    rng = np.random.default_rng(3)
+    X = rng.normal(5, 2, size=(53, 40))
+    # constant gene -> no z-score
+    X[:, 0] = 1
+    var_names = pd.Index([f"g{i}" for i in range(40)])
+    obs_names = pd.Index([f"s{i}" for i in range(53)])
+    adata = AnnData(
+        X=X, obs=pd.DataFrame(index=obs_names), var=pd.DataFrame(index=var_names)
+    )
+    models = {}
+    for name, genes in {
+        "m1": ["g1", "g2", "g3"],
+        "m2": ["g0", "g3", "g10", "g11"],
+        "m3": ["g0"],
+    }.items():
+        m = signatures.MCPSignatureRegressor()
+        m._signature_genes = pd.DataFrame(index=genes)
+        models[name] = m
+
+    if input_type == "adata":
+        res = signatures.predict_signatures(models, adata, chunk_size=10)
+    elif input_type == "backed":
+        adata.write_h5ad(tmp_path / "adata.h5ad")
+        res = signatures.predict_signatures(
+            models,
+            anndata.read_h5ad(tmp_path / "adata.h5ad", backed="r"),
+            chunk_size=10,
+        )
+    elif input_type == "memmap":
+        np.save(tmp_path / "X.npy", X)
+        res = signatures.predict_signatures(
+            models,
+            np.load(tmp_path / "X.npy", mmap_mode="r"),
+            var_names=var_names,
+            obs_names=obs_names,
+            chunk_size=10,
+        )
+    else:
+        with h5py.File(tmp_path / "X.h5", "w") as f:
+            f.create_dataset("X", data=X, chunks=(10, 40))
+        with h5py.File(tmp_path / "X.h5", "r") as f:
+            res = signatures.predict_signatures(
+                models,
+                f["X"],
+                var_names=var_names,
+                obs_names=obs_names,
+                chunk_size=10,
+            )
+
+    assert list(res.columns) == ["m1", "m2", "m3"]
+    assert res.index.equals(obs_names)
+    for name, m in models.items():
+        with np.errstate(invalid="ignore"), warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            expected = m.predict(adata)
+        npt.assert_allclose(res[name], expected, rtol=1e-10, atol=1e-12)
+    assert np.all(np.isnan(res["m3"]))
+
+
+def test_predict_signatures_missing_genes():
+    m = signatures.MCPSignatureRegressor()
+    m._signature_genes = pd.DataFrame(index=["g1", "x"])
+    with pytest.raises(ValueError):
+        signatures.predict_signatures([m], np.zeros((2, 2)), var_names=["g0", "g1"])
@@ -5,6 +5,7 @@ import statsmodels.stats.multitest
 import numpy as np
 from anndata import AnnData
 import scipy.sparse
+from multiprocessing import shared_memory
 
 
 def log2_fc(
@@ -55,18 +56,6 @@ def fdr_correction(df, pvalue_col="pvalue", *, key_added="fdr", inplace=False):
         return df
 
 
-def split_anndata(adata, groupby):
-    """Split an anndata object into a dict of anndata objects based on a column in obs"""
-    categories = adata.obs[groupby].unique()
-    return {cat: adata[adata.obs[groupby] == cat, :].copy() for cat in tqdm(categories)}
-
-
-def chunk_adatas(ad, chunksize=200):
-    """Generate chunks of adata objects (by variable)"""
-    for i in range(0, ad.shape[1], chunksize):
-        yield ad[:, i : i + chunksize].copy()
-
-
 def suppress_stdout(func):
     """Decorator to suppress stdout"""
 
@@ -143,3 +132,54 @@ def scale_range(a):
 def scale_01(a):
     """Scale between 0 and 1"""
     return (a - np.min(a)) / np.ptp(a)
+
+
+@contextlib.contextmanager
+def shared_arrays(arrays):
+    """
+    Copy numpy arrays into shared memory for the lifetime of the context.
+
+    Yields a dictionary name -> spec that can be passed to worker processes, which
+    get the arrays without copying using :func:`attach_shared_arrays`.
+    """
+    blocks = {}
+    try:
+        specs = {}
+        for name, arr in arrays.items():
+            arr = np.asarray(arr)
+            shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            blocks[name] = shm
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+            specs[name] = (shm.name, arr.shape, arr.dtype)
+        yield specs
+    finally:
+        for shm in blocks.values():
+            shm.close()
+            shm.unlink()
+
+
+@contextlib.contextmanager
+def attach_shared_arrays(specs):
+    """
+    Access arrays shared with :func:`shared_arrays` from a worker process.
+
+    The arrays are only valid within the context. Copy the parts that are needed afterwards.
+    """
+    blocks = {
+        name: shared_memory.SharedMemory(name=spec[0]) for name, spec in specs.items()
+    }
+    arrays = {
+        name: np.ndarray(specs[name][1], dtype=specs[name][2], buffer=shm.buf)
+        for name, shm in blocks.items()
+    }
+    try:
+        yield arrays
+    finally:
+        arrays.clear()
+        for shm in blocks.values():
+            try:
+                shm.close()
+            except BufferError:
+                # views on the array are still referenced by the caller. The memory
+                # is unmapped once they are garbage collected.
+                pass
@@ -1,15 +1,23 @@
 #!/usr/bin/env nextflow
 nextflow.enable.dsl = 2
 
-include { SPLIT_ANNDATA } from "../scconversion/main.nf"
-
-
 process MAKE_PSEUDOBULK {
+    /**
+     * Generate pseudobulk samples for all cell-types in a single pass over the anndata object
+     */
     cpus 1
-    container "${baseDir}/containers/seuratdisk.sif"
+    container "${baseDir}/containers/pircher-sc-integrate2_2021-11-27_patched_annotation_helper.sif"
 
     input:
+    // the scanpy_helpers package of this repository. The container predates
+    // `make_pseudobulk_samplesheets`, therefore the package is staged with the process.
+    // Unlike in notebook processes (e.g. SCQC, COMPARE_GROUPS), where the kernel imports
+    // staged modules from the working directory, a script in `bin/` only has its own
+    // directory on `sys.path`. The working directory is added via PYTHONPATH below.
+    path(scanpy_helpers_lib, stageAs: "scanpy_helpers")
     tuple val(id), path(input_adata)
+    // the column containing the cell-type annotation
+    val(cell_type_col)
     // the column containing the biological replicate variable
     val(replicate_col)
     val(condition_col)
@@ -18,77 +26,21 @@ process MAKE_PSEUDOBULK {
     tuple(val(min_cells_per_sample), val(keep_unpaired_samples))
 
     output:
-    tuple val(id), path("${id}_counts.csv"), path("${id}_samplesheet.csv"), emit: pseudobulk
+    path("*.csv"), emit: pseudobulk
 
     script:
-    def keep_unpaired_samples = keep_unpaired_samples ? "True" : "False"
+    def keep_unpaired_samples = keep_unpaired_samples ? "--keep_unpaired_samples" : ""
     """
-    #!/usr/bin/env python
-
-    import scanpy as sc
-    import pandas as pd
-    import numpy as np
-
-    adata = sc.read_h5ad("${input_adata}")
-    replicate_col = "${replicate_col}"
-    condition_col = "${condition_col}"
-    keep_unpaired_samples = ${keep_unpaired_samples}
-    min_cells_per_sample = ${min_cells_per_sample}
-
-    # aggregate counts by sample
-    bulk_samples = {}
-    n_cells = {}
-    rep_cond = adata.obs.loc[:, [replicate_col, condition_col]].drop_duplicates()
-    for _, replicate, condition in rep_cond.itertuples():
-        mask = (adata.obs[replicate_col] == replicate) & (
-            adata.obs[condition_col] == condition
-        )
-        sample_id = f"{replicate}_{condition}"
-        n_cells[sample_id] = np.sum(mask)
-        bulk_samples[sample_id] = pd.Series(
-            np.sum(
-                adata[
-                    mask,
-                    :,
-                ].X,
-                axis=0,
-            ).A1,
-            index=adata.var_names,
-        )
-
-    bulk_df = pd.DataFrame(bulk_samples)
-    bulk_df.index.name = "gene_id"
-
-    # Create samplesheet with all variables in obs that are unique per group.
-    keep_cols = np.all(
-        adata.obs.groupby([replicate_col, condition_col], observed=True).apply(lambda x: x.nunique()) == 1,
-        axis=0
-    )
-    samplesheet = adata.obs.loc[:, keep_cols].drop_duplicates()
-    samplesheet.index = [
-        f"{replicate}_{condition}"
-        for replicate, condition in
-        zip(samplesheet[replicate_col], samplesheet[condition_col])
-    ]
-    # drop a pre-existing sample column should it exist
-    samplesheet.drop(["sample"], axis="columns", inplace=True, errors="ignore")
-    samplesheet.index.name = "sample"
-    samplesheet["n_cells"] = pd.Series(n_cells)
-    samplesheet = samplesheet.loc[samplesheet["n_cells"] > min_cells_per_sample, :]
-
-    # remove all entries that don't have a paired case/control sample
-    if not keep_unpaired_samples:
-        keep_replicates = samplesheet.groupby([replicate_col]).size() == 2
-        keep_replicates = keep_replicates.index[keep_replicates].values
-        samplesheet = samplesheet.loc[samplesheet[replicate_col].isin(keep_replicates), :]
-    samplesheet.sort_index(inplace=True)
-    bulk_df = bulk_df.loc[:, samplesheet.index]
-
-    # Export as CSV
-    bulk_df.to_csv("${id}_counts.csv")
-    samplesheet.to_csv("${id}_samplesheet.csv")
+    export PYTHONPATH="\$PWD\${PYTHONPATH:+:\$PYTHONPATH}"
+
+    make_pseudobulk.py ${input_adata} \\
+        --prefix ${id} \\
+        --split_by "${cell_type_col}" \\
+        --replicate_col "${replicate_col}" \\
+        --condition_col "${condition_col}" \\
+        --min_cells_per_sample ${min_cells_per_sample} \\
+        ${keep_unpaired_samples}
     """
-
 }
 
 process DE_DESEQ2 {
@@ -135,22 +87,25 @@ workflow deseq2_analysis {
         filter_cell_types   // only perform DE for certain cell-types. List of keywords that are checked with "contains". Set to null if you don't want to filter.
 
     main:
-    SPLIT_ANNDATA(
-        adata,
-        cell_type_column
-    )
-    ch_split = SPLIT_ANNDATA.out.adata.flatten().map{it -> [it.baseName, it]}.filter{
-         id, tmp_ad -> filter_cell_types == null || filter_cell_types.any{ it -> id.contains(it) }
-    }
     MAKE_PSEUDOBULK(
-        ch_split,
+        file("${baseDir}/lib/scanpy_helper_submodule/scanpy_helpers", checkIfExists: true),
+        adata,
+        cell_type_column,
         pseudobulk_group_by,
         column_to_test,
         pseudobulk_settings
     )
+    // group counts and samplesheet by cell-type: [id, counts, samplesheet]
+    ch_pseudobulk = MAKE_PSEUDOBULK.out.pseudobulk.flatten().map{
+        it -> [it.name.replaceAll(/_(counts|samplesheet)\.csv$/, ""), it]
+    }.groupTuple(size: 2, sort: true).map{
+        id, files -> [id, files[0], files[1]]
+    }.filter{
+        id, counts, samplesheet -> filter_cell_types == null || filter_cell_types.any{ it -> id.contains(it) }
+    }
     DE_DESEQ2(
         // only consider cell-types with at least N case/control samples
-        MAKE_PSEUDOBULK.out.pseudobulk.filter{
+        ch_pseudobulk.filter{
             id, counts, samplesheet -> samplesheet.text.count("\n") >= min_samples
         }.map{
             //override ID
@@ -91,22 +91,16 @@ workflow plots_and_comparisons {
         Channel.value(
             [[id: 'compare_groups'], file("${baseDir}/analyses/90_plots_and_comparisons/91_compare_groups.py")]
         ),
-        Channel.from([
-            // "tumor_normal",
-            "patient_infiltration_status",
-            "patient_immune_infiltration",
-            "patient_immune_infiltration_treatment_coding",
-            "patient_immune_infiltration_treatment_coding_random",
-            "luad_lusc",
-            "early_advanced",
-        ]).map {
-            it -> [
-                "comparison": it,
-                "adata_in": "full_atlas_merged.h5ad",
-                "stratification_csv": "patient_stratification.csv"
-            ]
-        },
-        extended_atlas.mix(patient_stratification).collect()
+        [
+            "adata_in": "full_atlas_merged.h5ad",
+            "stratification_csv": "patient_stratification.csv"
+        ],
+        // score_cells/run_comparisons are more recent than the container, therefore the
+        // scanpy_helpers package is staged into the working directory of the notebook.
+        extended_atlas.mix(
+            patient_stratification,
+            Channel.fromPath("${baseDir}/lib/scanpy_helper_submodule/scanpy_helpers", type: "dir", checkIfExists: true)
+        ).collect()
     )
 
     COMPARE_GROUPS_PLOTS(
@@ -117,7 +111,8 @@ workflow plots_and_comparisons {
             "path_prefix": "./",
             "deseq2_path_prefix": "./"
         ],
-        COMPARE_GROUPS.out.artifacts.mix(deseq2_results).collect()
+        // only the result tables; not the signature score store
+        COMPARE_GROUPS.out.artifacts.flatten().filter{ it.name.endsWith(".tsv") }.mix(deseq2_results).collect()
     )
 
     ch_core_atlas_input_files = core_atlas.concat(